@@ -6,10 +6,18 @@ from rest_framework import (
     generics,
     status,
     decorators,
+    mixins,
+    permissions,
+    filters,
 )
-from bookstore.models import Book, Author, Publisher, Tag, Series, Shelf, Comments
+from rest_framework.response import Response
+from django.conf import settings
+from django.db import transaction
+from bookstore.models import Book, Author, Publisher, Tag, Series, Shelf, Comments, File, UploadSession
 from bookstore.serializers import BookSerializer, AuthorSerializer, PublisherSerializer, TagSerializer, ShelfSerializer, \
-    SeriesSerializer, CommentsSerializer
+    SeriesSerializer, CommentsSerializer, CatalogSearchSerializer, UploadSessionSerializer
+from bookstore import search, storage, formats
+from bookstore.pagination import BookCursorPagination
 
 router = routers.DefaultRouter()
 app_name = 'Candle'
@@ -18,6 +26,10 @@ app_name = 'Candle'
 class BookViewSet(viewsets.ModelViewSet):
     queryset = Book.objects.all()
     serializer_class = BookSerializer
+    pagination_class = BookCursorPagination
+    filter_backends = [filters.OrderingFilter]
+    ordering_fields = ['created_at', 'title']
+    ordering = ['-created_at', '-pk']
 
 
 class AuthorViewSet(viewsets.ModelViewSet):
@@ -45,9 +57,96 @@ class TagViewSet(viewsets.ModelViewSet):
     serializer_class = TagSerializer
 
 
+class SearchViewSet(viewsets.ViewSet):
+    def list(self, request):
+        query = request.query_params.get('query', '').strip()
+        if len(query) < 3:
+            return Response({'detail': 'Query must have min 3 character!'}, status=status.HTTP_400_BAD_REQUEST)
+        kinds = request.query_params.getlist('type') or None
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 5)), 50))
+        except ValueError:
+            limit = 5
+        result = search.search_catalog(query, kinds, limit)
+        return Response(CatalogSearchSerializer(result).data)
+
+
+class AutocompleteView(views.APIView):
+    def get(self, request):
+        query = request.query_params.get('q', '')
+        kinds = request.query_params.getlist('type') or None
+        return Response({'query': query, 'results': search.autocomplete(query, kinds)})
+
+
+class UploadSessionViewSet(mixins.CreateModelMixin,
+                           mixins.RetrieveModelMixin,
+                           mixins.DestroyModelMixin,
+                           viewsets.GenericViewSet):
+    """
+    Resumable upload of a book file. A session is created with the file name and
+    size, then the raw bytes are sent with ``PUT chunk`` requests carrying an
+    ``Upload-Offset`` header. After a failure the client reads ``offset`` from
+    the session and continues from there. The last chunk creates the ``File``.
+    """
+    serializer_class = UploadSessionSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    lookup_field = 'uuid'
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(uploader=self.request.user)
+
+    def perform_create(self, serializer):
+        serializer.save(uploader=self.request.user)
+
+    @decorators.action(detail=True, methods=['put'])
+    def chunk(self, request, uuid=None):
+        session = self.get_object()
+        try:
+            offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except (KeyError, ValueError):
+            return Response({'detail': 'Upload-Offset header is required!'}, status=status.HTTP_400_BAD_REQUEST)
+        if offset != session.offset or session.is_complete:
+            return Response(self.get_serializer(session).data, status=status.HTTP_409_CONFLICT)
+        if length > settings.UPLOAD_CHUNK_MAX_SIZE:
+            return Response({'detail': 'Chunk is too large!'}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        if offset + length > session.size:
+            return Response({'detail': 'Chunk exceeds the file size!'}, status=status.HTTP_400_BAD_REQUEST)
+
+        written = storage.write_chunk(session.storage_name, offset, request.stream, length) if length else 0
+        updated = UploadSession.objects.filter(pk=session.pk, offset=offset).update(offset=offset + written)
+        session.refresh_from_db()
+        if not updated:
+            return Response(self.get_serializer(session).data, status=status.HTTP_409_CONFLICT)
+        if not session.is_complete:
+            return Response(self.get_serializer(session).data)
+
+        blob = storage.hash_blob(session.storage_name)
+        extension = formats.detect_book_format(blob.head, session.extension)
+        if extension is None:
+            session.delete()
+            return Response({'detail': 'File is damaged or has a wrong extension!'},
+                            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        with transaction.atomic():
+            book = session.book or Book.objects.create()
+            # The replaced file goes first, so that releasing its blob cannot remove identical new content.
+            File.objects.filter(book=book, extension=extension).delete()
+            storage.commit_blob(blob)
+            session.book = book
+            session.file = File.objects.create(book=book,
+                                               extension=extension,
+                                               size=blob.size,
+                                               checksum=blob.checksum,
+                                               uploader=session.uploader)
+            session.save()
+        return Response(self.get_serializer(session).data, status=status.HTTP_201_CREATED)
+
+
 router.register('books', BookViewSet, 'books')
 router.register('authors', AuthorViewSet, 'authors')
 router.register('publisher', PublisherViewSet, 'publishers')
 router.register('series', SeriesViewSet, 'series')
 router.register('shelves', ShelfViewSet, 'shelves')
 router.register('tags', TagViewSet, 'tags')
+router.register('search', SearchViewSet, 'search')
+router.register('uploads', UploadSessionViewSet, 'uploads')
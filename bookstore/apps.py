@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class BookstoreConfig(AppConfig):
     name = 'bookstore'
+
+    def ready(self):
+        from bookstore import signals  # noqa: F401
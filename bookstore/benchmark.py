@@ -0,0 +1,149 @@
+"""
+Endpoint benchmarks driven through the test client.
+
+Every named URL of ``bookstore.urls`` (and of the API router) is requested
+repeatedly against a seeded catalog. Latency percentiles, the SQL query count
+and time, and the peak Python memory of one request are recorded per endpoint,
+so that two runs can be compared.
+"""
+import re
+import time
+import tracemalloc
+
+from django.db import connection
+from django.urls import URLPattern, reverse
+
+from bookstore import urls
+from bookstore.api_views import router
+from bookstore.models import Book, Author, Tag, Series, Publisher, Shelf, File
+
+# Endpoints that change data on GET or need files the generated catalog does not have
+SKIPPED = re.compile(r'delete|^file-download$|^api:uploads-')
+
+MODELS = [
+    ('book', Book),
+    ('author', Author),
+    ('tag', Tag),
+    ('series', Series),
+    ('publisher', Publisher),
+    ('shel', Shelf),
+    ('file', File),
+]
+
+SEARCH_PARAMS = {
+    'search': 'query',
+    'book-search': 'query',
+    'author-search': 'query',
+    'tag-search': 'query',
+    'series-search': 'query',
+    'publishers-search': 'query',
+    'api:search-list': 'query',
+    'autocomplete': 'q',
+}
+
+
+class QueryRecorder:
+    """``connection.execute_wrapper`` counting the queries and their time."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def _model_for(name):
+    short_name = name.split(':')[-1]
+    for prefix, model in MODELS:
+        if short_name.startswith(prefix):
+            return model
+    return None
+
+
+def endpoints(search_term):
+    """Returns ``[(name, url)]`` for every named URL that can be requested with GET."""
+    patterns = [(pattern.name, pattern) for pattern in urls.urlpatterns if isinstance(pattern, URLPattern)]
+    patterns += [('api:' + pattern.name, pattern) for pattern in router.urls]
+
+    result = []
+    for name, pattern in patterns:
+        if not name or SKIPPED.search(name) or name in dict(result):
+            continue
+        groups = set(pattern.pattern.regex.groupindex)
+        if groups - {'pk'}:
+            continue
+        kwargs = {}
+        if groups:
+            model = _model_for(name)
+            instance = model.objects.order_by('pk').first() if model else None
+            if instance is None:
+                continue
+            kwargs['pk'] = instance.pk
+        url = reverse(name, kwargs=kwargs)
+        if name in SEARCH_PARAMS:
+            url += '?{}={}'.format(SEARCH_PARAMS[name], search_term)
+        result.append((name, url))
+    return result
+
+
+def measure(client, url, repeat, warmup=1):
+    for _ in range(warmup):
+        client.get(url)
+
+    timings = []
+    recorder = QueryRecorder()
+    with connection.execute_wrapper(recorder):
+        for _ in range(repeat):
+            started = time.perf_counter()
+            response = client.get(url)
+            timings.append(time.perf_counter() - started)
+
+    # Memory is traced in a separate request because tracing slows everything down.
+    tracemalloc.start()
+    client.get(url)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'url': url,
+        'status': response.status_code,
+        'p50_ms': round(percentile(timings, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(timings, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 3),
+        'queries': recorder.count // repeat,
+        'query_ms': round(recorder.duration / repeat * 1000, 3),
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def compare(baseline, current, threshold, min_delta_ms=1.0):
+    """
+    Returns the regressions of ``current`` against ``baseline``: a p95 latency
+    above ``1 + threshold`` times the baseline (and at least ``min_delta_ms``
+    slower), or more queries than before.
+    """
+    regressions = []
+    for name, result in current['endpoints'].items():
+        before = baseline['endpoints'].get(name)
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + threshold) and \
+                result['p95_ms'] - before['p95_ms'] >= min_delta_ms:
+            regressions.append('{}: p95 {} ms -> {} ms'.format(name, before['p95_ms'], result['p95_ms']))
+        if result['queries'] > before['queries']:
+            regressions.append('{}: {} queries -> {}'.format(name, before['queries'], result['queries']))
+    return regressions
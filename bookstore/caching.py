@@ -0,0 +1,110 @@
+"""
+Versioned cache tags and the page cache of anonymous visitors.
+
+A tag names a model (``bookstore.book``), one of its rows
+(``bookstore.book:12``) or a table (``table:bookstore_book``). Every tag has a
+version in the cache and every entry remembers the versions of its tags;
+``invalidate()`` replaces a version, so the entries stored under the old one
+are never read again. ``ALL`` belongs to every entry: ``invalidate()``
+without tags drops everything, after bulk writes that send no signals.
+
+Pages are tagged with the rows they showed, collected from ``post_init`` while
+the view runs, and with the models whose lists they show. The handlers in
+``bookstore.signals`` invalidate a row, its model and the rows it refers to
+on every write.
+"""
+from contextlib import contextmanager
+import hashlib
+import threading
+import uuid
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils import translation
+
+ALL = '*'
+
+_local = threading.local()
+
+
+def _version_key(tag):
+    return 'tag-version:' + tag
+
+
+def model_tag(model, pk=None):
+    label = model._meta.label_lower
+    return label if pk is None else '{}:{}'.format(label, pk)
+
+
+def invalidate(*tags):
+    """Forgets the entries tagged with any of ``tags``, or every entry without arguments."""
+    cache.set_many({_version_key(tag): uuid.uuid4().hex for tag in tags or [ALL]}, None)
+
+
+def versions(tags):
+    """``{tag: version}`` of ``tags`` and ``ALL``, starting the versions that are missing."""
+    tags = set(tags) | {ALL}
+    current = cache.get_many([_version_key(tag) for tag in tags])
+    missing = {_version_key(tag): uuid.uuid4().hex for tag in tags if _version_key(tag) not in current}
+    if missing:
+        cache.set_many(missing, None)
+        current.update(missing)
+    return {tag: current[_version_key(tag)] for tag in tags}
+
+
+def is_current(tag_versions):
+    current = cache.get_many([_version_key(tag) for tag in tag_versions])
+    return all(current.get(_version_key(tag)) == version for tag, version in tag_versions.items())
+
+
+@contextmanager
+def collect_tags():
+    """Yields the set of tags of the model instances loaded inside the block."""
+    tags = set()
+    previous, _local.tags = getattr(_local, 'tags', None), tags
+    try:
+        yield tags
+    finally:
+        _local.tags = previous
+
+
+def record_instance(sender, instance, **kwargs):
+    """``post_init`` receiver feeding ``collect_tags()``."""
+    tags = getattr(_local, 'tags', None)
+    if tags is not None and instance.pk is not None:
+        tags.add(model_tag(sender, instance.pk))
+
+
+def is_cacheable(request):
+    """Only anonymous reads without pending messages share a cached page."""
+    return (settings.PAGE_CACHE_TIMEOUT and request.method in ('GET', 'HEAD')
+            and not request.user.is_authenticated and not len(messages.get_messages(request)))
+
+
+def page_key(request, view):
+    query = sorted((key, value) for key, values in request.GET.lists() for value in values)
+    signature = repr((view, request.path, query, translation.get_language()))
+    return 'page:' + hashlib.md5(signature.encode()).hexdigest()
+
+
+def get_page(key):
+    entry = cache.get(key)
+    if entry is None or not is_current(entry['versions']):
+        return None
+    response = HttpResponse(entry['content'])
+    for header, value in entry['headers']:
+        response[header] = value
+    return response
+
+
+def set_page(key, response, tag_versions):
+    """
+    Stores ``response`` under ``key``. ``tag_versions`` should be read before
+    rendering where possible, so that a write meanwhile leaves the entry stale.
+    """
+    if response.status_code != 200 or response.streaming or response.cookies:
+        return
+    entry = {'versions': tag_versions, 'content': response.content, 'headers': list(response.items())}
+    cache.set(key, entry, settings.PAGE_CACHE_TIMEOUT)
@@ -0,0 +1,70 @@
+"""
+Denormalized ``book_count`` of authors, tags, series and publishers.
+
+The counters are adjusted by the signal handlers in ``bookstore.signals`` with
+``F()`` updates, one statement per model and delta. Bulk writes send no
+signals, so their callers ``recount()`` the rows they touched and the
+``reconcile_book_counts`` command recounts everything.
+"""
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+# Primary keys per UPDATE, below the bound parameter limit of SQLite
+UPDATE_BATCH_SIZE = 500
+
+
+def taxonomy():
+    """``{model: lookup from Book}`` of the models with a ``book_count``."""
+    from bookstore.models import Author, Tag, Series, Publisher
+    return {Author: 'authors', Tag: 'tags', Series: 'series', Publisher: 'publisher'}
+
+
+def adjust(model, ids, delta):
+    """Adds ``delta`` to the ``book_count`` of ``ids``, once per occurrence of an id."""
+    by_delta = {}
+    for pk, times in Counter(pk for pk in ids if pk is not None).items():
+        by_delta.setdefault(delta * times, []).append(pk)
+    for change, pks in by_delta.items():
+        model.objects.filter(pk__in=pks).update(book_count=F('book_count') + change)
+
+
+def actual_count(model):
+    """Subquery counting the books of the outer ``model`` row."""
+    from bookstore.models import Book
+    lookup = taxonomy()[model]
+    books = Book.objects.filter(**{lookup: OuterRef('pk')}).order_by().values(lookup)
+    return Coalesce(Subquery(books.annotate(count=Count('pk')).values('count')), Value(0))
+
+
+def linked(book_ids):
+    """``{model: ids}`` of the rows that the books ``book_ids`` count towards."""
+    from bookstore.models import Book
+    books = Book.objects.filter(pk__in=book_ids).order_by()
+    return {model: set(books.exclude(**{lookup: None}).values_list(lookup, flat=True))
+            for model, lookup in taxonomy().items()}
+
+
+def recount_linked(*links):
+    """Recounts the union of ``linked()`` results, taken before and after a bulk write."""
+    for model in taxonomy():
+        ids = set().union(*(link[model] for link in links))
+        if ids:
+            recount(model.objects.filter(pk__in=ids))
+
+
+def recount(rows):
+    """Sets the exact ``book_count`` of the ``rows`` queryset; returns the number of rows fixed."""
+    model = rows.model
+    wrong = rows.annotate(actual=actual_count(model)).exclude(book_count=F('actual')).values_list('pk', 'actual')
+    by_count = {}
+    for pk, count in wrong:
+        by_count.setdefault(count, []).append(pk)
+    fixed = 0
+    with transaction.atomic():
+        for count, pks in by_count.items():
+            for start in range(0, len(pks), UPDATE_BATCH_SIZE):
+                fixed += model.objects.filter(pk__in=pks[start:start + UPDATE_BATCH_SIZE]).update(book_count=count)
+    return fixed
@@ -0,0 +1,74 @@
+"""
+Cover images and their pre-rendered variants.
+
+The uploaded original is stored as ``covers/<uuid>``; every size listed in
+``settings.COVER_SIZES`` is rendered next to it as ``covers/<uuid>_<size>.jpg``
+(and ``.webp`` when ``settings.COVER_WEBP`` is set).
+"""
+import io
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+FORMATS = {
+    'jpeg': ('jpg', {'format': 'JPEG', 'quality': 85, 'optimize': True, 'progressive': True}),
+    'webp': ('webp', {'format': 'WEBP', 'quality': 80, 'method': 4}),
+}
+
+
+def cover_formats():
+    return ['jpeg', 'webp'] if settings.COVER_WEBP else ['jpeg']
+
+
+def cover_name(uuid_hex, size=None, image_format='jpeg'):
+    if size is None:
+        return 'covers/' + uuid_hex
+    return 'covers/{}_{}.{}'.format(uuid_hex, size, FORMATS[image_format][0])
+
+
+def variant_names(uuid_hex):
+    return [cover_name(uuid_hex, size, image_format) for size in settings.COVER_SIZES for image_format in FORMATS]
+
+
+def render_variants(uuid_hex, force=True):
+    """Renders every size and format of a stored cover, returns the number written."""
+    with default_storage.open(cover_name(uuid_hex), 'rb') as original:
+        image = ImageOps.exif_transpose(Image.open(original))
+        image = image.convert('RGB')
+
+    written = 0
+    for size, dimensions in settings.COVER_SIZES.items():
+        variant = image.copy()
+        variant.thumbnail(dimensions, Image.LANCZOS)
+        for image_format in cover_formats():
+            name = cover_name(uuid_hex, size, image_format)
+            if default_storage.exists(name):
+                if not force:
+                    continue
+                default_storage.delete(name)
+            extension, options = FORMATS[image_format]
+            buffer = io.BytesIO()
+            variant.save(buffer, **options)
+            default_storage.save(name, ContentFile(buffer.getvalue()))
+            written += 1
+    return written
+
+
+def delete_cover(uuid_hex):
+    for name in [cover_name(uuid_hex)] + variant_names(uuid_hex):
+        if default_storage.exists(name):
+            default_storage.delete(name)
+
+
+def save_cover(book, content):
+    """
+    Replaces the cover of ``book``. An image PIL cannot decode raises ``OSError``
+    (``UnidentifiedImageError`` is one) before the old cover is touched.
+    """
+    Image.open(content).load()
+    content.seek(0)
+    delete_cover(book.uuid.hex)
+    default_storage.save(cover_name(book.uuid.hex), content)
+    render_variants(book.uuid.hex)
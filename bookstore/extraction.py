@@ -0,0 +1,481 @@
+"""
+Metadata and cover extraction from uploaded ebook files.
+
+The readers below only parse files and return plain dictionaries, so they can
+run in worker processes without touching the database. ``apply_metadata`` then
+writes a batch of results in the main process: empty ``Book`` fields are filled
+in and the referenced authors, tags, series and publishers are fetched or
+created in bulk.
+
+Covers are taken from EPUB manifests and FB2 binaries; PDF first pages are
+rendered only when PyMuPDF (``fitz``) is installed.
+"""
+import base64
+import io
+import posixpath
+import re
+import struct
+import zipfile
+from datetime import date, timedelta
+from urllib.parse import unquote
+from xml.etree import ElementTree
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image
+
+from bookstore import caching, counters, covers, pagination, search
+
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+METADATA_FORMATS = {'epub', 'fb2', 'pdf', 'mobi'}
+# In order of preference when a book has several files
+COVER_FORMATS = ['epub', 'fb2', 'pdf']
+
+DC = '{http://purl.org/dc/elements/1.1/}'
+OPF = '{http://www.idpf.org/2007/opf}'
+CONTAINER = '{urn:oasis:names:tc:opendocument:xmlns:container}'
+FB2 = '{http://www.gribuser.ru/xml/fictionbook/2.0}'
+
+# Upper bound of the XML documents read out of an EPUB archive
+MAX_XML_SIZE = 4 * 1024 * 1024
+MAX_COVER_SIZE = 16 * 1024 * 1024
+# PDF info dictionaries are searched in the first and last bytes of the file
+PDF_SCAN_SIZE = 1024 * 1024
+
+TAG_RE = re.compile(r'<[^>]+>')
+YEAR_RE = re.compile(r'(\d{4})(?:-(\d{2}))?(?:-(\d{2}))?')
+ISBN_RE = re.compile(r'(97[89])?\d{9}[\dX]')
+
+
+def _text(value):
+    return ' '.join(TAG_RE.sub(' ', value or '').split())
+
+
+def _date(value):
+    match = YEAR_RE.search(value or '')
+    if not match:
+        return None
+    year, month, day = match.groups()
+    try:
+        return date(int(year), int(month or 1), int(day or 1))
+    except ValueError:
+        return None
+
+
+def _isbn(value):
+    match = ISBN_RE.search((value or '').upper().replace('-', '').replace(' ', ''))
+    return match.group(0) if match else ''
+
+
+def _read_member(archive, name, max_size):
+    if archive.getinfo(name).file_size > max_size:
+        raise ValueError('{} is too large'.format(name))
+    return archive.read(name)
+
+
+def _read_package(archive):
+    container = ElementTree.fromstring(_read_member(archive, 'META-INF/container.xml', MAX_XML_SIZE))
+    path = container.find('.//{}rootfile'.format(CONTAINER)).get('full-path')
+    return path, ElementTree.fromstring(_read_member(archive, path, MAX_XML_SIZE))
+
+
+def read_epub(file):
+    with zipfile.ZipFile(file) as archive:
+        path, package = _read_package(archive)
+    metadata = package.find(OPF + 'metadata')
+    if metadata is None:
+        return {}
+
+    meta = {element.get('name') or element.get('property'): element.get('content') or element.text
+            for element in metadata.iter(OPF + 'meta')}
+    identifiers = [element.text for element in metadata.findall(DC + 'identifier')]
+    return {
+        'title': metadata.findtext(DC + 'title'),
+        'authors': [element.text for element in metadata.findall(DC + 'creator')],
+        'tags': [element.text for element in metadata.findall(DC + 'subject')],
+        'series': meta.get('calibre:series') or meta.get('belongs-to-collection'),
+        'publisher': metadata.findtext(DC + 'publisher'),
+        'isbn': next(filter(None, map(_isbn, identifiers)), ''),
+        'description': _text(metadata.findtext(DC + 'description')),
+        'published_at': _date(metadata.findtext(DC + 'date')),
+    }
+
+
+def read_fb2(file):
+    # FB2 embeds its images after <description>, so parsing stops there.
+    for event, element in ElementTree.iterparse(file, events=['end']):
+        if element.tag == FB2 + 'description':
+            break
+    else:
+        return {}
+
+    title_info = element.find(FB2 + 'title-info')
+    publish_info = element.find(FB2 + 'publish-info')
+    if title_info is None:
+        return {}
+    authors = []
+    for author in title_info.findall(FB2 + 'author'):
+        parts = [author.findtext(FB2 + part) for part in ('first-name', 'middle-name', 'last-name')]
+        authors.append(' '.join(filter(None, parts)) or author.findtext(FB2 + 'nickname'))
+    sequence = title_info.find(FB2 + 'sequence')
+    annotation = title_info.find(FB2 + 'annotation')
+    metadata = {
+        'title': title_info.findtext(FB2 + 'book-title'),
+        'authors': authors,
+        'tags': [genre.text for genre in title_info.findall(FB2 + 'genre')],
+        'series': sequence.get('name') if sequence is not None else None,
+        'description': _text(' '.join(annotation.itertext())) if annotation is not None else '',
+        'published_at': _date(title_info.findtext(FB2 + 'date')),
+    }
+    if publish_info is not None:
+        metadata['publisher'] = publish_info.findtext(FB2 + 'publisher')
+        metadata['isbn'] = _isbn(publish_info.findtext(FB2 + 'isbn'))
+        metadata['published_at'] = metadata['published_at'] or _date(publish_info.findtext(FB2 + 'year'))
+    return metadata
+
+
+def _pdf_string(raw):
+    if raw.startswith(b'<'):
+        raw = bytes.fromhex(raw[1:-1].decode('ascii', 'ignore'))
+    else:
+        raw = re.sub(rb'\\([0-7]{1,3})', lambda m: bytes([int(m.group(1), 8) & 0xff]), raw[1:-1])
+        raw = re.sub(rb'\\(.)', rb'\1', raw)
+    if raw.startswith(b'\xfe\xff'):
+        return raw[2:].decode('utf-16-be', 'replace')
+    return raw.decode('latin-1')
+
+
+def read_pdf(file):
+    # Only uncompressed info dictionaries are seen; compressed object streams yield nothing.
+    head = file.read(PDF_SCAN_SIZE)
+    size = file.seek(0, 2)
+    file.seek(max(size - PDF_SCAN_SIZE, len(head)))
+    data = head + file.read()
+    fields = {}
+    for key in ('Title', 'Author', 'Subject', 'Keywords', 'CreationDate'):
+        match = re.search(rb'/' + key.encode() + rb'\s*(\((?:\\.|[^\\)])*\)|<[0-9A-Fa-f\s]*>)', data)
+        if match:
+            fields[key] = _pdf_string(match.group(1)).strip()
+    keywords = fields.get('Keywords', '')
+    return {
+        'title': fields.get('Title'),
+        'authors': re.split(r'\s*[;&]\s*|\s+and\s+', fields['Author']) if fields.get('Author') else [],
+        'tags': re.split(r'\s*[,;]\s*', keywords) if keywords else [],
+        'description': fields.get('Subject', ''),
+        'published_at': _date(fields.get('CreationDate', '')[2:]),
+    }
+
+
+def read_mobi(file):
+    header = file.read(78 + 8)
+    if header[60:68] not in (b'BOOKMOBI', b'TEXtREAd'):
+        return {}
+    record0 = struct.unpack('>I', header[78:82])[0]
+    file.seek(record0)
+    record = file.read(64 * 1024)
+    if record[16:20] != b'MOBI':
+        return {'title': header[:32].split(b'\x00')[0].decode('latin-1')}
+
+    mobi_length, encoding = struct.unpack('>I4xI', record[20:32])
+    codec = 'utf-8' if encoding == 65001 else 'cp1252'
+    name_offset, name_length = struct.unpack('>II', record[84:92])
+    metadata = {'title': record[name_offset:name_offset + name_length].decode(codec, 'replace'),
+                'authors': [], 'tags': []}
+    exth = 16 + mobi_length
+    if not struct.unpack('>I', record[128:132])[0] & 0x40 or record[exth:exth + 4] != b'EXTH':
+        return metadata
+
+    count = struct.unpack('>I', record[exth + 8:exth + 12])[0]
+    position = exth + 12
+    for _ in range(count):
+        kind, length = struct.unpack('>II', record[position:position + 8])
+        value = record[position + 8:position + length].decode(codec, 'replace')
+        position += length
+        if kind == 100:
+            metadata['authors'].append(value)
+        elif kind == 101:
+            metadata['publisher'] = value
+        elif kind == 103:
+            metadata['description'] = _text(value)
+        elif kind == 104:
+            metadata['isbn'] = _isbn(value)
+        elif kind == 105:
+            metadata['tags'].append(value)
+        elif kind == 106:
+            metadata['published_at'] = _date(value)
+        elif kind == 503:
+            metadata['title'] = value
+    return metadata
+
+
+def read_epub_cover(file):
+    with zipfile.ZipFile(file) as archive:
+        path, package = _read_package(archive)
+        metadata = package.find(OPF + 'metadata')
+        cover_id = None
+        if metadata is not None:
+            cover_id = next((meta.get('content') for meta in metadata.iter(OPF + 'meta')
+                             if meta.get('name') == 'cover'), None)
+        images = [item for item in package.iter(OPF + 'item') if item.get('media-type', '').startswith('image/')]
+        candidates = [item for item in images if 'cover-image' in item.get('properties', '').split()]
+        candidates += [item for item in images if item.get('id') == cover_id]
+        candidates += [item for item in images if 'cover' in (item.get('id', '') + item.get('href', '')).lower()]
+        if not candidates:
+            return None
+        href = posixpath.join(posixpath.dirname(path), unquote(candidates[0].get('href')))
+        return _read_member(archive, posixpath.normpath(href), MAX_COVER_SIZE)
+
+
+def read_fb2_cover(file):
+    href = None
+    for event, element in ElementTree.iterparse(file, events=['end']):
+        if element.tag == FB2 + 'coverpage':
+            image = element.find(FB2 + 'image')
+            attributes = image.attrib if image is not None else {}
+            href = next((value for key, value in attributes.items() if key.endswith('href')), '').lstrip('#')
+        elif element.tag == FB2 + 'binary':
+            if href and element.get('id') == href:
+                return base64.b64decode(element.text or '')
+            element.clear()
+        elif element.tag == FB2 + 'body':
+            element.clear()
+    return None
+
+
+def read_pdf_cover(file):
+    if fitz is None:
+        return None
+    with fitz.open(stream=file.read(), filetype='pdf') as document:
+        if not document.page_count:
+            return None
+        return document[0].get_pixmap(matrix=fitz.Matrix(2, 2)).tobytes('png')
+
+
+READERS = {
+    'epub': read_epub,
+    'fb2': read_fb2,
+    'pdf': read_pdf,
+    'mobi': read_mobi,
+}
+
+
+COVER_READERS = {
+    'epub': read_epub_cover,
+    'fb2': read_fb2_cover,
+    'pdf': read_pdf_cover,
+}
+
+
+def extract_metadata(name, extension):
+    with default_storage.open(name, 'rb') as file:
+        return READERS[extension](file)
+
+
+def extract_cover(name, extension, uuid_hex):
+    """
+    Stores the embedded cover of a book file as ``covers/<uuid>`` and renders its
+    variants. Returns False when there is no cover or the book already has one.
+    """
+    if default_storage.exists(covers.cover_name(uuid_hex)):
+        return False
+    with default_storage.open(name, 'rb') as file:
+        data = COVER_READERS[extension](file)
+    if not data:
+        return False
+    Image.open(io.BytesIO(data)).verify()
+    default_storage.save(covers.cover_name(uuid_hex), ContentFile(data))
+    covers.render_variants(uuid_hex)
+    return True
+
+
+def _names(values, max_length):
+    names = []
+    for value in values or []:
+        value = ' '.join((value or '').split())[:max_length]
+        if value and value not in names:
+            names.append(value)
+    return names
+
+
+def get_or_create_names(model, field, names):
+    """Returns ``{name: pk}``, creating the missing rows with one bulk insert."""
+    if not names:
+        return {}
+    pks = dict(model.objects.filter(**{field + '__in': names}).values_list(field, 'pk'))
+    missing = [name for name in names if name not in pks]
+    if missing:
+        rows = [model(**{field: name}) for name in missing]
+        for row in rows:
+            row.update_letter()
+        model.objects.bulk_create(rows)
+        created = model.objects.filter(**{field + '__in': missing}).exclude(pk__in=pks.values())
+        kind = model._meta.model_name
+        terms = set()
+        for instance in created:
+            pks.setdefault(getattr(instance, field), instance.pk)
+            terms.update(search.vocabulary(getattr(instance, field)))
+            search.index_autocomplete(kind, instance)
+        search.add_terms(terms)
+        pagination.invalidate_counts(model._meta.db_table)
+    return pks
+
+
+def clean_metadata(metadata):
+    """Normalizes the names of ``metadata`` in place into lists fitting the model fields."""
+    from bookstore.models import Author, Tag, Series, Publisher
+
+    metadata['authors'] = _names(metadata.get('authors'), Author._meta.get_field('name').max_length)
+    metadata['tags'] = _names(metadata.get('tags'), Tag._meta.get_field('name').max_length)
+    metadata['series'] = _names([metadata.get('series')], Series._meta.get_field('title').max_length)
+    metadata['publisher'] = _names([metadata.get('publisher')], Publisher._meta.get_field('name').max_length)
+    return metadata
+
+
+def resolve_names(metadatas):
+    """Returns the ``{name: pk}`` maps of authors, tags, series and publishers of cleaned metadata."""
+    from bookstore.models import Author, Tag, Series, Publisher
+
+    def collect(key):
+        return list({name: None for metadata in metadatas for name in metadata[key]})
+
+    return (get_or_create_names(Author, 'name', collect('authors')),
+            get_or_create_names(Tag, 'name', collect('tags')),
+            get_or_create_names(Series, 'title', collect('series')),
+            get_or_create_names(Publisher, 'name', collect('publisher')))
+
+
+@transaction.atomic
+def apply_metadata(results):
+    """
+    Fills in the empty fields of books from ``results``, a list of
+    ``(book_id, metadata)``. Existing values are never overwritten.
+    """
+    from bookstore.models import Book, Author, Tag
+
+    books = Book.objects.in_bulk([book_id for book_id, metadata in results])
+    results = [(books[book_id], clean_metadata(metadata))
+               for book_id, metadata in results if book_id in books and metadata]
+    authors, tags, series, publishers = resolve_names([metadata for book, metadata in results])
+
+    book_ids = [book.pk for book, metadata in results]
+    with_authors = set(Book.authors.through.objects.filter(book_id__in=book_ids).values_list('book_id', flat=True))
+    with_tags = set(Book.tags.through.objects.filter(book_id__in=book_ids).values_list('book_id', flat=True))
+    book_authors, book_tags = [], []
+    default_title = Book._meta.get_field('title').default
+    for book, metadata in results:
+        fields = []
+        title = ' '.join((metadata.get('title') or '').split())
+        if title and book.title == default_title:
+            book.title = title[:128]
+            fields.append('title')
+        for field in ('description', 'isbn'):
+            value = (metadata.get(field) or '')[:Book._meta.get_field(field).max_length]
+            if value and not getattr(book, field):
+                setattr(book, field, value)
+                fields.append(field)
+        if metadata.get('published_at') and not book.published_at:
+            book.published_at = metadata['published_at']
+            fields.append('published_at')
+        if metadata['series'] and not book.series_id:
+            book.series_id = series[metadata['series'][0]]
+            fields.append('series')
+        if metadata['publisher'] and not book.publisher_id:
+            book.publisher_id = publishers[metadata['publisher'][0]]
+            fields.append('publisher')
+        if fields:
+            book.save(update_fields=fields + ['last_modified'])
+
+        if book.pk not in with_authors:
+            book_authors.extend(Book.authors.through(book_id=book.pk, author_id=authors[name])
+                                for name in metadata['authors'])
+        if book.pk not in with_tags:
+            book_tags.extend(Book.tags.through(book_id=book.pk, tag_id=tags[name]) for name in metadata['tags'])
+    Book.authors.through.objects.bulk_create(book_authors)
+    Book.tags.through.objects.bulk_create(book_tags)
+    counters.adjust(Author, [link.author_id for link in book_authors], 1)
+    counters.adjust(Tag, [link.tag_id for link in book_tags], 1)
+    pagination.invalidate_counts(Book.authors.through._meta.db_table, Book.tags.through._meta.db_table)
+    # The bulk inserts send no m2m_changed, so the cached cards and pages are renewed here.
+    Book.objects.filter(pk__in={link.book_id for link in book_authors}).touch_authors()
+    caching.invalidate(caching.model_tag(Author), caching.model_tag(Tag),
+                       *{caching.model_tag(Book, link.book_id) for link in book_tags},
+                       *{caching.model_tag(Author, link.author_id) for link in book_authors},
+                       *{caching.model_tag(Tag, link.tag_id) for link in book_tags})
+
+
+def enqueue(files):
+    from bookstore.models import ExtractionJob
+
+    jobs = [ExtractionJob(file=file, kind=ExtractionJob.METADATA)
+            for file in files if file.extension in METADATA_FORMATS]
+    jobs += [ExtractionJob(file=file, kind=ExtractionJob.COVER)
+             for file in files if file.extension in COVER_FORMATS and not file.book.has_cover]
+    ExtractionJob.objects.bulk_create(jobs)
+
+
+def enqueue_covers(batch_size=1000):
+    """
+    Queues one cover job for every book without a cover, preferring the formats
+    in ``COVER_FORMATS`` order. Books that already had a cover job are skipped,
+    so repeated calls only add what is missing. Returns the number queued.
+    """
+    from bookstore.models import ExtractionJob, File
+
+    files = File.objects.filter(book__has_cover=False, extension__in=COVER_FORMATS) \
+        .exclude(book__files__jobs__kind=ExtractionJob.COVER) \
+        .order_by('book_id').values_list('pk', 'book_id', 'extension')
+    best = {}
+    for pk, book_id, extension in files.iterator():
+        if book_id not in best or COVER_FORMATS.index(extension) < COVER_FORMATS.index(best[book_id][1]):
+            best[book_id] = (pk, extension)
+    jobs = [ExtractionJob(file_id=pk, kind=ExtractionJob.COVER) for pk, extension in best.values()]
+    ExtractionJob.objects.bulk_create(jobs, batch_size=batch_size)
+    return len(jobs)
+
+
+def claim_jobs(kind, limit):
+    """
+    Marks up to ``limit`` pending jobs as running and returns them. Jobs left
+    running by a crashed worker are retried after ``EXTRACTION_JOB_TIMEOUT``.
+    """
+    from bookstore.models import ExtractionJob
+
+    stale = timezone.now() - timedelta(seconds=settings.EXTRACTION_JOB_TIMEOUT)
+    ExtractionJob.objects.filter(kind=kind, status=ExtractionJob.RUNNING, last_modified__lt=stale) \
+        .update(status=ExtractionJob.PENDING)
+    with transaction.atomic():
+        pending = ExtractionJob.objects.select_for_update(skip_locked=True) \
+            .filter(kind=kind, status=ExtractionJob.PENDING).order_by('pk')
+        ids = list(pending.values_list('pk', flat=True)[:limit])
+        ExtractionJob.objects.filter(pk__in=ids).update(status=ExtractionJob.RUNNING, last_modified=timezone.now())
+    return list(ExtractionJob.objects.filter(pk__in=ids).select_related('file__book'))
+
+
+def finish_jobs(kind, jobs, results):
+    """
+    Stores the ``(job_id, result, error)`` of finished jobs: extracted metadata,
+    or whether a cover was stored.
+    """
+    from bookstore.models import ExtractionJob, Book
+
+    books = {job.pk: job.file.book_id for job in jobs}
+    if kind == ExtractionJob.METADATA:
+        apply_metadata([(books[job_id], metadata) for job_id, metadata, error in results if error is None])
+    else:
+        covered = list(Book.objects.filter(pk__in=[books[job_id] for job_id, stored, error in results if stored],
+                                           has_cover=False).values_list('pk', flat=True))
+        Book.objects.filter(pk__in=covered).update(has_cover=True, last_modified=timezone.now())
+        # The update sends no signals; the cached pages showing these books go here.
+        caching.invalidate(*[caching.model_tag(Book, pk) for pk in covered])
+    done = [job_id for job_id, result, error in results if error is None]
+    ExtractionJob.objects.filter(pk__in=done).update(status=ExtractionJob.DONE, error='')
+    for job_id, result, error in results:
+        if error is not None:
+            ExtractionJob.objects.filter(pk=job_id).update(status=ExtractionJob.FAILED, error=error)
@@ -0,0 +1,60 @@
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+
+def sniff_image_type(head):
+    for signature, content_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+# (offset, signature, extension) of the binary ebook formats
+BOOK_SIGNATURES = [
+    (0, b'%PDF-', 'pdf'),
+    (0, b'AT&TFORM', 'djvu'),
+    (0, b'Rar!\x1a\x07', 'cbr'),
+    (0, b'ITSF', 'chm'),
+    (0, b'{\\rtf', 'rtf'),
+    (30, b'mimetypeapplication/epub+zip', 'epub'),
+    (30, b'mimetypeapplication/vnd.oasis.opendocument.text', 'odt'),
+    (60, b'BOOKMOBI', 'mobi'),
+    (60, b'TEXtREAd', 'mobi'),
+]
+MARKUP_SIGNATURES = [
+    (b'<fictionbook', 'fb2'),
+    (b'<package', 'opf'),
+    (b'<!doctype html', 'html'),
+    (b'<html', 'html'),
+]
+TEXT_FORMATS = {'txt', 'html', 'fb2', 'opf'}
+
+
+def sniff_book_format(head):
+    for offset, signature, extension in BOOK_SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return extension
+    lowered = head.lower()
+    for signature, extension in MARKUP_SIGNATURES:
+        if signature in lowered:
+            return extension
+    return None
+
+
+def detect_book_format(head, extension):
+    """
+    Returns the real format of a file named with ``extension``, or None when a
+    binary format is claimed but its signature is missing.
+    """
+    sniffed = sniff_book_format(head)
+    if sniffed:
+        return sniffed
+    if extension in TEXT_FORMATS and b'\x00' not in head:
+        return extension
+    return None
@@ -10,9 +10,9 @@ class BookForm(forms.ModelForm):
     description = forms.CharField(required=False,
                                   widget=forms.Textarea)
 
-    cover = forms.FileField(label='Cover',
-                            required=False,
-                            validators=[FileExtensionValidator(VALID_COVER_EXT)])
+    cover = forms.ImageField(label='Cover',
+                             required=False,
+                             validators=[FileExtensionValidator(VALID_COVER_EXT)])
 
     files = forms.FileField(label='Book file',
                             widget=forms.ClearableFileInput(attrs={'multiple': True}),
@@ -0,0 +1,204 @@
+"""
+Opt-in per-request profiling (``QUERY_INSTRUMENTATION``).
+
+``QueryInstrumentationMiddleware`` records every SQL query of a request,
+answers with a ``Server-Timing`` header (db, template, storage, total), warns
+with the stack when one query shape repeats more than
+``QUERY_REPEAT_THRESHOLD`` times (an N+1 pattern) and logs the plan of
+queries slower than ``QUERY_EXPLAIN_THRESHOLD`` milliseconds. The template
+and storage times come from the template backend and the file storage below,
+which the settings only install while the flag is on.
+"""
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import logging
+import re
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.storage import FileSystemStorage
+from django.db import connection
+from django.template.backends.django import DjangoTemplates, Template
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+PLACEHOLDER_LIST_RE = re.compile(r'\((?:\s*%s\s*,)+\s*%s\s*\)')
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    """Query shape: literals and ``IN`` lists of any length look the same."""
+    sql = LITERAL_RE.sub('?', sql)
+    sql = PLACEHOLDER_LIST_RE.sub('(...)', sql)
+    return WHITESPACE_RE.sub(' ', sql).strip()
+
+
+def _stack():
+    """The project frames of the current stack and the template node being rendered, if any."""
+    frames = [frame for frame in traceback.extract_stack()[:-3]
+              if str(settings.BASE_DIR) in frame.filename and 'site-packages' not in frame.filename
+              and frame.filename != __file__]
+    stack = ''.join(traceback.format_list(frames))
+    for frame, lineno in traceback.walk_stack(None):
+        node = frame.f_locals.get('self')
+        if frame.f_code.co_name == 'render_annotated' and getattr(node, 'token', None) and node.origin:
+            stack += '  Template "{}", line {}\n'.format(node.origin.template_name, node.token.lineno)
+            break
+    return stack
+
+
+class RequestProfile:
+    """``connection.execute_wrapper`` collecting the queries and timings of one request."""
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.queries = 0
+        self.shapes = Counter()
+        self.explaining = False
+        self.running = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.explaining:
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.timings['db'] += duration
+            self.queries += 1
+            shape = normalize_sql(sql)
+            self.shapes[shape] += 1
+            if self.shapes[shape] == settings.QUERY_REPEAT_THRESHOLD + 1:
+                logger.warning('Query repeated more than %s times in one request: %s\n%s',
+                               settings.QUERY_REPEAT_THRESHOLD, shape, _stack())
+            if duration * 1000 >= settings.QUERY_EXPLAIN_THRESHOLD and not many:
+                self.explain(context['connection'], sql, params, duration)
+
+    def explain(self, db, sql, params, duration):
+        if not sql.lstrip().upper().startswith('SELECT'):
+            return
+        self.explaining = True
+        try:
+            with db.cursor() as cursor:
+                cursor.execute('{} {}'.format(db.ops.explain_query_prefix(), sql), params)
+                plan = '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+        except Exception as e:
+            plan = '{}: {}'.format(type(e).__name__, e)
+        finally:
+            self.explaining = False
+        logger.warning('Slow query (%.1f ms): %s\n%s', duration * 1000, sql, plan)
+
+    @property
+    def duplicates(self):
+        return {shape: count for shape, count in self.shapes.items() if count > 1}
+
+    def server_timing(self, total):
+        metrics = [('db', self.timings['db'], '{} queries'.format(self.queries)),
+                   ('template', self.timings['template'], None),
+                   ('storage', self.timings['storage'], None),
+                   ('total', total, None)]
+        return ', '.join('{};dur={:.1f}'.format(name, duration * 1000) + (';desc="{}"'.format(desc) if desc else '')
+                         for name, duration, desc in metrics)
+
+
+def current_profile():
+    return getattr(_local, 'profile', None)
+
+
+@contextmanager
+def timer(metric):
+    """
+    Adds the duration of the block to ``metric`` of the request being profiled.
+    Blocks nested in one of the same metric are already counted by it.
+    """
+    profile = current_profile()
+    if profile is None or metric in profile.running:
+        yield
+        return
+    profile.running.add(metric)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.timings[metric] += time.perf_counter() - started
+        profile.running.discard(metric)
+
+
+class InstrumentedFileSystemStorage(FileSystemStorage):
+    """``FileSystemStorage`` reporting its time to the ``storage`` metric."""
+
+    def _open(self, name, mode='rb'):
+        with timer('storage'):
+            return super()._open(name, mode)
+
+    def _save(self, name, content):
+        with timer('storage'):
+            return super()._save(name, content)
+
+    def delete(self, name):
+        with timer('storage'):
+            return super().delete(name)
+
+    def exists(self, name):
+        with timer('storage'):
+            return super().exists(name)
+
+    def size(self, name):
+        with timer('storage'):
+            return super().size(name)
+
+    def listdir(self, path):
+        with timer('storage'):
+            return super().listdir(path)
+
+
+class InstrumentedTemplate(Template):
+    """Backend template reporting its render time to the ``template`` metric."""
+
+    def render(self, context=None, request=None):
+        with timer('template'):
+            return super().render(context, request)
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """
+    ``DjangoTemplates`` timing every render, whether it comes from a
+    ``TemplateResponse``, ``render()`` or ``render_to_string()``.
+    """
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return InstrumentedTemplate(super().get_template(template_name).template, self)
+
+
+class QueryInstrumentationMiddleware:
+    def __init__(self, get_response):
+        if not settings.QUERY_INSTRUMENTATION:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profile = _local.profile = RequestProfile()
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(profile):
+                response = self.get_response(request)
+        finally:
+            _local.profile = None
+        total = time.perf_counter() - started
+
+        response['Server-Timing'] = profile.server_timing(total)
+        logger.info('%s %s: %s queries in %.1f ms, %.1f ms total', request.method, request.path,
+                    profile.queries, profile.timings['db'] * 1000, total * 1000)
+        for shape, count in profile.duplicates.items():
+            logger.debug('%s x %s', count, shape)
+        return response
@@ -0,0 +1,23 @@
+import os
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from bookstore import extraction
+from bookstore.models import ExtractionJob
+
+
+class Command(BaseCommand):
+    help = 'Extracting the embedded covers of books that have none'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--io-limit', type=float, default=0,
+                            help='Maximum average read rate in MB/s (default: unlimited)')
+
+    def handle(self, *args, **options):
+        # Queued jobs are the checkpoint: an interrupted run continues with the pending ones.
+        queued = extraction.enqueue_covers()
+        self.stdout.write('{} books queued'.format(queued))
+        call_command('run_extraction_worker', once=True, kind=[ExtractionJob.COVER], workers=options['workers'],
+                     io_limit=options['io_limit'], stdout=self.stdout, stderr=self.stderr)
@@ -0,0 +1,76 @@
+import json
+import re
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, \
+    teardown_test_environment
+
+from bookstore import benchmark
+from bookstore.models import Book
+
+
+class Command(BaseCommand):
+    help = 'Benchmarking every endpoint against a generated catalog in a test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=10, help='Multiplier passed to the generate command')
+        parser.add_argument('--repeat', type=int, default=30, help='Measured requests per endpoint')
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--endpoint', action='append', help='Regular expression selecting endpoint names')
+        parser.add_argument('--output', default='benchmark.json')
+        parser.add_argument('--baseline', help='Earlier output to compare with')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Allowed relative p95 slowdown before an endpoint counts as regressed')
+        parser.add_argument('--keepdb', action='store_true', help='Keep and reuse the test database')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+        try:
+            result = self.run(options)
+        finally:
+            teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        with open(options['output'], 'w') as file:
+            json.dump(result, file, indent=2)
+        self.stdout.write('Saved {}'.format(options['output']))
+
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                regressions = benchmark.compare(json.load(file), result, options['threshold'])
+            for regression in regressions:
+                self.stderr.write(regression)
+            if regressions:
+                raise CommandError('{} regressions'.format(len(regressions)))
+            self.stdout.write(self.style.SUCCESS('No regressions against {}'.format(options['baseline'])))
+
+    def run(self, options):
+        if not Book.objects.exists():
+            self.stdout.write('Generating the catalog')
+            call_command('generate', options['size'], seed=0, stdout=self.stdout)
+        user = User.objects.filter(username='benchmark').first() or \
+            User.objects.create_superuser('benchmark', 'benchmark@example.com', 'benchmark')
+        client = Client()
+        client.force_login(user)
+
+        search_term = Book.objects.order_by('pk').values_list('title', flat=True).first().split()[0].lower()
+        selected = [re.compile(pattern) for pattern in options['endpoint'] or ['']]
+        results = {}
+        self.stdout.write('{:<24} {:>6} {:>9} {:>9} {:>9} {:>8} {:>9} {:>9}'.format(
+            'endpoint', 'status', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'query ms', 'peak KB'))
+        for name, url in benchmark.endpoints(search_term):
+            if not any(pattern.search(name) for pattern in selected):
+                continue
+            result = results[name] = benchmark.measure(client, url, options['repeat'], options['warmup'])
+            self.stdout.write('{:<24} {status:>6} {p50_ms:>9} {p95_ms:>9} {p99_ms:>9} {queries:>8} {query_ms:>9} '
+                              '{peak_kb:>9}'.format(name, **result))
+        return {
+            'size': options['size'],
+            'books': Book.objects.count(),
+            'repeat': options['repeat'],
+            'endpoints': results,
+        }
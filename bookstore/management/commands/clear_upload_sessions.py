@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from bookstore.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = 'Deleting upload sessions older than UPLOAD_SESSION_EXPIRY'
+
+    def handle(self, *args, **options):
+        expired = timezone.now() - timedelta(seconds=settings.UPLOAD_SESSION_EXPIRY)
+        deleted = 0
+        for session in UploadSession.objects.filter(last_modified__lt=expired).iterator():
+            session.delete()
+            deleted += 1
+
+        self.stdout.write(self.style.SUCCESS('Successfully deleted {} sessions'.format(deleted)))
@@ -0,0 +1,24 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from bookstore import storage
+from bookstore.models import File
+
+
+class Command(BaseCommand):
+    help = 'Moving files stored by uuid into the content-addressed storage'
+
+    def handle(self, *args, **options):
+        moved = 0
+        for file in File.objects.filter(checksum='').iterator():
+            legacy_name = file.storage_name
+            if not default_storage.exists(legacy_name):
+                self.stderr.write('Missing {}'.format(legacy_name))
+                continue
+            with default_storage.open(legacy_name, 'rb') as content:
+                blob = storage.store_blob(content)
+            File.objects.filter(pk=file.pk).update(checksum=blob.checksum, size=blob.size)
+            default_storage.delete(legacy_name)
+            moved += 1
+
+        self.stdout.write(self.style.SUCCESS('Successfully moved {} files'.format(moved)))
@@ -1,17 +1,166 @@
+from multiprocessing import Pool
+import datetime
+import random
+import uuid
+
+from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.db.models import Max
+from faker import Faker
+
+from bookstore import counters, pagination, search
+from bookstore.forms import VALID_FILES_EXT
+from bookstore.models import Book, Author, Tag, Series, Publisher, Shelf, Comments, File, TaxonomyModel
+
+# Rows per multiplier unit
+BOOKS = 30
+AUTHORS = 5
+TAGS = 2
+SERIES = 3
+PUBLISHERS = 1
+SHELVES = 1
+USERS = 1
+
+AUTHORS_PER_BOOK = [1] * 16 + [2] * 3 + [3]
+FILE_EXTENSIONS = ['epub'] * 5 + ['pdf'] * 3 + ['fb2'] * 2 + VALID_FILES_EXT
+# Fixed bounds of the publication dates, so that a seed gives the same books whenever it runs
+PUBLISHED_FROM = datetime.date(1925, 1, 1)
+PUBLISHED_TO = datetime.date(2024, 12, 31)
+
+
+def _popular(rng, first, end):
+    # Skewed towards the first rows: a few authors and tags have most of the books.
+    return first + int((end - first) * rng.random() ** 3)
+
+
+def _book_chunk(task):
+    """
+    Generates the rows of ``count`` books with primary keys from ``first_book``
+    on. Every chunk is seeded with its ``offset`` in the run, so the output
+    depends neither on the number of processes nor on the rows already there.
+    """
+    seed, first_book, offset, count, ranges = task
+    rng = random.Random(seed * 1000003 + offset)
+    faker = Faker()
+    faker.seed_instance(seed * 1000003 + offset)
+
+    rows = {'books': [], 'authors': [], 'tags': [], 'shelves': [], 'comments': [], 'files': []}
+    for pk in range(first_book, first_book + count):
+        rows['books'].append({
+            'pk': pk,
+            'uuid': uuid.UUID(int=rng.getrandbits(128), version=4),
+            'title': faker.sentence(nb_words=rng.randint(1, 6))[:-1][:128],
+            'description': faker.paragraph(nb_sentences=rng.randint(1, 8)),
+            'isbn': faker.isbn13(separator=''),
+            'published_at': faker.date_between_dates(date_start=PUBLISHED_FROM, date_end=PUBLISHED_TO),
+            'series_id': _popular(rng, *ranges['series']) if rng.random() < 0.3 else None,
+            'publisher_id': rng.randrange(*ranges['publishers']) if rng.random() < 0.9 else None,
+        })
+        for author_id in {_popular(rng, *ranges['authors']) for _ in range(rng.choice(AUTHORS_PER_BOOK))}:
+            rows['authors'].append((pk, author_id))
+        for tag_id in {_popular(rng, *ranges['tags']) for _ in range(rng.randint(1, 5))}:
+            rows['tags'].append((pk, tag_id))
+        if rng.random() < 0.1:
+            rows['shelves'].append((pk, rng.randrange(*ranges['shelves'])))
+        for _ in range(int(rng.expovariate(0.5))):
+            rows['comments'].append((pk, rng.randrange(*ranges['users']), faker.paragraph(nb_sentences=2)))
+        for extension in {rng.choice(FILE_EXTENSIONS) for _ in range(rng.randint(1, 3))}:
+            rows['files'].append((pk, rng.randrange(*ranges['users']), extension,
+                                  int(rng.lognormvariate(14, 1.2)), uuid.UUID(int=rng.getrandbits(128), version=4)))
+    return rows
 
 
 class Command(BaseCommand):
     help = 'Generating the fake data'
 
-    def _generate(self, multiplier):
-        pass
-
     def add_arguments(self, parser):
         parser.add_argument('multiplier', nargs='+', type=int)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--workers', type=int, default=1, help='Processes generating the books')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Books per chunk and transaction')
+
+    def _create(self, model, count, factory):
+        first = (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+        rows = [model(pk=pk, **factory()) for pk in range(first, first + count)]
+        if issubclass(model, TaxonomyModel):
+            for row in rows:
+                row.update_letter()
+        model.objects.bulk_create(rows, batch_size=5000)
+        return first, count
+
+    def _generate(self, multiplier, seed, workers, batch_size):
+        faker = Faker()
+        faker.seed_instance(seed)
+        rng = random.Random(seed)
+        with transaction.atomic():
+            ranges = {
+                'users': self._create(User, USERS * multiplier, lambda: {
+                    'username': '{}_{}'.format(faker.user_name(), rng.getrandbits(32)), 'password': '!'}),
+                'authors': self._create(Author, AUTHORS * multiplier, lambda: {
+                    'name': faker.name()[:64], 'description': faker.paragraph()}),
+                'tags': self._create(Tag, TAGS * multiplier, lambda: {'name': faker.word()[:32]}),
+                'series': self._create(Series, SERIES * multiplier, lambda: {
+                    'title': faker.sentence(nb_words=3)[:-1][:64], 'description': faker.paragraph()}),
+                'publishers': self._create(Publisher, PUBLISHERS * multiplier, lambda: {
+                    'name': faker.company()[:64]}),
+                'shelves': self._create(Shelf, SHELVES * multiplier, lambda: {
+                    'name': faker.sentence(nb_words=2)[:-1][:64], 'description': faker.sentence(),
+                    'is_public': rng.random() < 0.5}),
+            }
+        ranges = {key: (first, first + count) for key, (first, count) in ranges.items()}
+
+        count = BOOKS * multiplier
+        first_book = (Book.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+        tasks = [(seed, first_book + offset, offset, min(batch_size, count - offset), ranges)
+                 for offset in range(0, count, batch_size)]
+        # Worker processes are forked and must not share the parent's database connection.
+        connections.close_all()
+        with Pool(workers) as pool:
+            for done, rows in enumerate(pool.imap(_book_chunk, tasks), 1):
+                self._insert(rows)
+                self.stdout.write('{}/{} books'.format(min(done * batch_size, count), count))
+
+    @transaction.atomic
+    def _insert(self, rows):
+        Book.objects.bulk_create([Book(**row) for row in rows['books']], batch_size=2000)
+        Book.authors.through.objects.bulk_create(
+            [Book.authors.through(book_id=book_id, author_id=author_id) for book_id, author_id in rows['authors']],
+            batch_size=5000)
+        Book.tags.through.objects.bulk_create(
+            [Book.tags.through(book_id=book_id, tag_id=tag_id) for book_id, tag_id in rows['tags']], batch_size=5000)
+        Book.shelves.through.objects.bulk_create(
+            [Book.shelves.through(book_id=book_id, shelf_id=shelf_id) for book_id, shelf_id in rows['shelves']],
+            batch_size=5000)
+        Comments.objects.bulk_create(
+            [Comments(book_id=book_id, user_id=user_id, content=content)
+             for book_id, user_id, content in rows['comments']],
+            batch_size=2000)
+        File.objects.bulk_create(
+            [File(book_id=book_id, uploader_id=user_id, extension=extension, size=size, uuid=file_uuid)
+             for book_id, user_id, extension, size, file_uuid in rows['files']],
+            batch_size=2000)
 
     def handle(self, *args, **options):
-        for multiplier in options['multiplier']:
-            self._generate(multiplier)
+        if any(multiplier < 1 for multiplier in options['multiplier']):
+            raise CommandError('Multiplier must be positive')
+        defer_index = connection.vendor == 'sqlite'
+        if defer_index:
+            # Per-row trigger maintenance is far slower than one rebuild at the end.
+            with connection.cursor() as cursor:
+                search.drop_index(cursor)
+        try:
+            for number, multiplier in enumerate(options['multiplier']):
+                self._generate(multiplier, options['seed'] + number, options['workers'], options['batch_size'])
+        finally:
+            self.stdout.write('Rebuilding the search indexes')
+            with transaction.atomic():
+                if defer_index:
+                    search.rebuild_index()
+                search.rebuild_vocabulary()
+                search.rebuild_autocomplete()
+            for model in counters.taxonomy():
+                counters.recount(model.objects.all())
+            pagination.invalidate_counts()
 
-            self.stdout.write(self.style.SUCCESS('Successfully generated'))
+        self.stdout.write(self.style.SUCCESS('Successfully generated'))
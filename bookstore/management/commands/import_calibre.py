@@ -0,0 +1,211 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from html import unescape
+import os
+import sqlite3
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.html import strip_tags
+
+from bookstore import counters, covers, extraction, pagination, search, storage
+from bookstore.forms import VALID_FILES_EXT
+from bookstore.models import Book, File, Author, Tag, Series, Publisher, AutocompleteEntry
+
+BOOK_FIELDS = ['title', 'description', 'isbn', 'published_at', 'series', 'publisher']
+
+LINKS = {
+    'authors': ('SELECT l.book, a.name FROM books_authors_link l JOIN authors a ON a.id = l.author '
+                'WHERE l.book IN ({}) ORDER BY l.id'),
+    'tags': 'SELECT l.book, t.name FROM books_tags_link l JOIN tags t ON t.id = l.tag WHERE l.book IN ({})',
+    'series': 'SELECT l.book, s.name FROM books_series_link l JOIN series s ON s.id = l.series WHERE l.book IN ({})',
+    'publisher': ('SELECT l.book, p.name FROM books_publishers_link l JOIN publishers p ON p.id = l.publisher '
+                  'WHERE l.book IN ({})'),
+    'description': 'SELECT book, text FROM comments WHERE book IN ({})',
+    'isbn': "SELECT book, val FROM identifiers WHERE type = 'isbn' AND book IN ({})",
+    'files': 'SELECT book, format, name FROM data WHERE book IN ({})',
+}
+
+
+def _pubdate(value):
+    # Calibre stores an unknown date as the year 101.
+    try:
+        published = datetime.fromisoformat((value or '')[:10]).date()
+    except ValueError:
+        return None
+    return published if published.year > 1000 else None
+
+
+def _store_file(path):
+    try:
+        with open(path, 'rb') as content:
+            return storage.store_blob(content)
+    except OSError:
+        return None
+
+
+def _store_cover(item):
+    """Stores a cover and renders its variants; returns the error of an unreadable one."""
+    book, path = item
+    try:
+        with open(path, 'rb') as content:
+            covers.save_cover(book, content)
+    except OSError as e:
+        covers.delete_cover(book.uuid.hex)
+        return e
+    return None
+
+
+class Command(BaseCommand):
+    help = 'Importing a Calibre library'
+
+    def add_arguments(self, parser):
+        parser.add_argument('library', help='Calibre library directory containing metadata.db')
+        parser.add_argument('--user', help='Uploader of the files (default: the first superuser)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=4, help='Threads copying files and covers')
+
+    def handle(self, *args, **options):
+        self.library = options['library']
+        database = os.path.join(self.library, 'metadata.db')
+        if not os.path.exists(database):
+            raise CommandError('{} does not exist'.format(database))
+        users = User.objects.filter(username=options['user']) if options['user'] else \
+            User.objects.filter(is_superuser=True).order_by('pk')
+        self.user = users.first()
+        if self.user is None:
+            raise CommandError('No uploader: create a superuser or pass --user')
+
+        # Names already resolved to primary keys, shared by all batches.
+        self.names = {Author: {}, Tag: {}, Series: {}, Publisher: {}}
+        self.created = self.updated = self.files = self.covers = 0
+        calibre = sqlite3.connect('file:{}?mode=ro'.format(database), uri=True)
+        total = calibre.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+        last_id = done = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                rows = calibre.execute('SELECT id, uuid, title, pubdate, isbn, path FROM books '
+                                       'WHERE id > ? ORDER BY id LIMIT ?', [last_id, options['batch_size']]).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                self.import_batch(calibre, rows, executor)
+                done += len(rows)
+                self.stdout.write('{}/{} books'.format(done, total))
+        calibre.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            'Successfully imported {} new and {} updated books ({} files, {} covers)'.format(
+                self.created, self.updated, self.files, self.covers)))
+
+    def resolve(self, model, field, names):
+        known = self.names[model]
+        missing = [name for name in dict.fromkeys(names) if name not in known]
+        known.update(extraction.get_or_create_names(model, field, missing))
+        return known
+
+    def read_links(self, calibre, ids):
+        placeholders = ','.join('?' * len(ids))
+        links = {key: {} for key in LINKS}
+        for key, sql in LINKS.items():
+            for book_id, *values in calibre.execute(sql.format(placeholders), ids):
+                links[key].setdefault(book_id, []).append(values[0] if len(values) == 1 else values)
+        return links
+
+    @transaction.atomic
+    def import_batch(self, calibre, rows, executor):
+        links = self.read_links(calibre, [row[0] for row in rows])
+        metadatas = {}
+        for calibre_id, calibre_uuid, title, pubdate, isbn, path in rows:
+            metadatas[calibre_id] = extraction.clean_metadata({
+                'authors': links['authors'].get(calibre_id),
+                'tags': links['tags'].get(calibre_id),
+                'series': (links['series'].get(calibre_id) or [None])[0],
+                'publisher': (links['publisher'].get(calibre_id) or [None])[0],
+            })
+        authors = self.resolve(Author, 'name', [n for m in metadatas.values() for n in m['authors']])
+        tags = self.resolve(Tag, 'name', [n for m in metadatas.values() for n in m['tags']])
+        series = self.resolve(Series, 'title', [n for m in metadatas.values() for n in m['series']])
+        publishers = self.resolve(Publisher, 'name', [n for m in metadatas.values() for n in m['publisher']])
+
+        uuids = {row[0]: uuid.UUID(row[1]) for row in rows}
+        existing = {book.uuid: book for book in Book.objects.filter(uuid__in=uuids.values())}
+        # Updated books may leave authors, tags, series and publishers they counted towards.
+        linked_before = counters.linked([book.pk for book in existing.values()])
+        books, new_books, updated = {}, [], []
+        for calibre_id, calibre_uuid, title, pubdate, isbn, path in rows:
+            metadata = metadatas[calibre_id]
+            book = existing.get(uuids[calibre_id]) or Book(uuid=uuids[calibre_id])
+            book.title = ' '.join((title or '').split())[:128] or Book._meta.get_field('title').default
+            book.description = unescape(strip_tags((links['description'].get(calibre_id) or [''])[0])).strip()
+            book.isbn = ((links['isbn'].get(calibre_id) or [isbn or ''])[0])[:16]
+            book.published_at = _pubdate(pubdate)
+            book.series_id = series[metadata['series'][0]] if metadata['series'] else None
+            book.publisher_id = publishers[metadata['publisher'][0]] if metadata['publisher'] else None
+            book.last_modified = timezone.now()
+            books[calibre_id] = book
+            (updated if book.pk else new_books).append(book)
+        Book.objects.bulk_create_with_pks(new_books)
+        Book.objects.bulk_update(updated, BOOK_FIELDS + ['last_modified'])
+        self.created += len(new_books)
+        self.updated += len(updated)
+
+        # The Calibre links replace the authors and tags of books imported before.
+        book_ids = [book.pk for book in updated]
+        Book.authors.through.objects.filter(book_id__in=book_ids).delete()
+        Book.tags.through.objects.filter(book_id__in=book_ids).delete()
+        Book.authors.through.objects.bulk_create([
+            Book.authors.through(book_id=books[calibre_id].pk, author_id=authors[name])
+            for calibre_id, metadata in metadatas.items() for name in metadata['authors']])
+        Book.tags.through.objects.bulk_create([
+            Book.tags.through(book_id=books[calibre_id].pk, tag_id=tags[name])
+            for calibre_id, metadata in metadatas.items() for name in metadata['tags']])
+
+        AutocompleteEntry.objects.filter(kind='book', object_id__in=book_ids).delete()
+        terms = set()
+        entries = []
+        for book in books.values():
+            terms.update(search.vocabulary(book.title))
+            entries.extend(search.autocomplete_entries('book', book.pk, book.title))
+        search.add_terms(terms)
+        AutocompleteEntry.objects.bulk_create(entries, batch_size=5000)
+
+        self.copy_files(rows, books, links['files'], executor)
+        counters.recount_linked(linked_before, counters.linked([book.pk for book in books.values()]))
+        pagination.invalidate_counts()
+
+    def copy_files(self, rows, books, files, executor):
+        present = set(File.objects.filter(book__in=books.values()).values_list('book_id', 'extension'))
+        copies = []
+        for calibre_id, calibre_uuid, title, pubdate, isbn, path in rows:
+            book = books[calibre_id]
+            for calibre_format, name in files.get(calibre_id, []):
+                extension = calibre_format.lower()
+                if extension in VALID_FILES_EXT and (book.pk, extension) not in present:
+                    copies.append((book, extension, os.path.join(self.library, path, name + '.' + extension)))
+        stored = []
+        for (book, extension, file_path), blob in zip(copies, executor.map(_store_file, [c[2] for c in copies])):
+            if blob is None:
+                self.stderr.write('Missing {}'.format(file_path))
+            else:
+                stored.append(File(book=book, extension=extension, size=blob.size, checksum=blob.checksum,
+                                   uploader=self.user))
+        File.objects.bulk_create(stored)
+        self.files += len(stored)
+
+        cover_books = []
+        for calibre_id, calibre_uuid, title, pubdate, isbn, path in rows:
+            cover = os.path.join(self.library, path, 'cover.jpg')
+            if not books[calibre_id].has_cover and os.path.exists(cover):
+                cover_books.append((books[calibre_id], cover))
+        stored = []
+        for (book, cover), error in zip(cover_books, executor.map(_store_cover, cover_books)):
+            if error is None:
+                stored.append(book.pk)
+            else:
+                self.stderr.write('Broken cover {}: {}'.format(cover, error))
+        Book.objects.filter(pk__in=stored).update(has_cover=True)
+        self.covers += len(stored)
@@ -0,0 +1,160 @@
+from multiprocessing import Pool
+from pathlib import Path
+import os
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+
+from bookstore import counters, extraction, formats, pagination, search, storage
+from bookstore.forms import VALID_FILES_EXT
+from bookstore.models import Book, File, AutocompleteEntry
+
+
+def _walk(root):
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if Path(filename).suffix[1:].lower() in VALID_FILES_EXT:
+                yield os.path.relpath(os.path.join(directory, filename), root)
+
+
+def _ingest(task):
+    root, path = task
+    try:
+        with open(os.path.join(root, path), 'rb') as content:
+            blob = storage.stage_blob(content)
+        extension = formats.detect_book_format(blob.head, Path(path).suffix[1:].lower())
+        if extension is None:
+            storage.discard_blob(blob)
+            return path, None, 'damaged or has a wrong extension'
+        storage.commit_blob(blob)
+    except Exception as e:
+        return path, None, '{}: {}'.format(type(e).__name__, e)
+
+    metadata = {}
+    if extension in extraction.METADATA_FORMATS:
+        try:
+            with open(os.path.join(root, path), 'rb') as content:
+                metadata = extraction.READERS[extension](content)
+        except Exception:
+            pass
+    if not metadata.get('title'):
+        metadata['title'] = Path(path).stem.replace('_', ' ')
+    return path, {'checksum': blob.checksum, 'size': blob.size, 'extension': extension, 'metadata': metadata}, None
+
+
+class Command(BaseCommand):
+    help = 'Importing every book file of a directory tree'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--user', help='Uploader of the files (default: the first superuser)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--checkpoint', help='File listing the ingested paths (default: <directory>/.ingest)')
+        parser.add_argument('--defer-index', action='store_true',
+                            help='Drop the full-text search triggers during the import and rebuild the index after')
+
+    def handle(self, *args, **options):
+        root = options['directory']
+        if not os.path.isdir(root):
+            raise CommandError('{} is not a directory'.format(root))
+        users = User.objects.filter(username=options['user']) if options['user'] else \
+            User.objects.filter(is_superuser=True).order_by('pk')
+        self.user = users.first()
+        if self.user is None:
+            raise CommandError('No uploader: create a superuser or pass --user')
+
+        checkpoint = options['checkpoint'] or os.path.join(root, '.ingest')
+        done = set()
+        if os.path.exists(checkpoint):
+            with open(checkpoint, encoding='utf-8') as file:
+                done = set(file.read().splitlines())
+        paths = [path for path in _walk(root) if path not in done]
+        self.stdout.write('{} files to ingest ({} already done)'.format(len(paths), len(done)))
+
+        defer_index = options['defer_index'] and connection.vendor == 'sqlite'
+        if defer_index:
+            with connection.cursor() as cursor:
+                search.drop_index(cursor)
+        # Worker processes are forked and must not share the parent's database connection.
+        connections.close_all()
+
+        self.created = self.skipped = self.failed = 0
+        started = time.monotonic()
+        try:
+            with Pool(options['workers']) as pool, open(checkpoint, 'a', encoding='utf-8') as log:
+                batch = []
+                results = pool.imap_unordered(_ingest, [(root, path) for path in paths], chunksize=16)
+                for number, (path, info, error) in enumerate(results, 1):
+                    if error:
+                        self.failed += 1
+                        self.stderr.write('{}: {}'.format(path, error))
+                    batch.append((path, info))
+                    if len(batch) >= options['batch_size'] or number == len(paths):
+                        self.write_batch([(path, info) for path, info in batch if info])
+                        # Failed paths stay out of the checkpoint and are retried by the next run.
+                        log.write(''.join(path + '\n' for path, info in batch if info))
+                        log.flush()
+                        batch = []
+                        rate = number / (time.monotonic() - started) * 60
+                        self.stdout.write('{}/{} files ({:.0f} files/min)'.format(number, len(paths), rate))
+        finally:
+            if defer_index:
+                self.stdout.write('Rebuilding the search index')
+                search.rebuild_index()
+
+        queued = extraction.enqueue_covers()
+        self.stdout.write(self.style.SUCCESS(
+            'Successfully ingested {} books ({} duplicates skipped, {} failed, {} cover jobs queued)'.format(
+                self.created, self.skipped, self.failed, queued)))
+
+    @transaction.atomic
+    def write_batch(self, batch):
+        existing = set(File.objects.filter(checksum__in=[info['checksum'] for path, info in batch])
+                       .values_list('checksum', flat=True))
+        files = []
+        for path, info in batch:
+            if info['checksum'] in existing:
+                self.skipped += 1
+                continue
+            existing.add(info['checksum'])
+            files.append(info)
+        if not files:
+            return
+
+        metadatas = [extraction.clean_metadata(info['metadata']) for info in files]
+        authors, tags, series, publishers = extraction.resolve_names(metadatas)
+        books = []
+        for metadata in metadatas:
+            books.append(Book(title=' '.join(metadata['title'].split())[:128],
+                              description=metadata.get('description') or '',
+                              isbn=(metadata.get('isbn') or '')[:16],
+                              published_at=metadata.get('published_at'),
+                              series_id=series[metadata['series'][0]] if metadata['series'] else None,
+                              publisher_id=publishers[metadata['publisher'][0]] if metadata['publisher'] else None))
+        Book.objects.bulk_create_with_pks(books)
+
+        File.objects.bulk_create([File(book=book, extension=info['extension'], size=info['size'],
+                                       checksum=info['checksum'], uploader=self.user)
+                                  for book, info in zip(books, files)])
+        Book.authors.through.objects.bulk_create([
+            Book.authors.through(book_id=book.pk, author_id=authors[name])
+            for book, metadata in zip(books, metadatas) for name in metadata['authors']])
+        Book.tags.through.objects.bulk_create([
+            Book.tags.through(book_id=book.pk, tag_id=tags[name])
+            for book, metadata in zip(books, metadatas) for name in metadata['tags']])
+
+        # bulk_create skips the signals that index new books for suggestions and autocomplete.
+        terms = set()
+        entries = []
+        for book in books:
+            terms.update(search.vocabulary(book.title))
+            entries.extend(search.autocomplete_entries('book', book.pk, book.title))
+        search.add_terms(terms)
+        AutocompleteEntry.objects.bulk_create(entries, batch_size=5000)
+        counters.recount_linked(counters.linked([book.pk for book in books]))
+        pagination.invalidate_counts()
+        self.created += len(books)
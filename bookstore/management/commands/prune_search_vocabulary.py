@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from bookstore import search
+
+
+class Command(BaseCommand):
+    help = 'Deleting the spelling suggestion terms that left the catalog'
+
+    def handle(self, *args, **options):
+        pruned = search.prune_vocabulary()
+        self.stdout.write(self.style.SUCCESS('Successfully pruned {} terms'.format(pruned)))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bookstore import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuilding the full-text search index'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            search.rebuild_index()
+            search.rebuild_vocabulary()
+            search.rebuild_autocomplete()
+
+        self.stdout.write(self.style.SUCCESS('Successfully rebuilt'))
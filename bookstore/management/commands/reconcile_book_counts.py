@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from bookstore import counters, pagination
+
+
+class Command(BaseCommand):
+    help = 'Recounting the books of every author, tag, series and publisher'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help='Rows recounted per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        for model in counters.taxonomy():
+            last = model.objects.aggregate(last=Max('pk'))['last'] or 0
+            fixed = 0
+            for start in range(0, last + 1, batch_size):
+                fixed += counters.recount(model.objects.filter(pk__gte=start, pk__lt=start + batch_size))
+            self.stdout.write('{}: {} fixed'.format(model._meta.verbose_name_plural, fixed))
+        pagination.invalidate_counts()
+        self.stdout.write(self.style.SUCCESS('Successfully reconciled'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from bookstore import statistics
+
+
+class Command(BaseCommand):
+    help = 'Recomputing the catalog statistics snapshot'
+
+    def handle(self, *args, **options):
+        snapshot = statistics.refresh()
+        self.stdout.write(self.style.SUCCESS('Successfully refreshed at {}'.format(snapshot['generated_at'])))
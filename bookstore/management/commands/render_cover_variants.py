@@ -0,0 +1,43 @@
+from functools import partial
+from multiprocessing import Pool
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from bookstore import covers
+from bookstore.models import Book
+
+
+def _render(uuid_hex, force=False):
+    try:
+        return uuid_hex, covers.render_variants(uuid_hex, force=force), None
+    except Exception as e:
+        return uuid_hex, 0, str(e)
+
+
+class Command(BaseCommand):
+    help = 'Rendering the thumbnail variants of existing covers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--force', action='store_true', help='Re-render variants that already exist')
+
+    def handle(self, *args, **options):
+        uuids = [uuid.hex for uuid in Book.objects.filter(has_cover=True).values_list('uuid', flat=True)]
+        # Worker processes are forked and must not share the parent's database connection.
+        connections.close_all()
+
+        written = failed = 0
+        with Pool(options['workers']) as pool:
+            results = pool.imap_unordered(partial(_render, force=options['force']), uuids, chunksize=16)
+            for done, (uuid_hex, count, error) in enumerate(results, 1):
+                written += count
+                if error:
+                    failed += 1
+                    self.stderr.write('{}: {}'.format(uuid_hex, error))
+                if done % 1000 == 0:
+                    self.stdout.write('{}/{} covers'.format(done, len(uuids)))
+
+        self.stdout.write(self.style.SUCCESS(
+            'Successfully rendered {} variants for {} covers ({} failed)'.format(written, len(uuids), failed)))
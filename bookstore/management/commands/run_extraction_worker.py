@@ -0,0 +1,72 @@
+from multiprocessing import Pool
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from bookstore import extraction
+from bookstore.models import ExtractionJob
+
+
+def _extract(task):
+    job_id, kind, name, extension, uuid_hex = task
+    try:
+        if kind == ExtractionJob.METADATA:
+            return job_id, extraction.extract_metadata(name, extension), None
+        return job_id, extraction.extract_cover(name, extension, uuid_hex), None
+    except Exception as e:
+        return job_id, None, '{}: {}'.format(type(e).__name__, e)
+
+
+class Command(BaseCommand):
+    help = 'Extracting metadata and covers of uploaded book files in a pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--batch-size', type=int, default=settings.EXTRACTION_BATCH_SIZE)
+        parser.add_argument('--kind', action='append', choices=[kind for kind, label in ExtractionJob.KIND_CHOICES],
+                            help='Job kinds to run (default: all)')
+        parser.add_argument('--io-limit', type=float, default=0,
+                            help='Maximum average read rate in MB/s (default: unlimited)')
+        parser.add_argument('--once', action='store_true', help='Exit when the queue is empty')
+
+    def handle(self, *args, **options):
+        kinds = options['kind'] or [kind for kind, label in ExtractionJob.KIND_CHOICES]
+        io_limit = options['io_limit'] * 1024 * 1024
+        # Worker processes are forked and must not share the parent's database connection.
+        connections.close_all()
+
+        processed = failed = 0
+        with Pool(options['workers']) as pool:
+            while True:
+                idle = True
+                for kind in kinds:
+                    jobs = extraction.claim_jobs(kind, options['batch_size'])
+                    if not jobs:
+                        continue
+                    idle = False
+
+                    started = time.monotonic()
+                    tasks = [(job.pk, kind, job.file.storage_name, job.file.extension, job.file.book.uuid.hex)
+                             for job in jobs]
+                    results = pool.map(_extract, tasks)
+                    extraction.finish_jobs(kind, jobs, results)
+                    for job_id, result, error in results:
+                        if error:
+                            failed += 1
+                            self.stderr.write('Job {}: {}'.format(job_id, error))
+                    processed += len(jobs)
+                    self.stdout.write('{} jobs processed'.format(processed))
+
+                    if io_limit:
+                        # Throttle to the average rate: the batch may not finish faster than its bytes allow.
+                        elapsed = time.monotonic() - started
+                        time.sleep(max(0, sum(job.file.size for job in jobs) / io_limit - elapsed))
+                if idle:
+                    if options['once']:
+                        break
+                    time.sleep(settings.EXTRACTION_POLL_INTERVAL)
+
+        self.stdout.write(self.style.SUCCESS('Successfully processed {} jobs ({} failed)'.format(processed, failed)))
@@ -0,0 +1,14 @@
+from django.db import migrations
+
+from bookstore.migrations import _search
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0009_remove_book_rating'),
+    ]
+
+    operations = [
+        migrations.RunPython(_search.create_search_index, _search.drop_search_index),
+    ]
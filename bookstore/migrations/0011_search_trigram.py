@@ -0,0 +1,37 @@
+# Generated by Django 3.1.6 on 2026-10-18 16:51
+
+from django.db import migrations, models
+
+from bookstore.migrations import _search
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0010_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTrigram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gram', models.CharField(max_length=3)),
+                ('term', models.CharField(max_length=64)),
+                ('length', models.PositiveSmallIntegerField()),
+            ],
+        ),
+        migrations.AlterModelOptions(
+            name='series',
+            options={'ordering': ['title'], 'verbose_name_plural': 'Series'},
+        ),
+        migrations.AddIndex(
+            model_name='searchtrigram',
+            index=models.Index(fields=['gram', 'length', 'term'], name='bookstore_s_gram_55f287_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchtrigram',
+            unique_together={('gram', 'term')},
+        ),
+        migrations.RunPython(_search.build_vocabulary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.1.6 on 2026-10-18 16:56
+
+from django.db import migrations, models
+
+from bookstore.migrations import _search
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0011_search_trigram'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AutocompleteEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=16)),
+                ('key', models.CharField(max_length=128)),
+                ('position', models.PositiveSmallIntegerField()),
+                ('object_id', models.IntegerField()),
+                ('label', models.CharField(max_length=128)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='autocompleteentry',
+            index=models.Index(fields=['kind', 'key'], name='bookstore_a_kind_e66a03_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='autocompleteentry',
+            index=models.Index(fields=['kind', 'object_id'], name='bookstore_a_kind_2ad532_idx'),
+        ),
+        migrations.RunPython(_search.build_autocomplete, migrations.RunPython.noop),
+    ]
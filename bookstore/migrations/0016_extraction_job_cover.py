@@ -0,0 +1,18 @@
+# Generated by Django 3.1.6 on 2026-10-18 17:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0015_extraction_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='extractionjob',
+            name='kind',
+            field=models.CharField(choices=[('metadata', 'Metadata'), ('cover', 'Cover')], max_length=16),
+        ),
+    ]
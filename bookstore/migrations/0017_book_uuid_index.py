@@ -0,0 +1,17 @@
+# Generated by Django 3.1.6 on 2026-10-18 17:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0016_extraction_job_cover'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['uuid'], name='bookstore_b_uuid_f40a21_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 3.1.6 on 2026-10-18 17:31
+
+from django.db import migrations, models
+
+from bookstore.migrations import _search
+
+COUNT_BOOKS = [
+    'UPDATE bookstore_author SET book_count = '
+    '(SELECT COUNT(*) FROM bookstore_book_authors WHERE author_id = bookstore_author.id)',
+    'UPDATE bookstore_tag SET book_count = '
+    '(SELECT COUNT(*) FROM bookstore_book_tags WHERE tag_id = bookstore_tag.id)',
+    'UPDATE bookstore_series SET book_count = '
+    '(SELECT COUNT(*) FROM bookstore_book WHERE series_id = bookstore_series.id)',
+    'UPDATE bookstore_publisher SET book_count = '
+    '(SELECT COUNT(*) FROM bookstore_book WHERE publisher_id = bookstore_publisher.id)',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0017_book_uuid_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(_search.drop_search_triggers, _search.create_search_triggers),
+        migrations.AddField(
+            model_name='author',
+            name='book_count',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='publisher',
+            name='book_count',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='series',
+            name='book_count',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='book_count',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunSQL(COUNT_BOOKS, migrations.RunSQL.noop),
+        migrations.RunPython(_search.create_search_triggers, _search.drop_search_triggers),
+    ]
@@ -0,0 +1,101 @@
+# Generated by Django 3.1.6 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+from bookstore.migrations import _search
+
+TAXONOMY = {'author': 'name', 'tag': 'name', 'series': 'title', 'publisher': 'name'}
+
+
+def set_letters(apps, schema_editor):
+    for model_name, name_field in TAXONOMY.items():
+        model = apps.get_model('bookstore', model_name)
+        rows = list(model.objects.only('pk', name_field))
+        for row in rows:
+            row.letter = _search.first_letter(getattr(row, name_field))
+        model.objects.bulk_update(rows, ['letter'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0018_book_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(_search.drop_search_triggers, _search.create_search_triggers),
+        migrations.AddField(
+            model_name='author',
+            name='letter',
+            field=models.CharField(default='*', editable=False, max_length=1),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='publisher',
+            name='letter',
+            field=models.CharField(default='*', editable=False, max_length=1),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='series',
+            name='letter',
+            field=models.CharField(default='*', editable=False, max_length=1),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='letter',
+            field=models.CharField(default='*', editable=False, max_length=1),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_letters, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='author',
+            index=models.Index(fields=['name'], name='bookstore_a_name_883099_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='author',
+            index=models.Index(fields=['letter', 'name'], name='bookstore_a_letter_a753cf_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='author',
+            index=models.Index(fields=['letter', 'book_count'], name='bookstore_a_letter_e3f150_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publisher',
+            index=models.Index(fields=['name'], name='bookstore_p_name_b7d26f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publisher',
+            index=models.Index(fields=['letter', 'name'], name='bookstore_p_letter_d908f0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publisher',
+            index=models.Index(fields=['letter', 'book_count'], name='bookstore_p_letter_930b54_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='series',
+            index=models.Index(fields=['title'], name='bookstore_s_title_922791_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='series',
+            index=models.Index(fields=['letter', 'title'], name='bookstore_s_letter_9fa23b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='series',
+            index=models.Index(fields=['letter', 'book_count'], name='bookstore_s_letter_32e708_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['name'], name='bookstore_t_name_9cc025_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['letter', 'name'], name='bookstore_t_letter_9e0165_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['letter', 'book_count'], name='bookstore_t_letter_2e7c14_idx'),
+        ),
+        migrations.RunPython(_search.create_search_triggers, _search.drop_search_triggers),
+    ]
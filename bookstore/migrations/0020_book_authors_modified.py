@@ -0,0 +1,22 @@
+# Generated by Django 3.1.6 on 2026-10-18 18:13
+
+from django.db import migrations, models
+
+from bookstore.migrations import _search
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookstore', '0019_taxonomy_letter'),
+    ]
+
+    operations = [
+        migrations.RunPython(_search.drop_search_triggers, _search.create_search_triggers),
+        migrations.AddField(
+            model_name='book',
+            name='authors_modified',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.RunPython(_search.create_search_triggers, _search.drop_search_triggers),
+    ]
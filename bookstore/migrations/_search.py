@@ -0,0 +1,216 @@
+"""
+Search index helpers shared by the migrations.
+
+They only rely on the schema a migration sees: the FTS tables, their triggers
+and the letter buckets are frozen here as they were when they were added, the
+dropped triggers are read back from ``sqlite_master`` and the vocabulary and
+autocomplete tables are filled through the historical models. Later changes of
+``bookstore.search`` must not change what an old migration does.
+"""
+import re
+import unicodedata
+
+TOKEN_RE = re.compile(r'\w+')
+LATIN_END = '\u0250'
+TOKENIZER = 'unicode61 remove_diacritics 2'
+
+BOOK_DOCUMENT = """
+    SELECT b.id, b.title, b.description,
+        (SELECT group_concat(a.name, ' ') FROM bookstore_author a
+            JOIN bookstore_book_authors ba ON ba.author_id = a.id WHERE ba.book_id = b.id),
+        (SELECT group_concat(t.name, ' ') FROM bookstore_tag t
+            JOIN bookstore_book_tags bt ON bt.tag_id = t.id WHERE bt.book_id = b.id),
+        (SELECT s.title FROM bookstore_series s WHERE s.id = b.series_id),
+        (SELECT p.name FROM bookstore_publisher p WHERE p.id = b.publisher_id)
+    FROM bookstore_book b WHERE {condition}
+"""
+
+# (table, columns) of the FTS5 tables; the book documents are built by BOOK_DOCUMENT
+FTS_INDEXES = [
+    ('bookstore_book', ['title', 'description', 'authors', 'tags', 'series', 'publisher']),
+    ('bookstore_author', ['name', 'description']),
+    ('bookstore_tag', ['name']),
+    ('bookstore_series', ['title', 'description']),
+    ('bookstore_publisher', ['name']),
+]
+
+# Buckets of the letter index of the taxonomy lists
+DIGITS_LETTER = '#'
+OTHER_LETTER = '*'
+ALPHABET = [chr(code) for code in range(ord('А'), ord('Я') + 1)] + [chr(code) for code in range(ord('A'), ord('Z') + 1)]
+
+# (model, field) of the catalog names
+NAME_FIELDS = [
+    ('book', 'title'),
+    ('author', 'name'),
+    ('tag', 'name'),
+    ('series', 'title'),
+    ('publisher', 'name'),
+]
+
+TERM_MIN_LENGTH = 3
+TERM_MAX_LENGTH = 64
+AUTOCOMPLETE_WORDS = 4
+BATCH_SIZE = 5000
+
+# Trigger definitions dropped by drop_search_triggers(), per database alias
+_dropped_triggers = {}
+
+
+def normalize(text):
+    chars = []
+    for char in text.lower():
+        decomposed = unicodedata.normalize('NFD', char)
+        chars.append(decomposed[0] if decomposed[0] < LATIN_END else char)
+    return ''.join(chars)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(normalize(text))
+
+
+def first_letter(text):
+    for char in normalize(text):
+        if char.isdigit():
+            return DIGITS_LETTER
+        if char.isalpha():
+            char = char.upper().replace('Ё', 'Е')
+            return char if char in ALPHABET else OTHER_LETTER
+    return OTHER_LETTER
+
+
+def trigrams(term):
+    padded = '  {} '.format(term)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _reindex_books(condition):
+    return """
+        DELETE FROM bookstore_book_fts WHERE rowid IN (SELECT b.id FROM bookstore_book b WHERE {condition});
+        INSERT INTO bookstore_book_fts(rowid, title, description, authors, tags, series, publisher) {document};
+    """.format(condition=condition, document=BOOK_DOCUMENT.format(condition=condition))
+
+
+def _search_triggers():
+    # Book documents embed the names of related rows, so they are rebuilt whenever
+    # the book, its M2M links or one of the related rows change.
+    triggers = [
+        ('bookstore_book_fts_ai', 'AFTER INSERT ON bookstore_book', _reindex_books('b.id = new.id')),
+        ('bookstore_book_fts_au', 'AFTER UPDATE OF title, description, series_id, publisher_id ON bookstore_book',
+         _reindex_books('b.id = new.id')),
+        ('bookstore_book_fts_ad', 'AFTER DELETE ON bookstore_book',
+         'DELETE FROM bookstore_book_fts WHERE rowid = old.id;'),
+        ('bookstore_book_authors_fts_ai', 'AFTER INSERT ON bookstore_book_authors',
+         _reindex_books('b.id = new.book_id')),
+        ('bookstore_book_authors_fts_ad', 'AFTER DELETE ON bookstore_book_authors',
+         _reindex_books('b.id = old.book_id')),
+        ('bookstore_book_tags_fts_ai', 'AFTER INSERT ON bookstore_book_tags', _reindex_books('b.id = new.book_id')),
+        ('bookstore_book_tags_fts_ad', 'AFTER DELETE ON bookstore_book_tags', _reindex_books('b.id = old.book_id')),
+        ('bookstore_author_book_fts_au', 'AFTER UPDATE OF name ON bookstore_author',
+         _reindex_books('b.id IN (SELECT book_id FROM bookstore_book_authors WHERE author_id = new.id)')),
+        ('bookstore_tag_book_fts_au', 'AFTER UPDATE OF name ON bookstore_tag',
+         _reindex_books('b.id IN (SELECT book_id FROM bookstore_book_tags WHERE tag_id = new.id)')),
+        ('bookstore_series_book_fts_au', 'AFTER UPDATE OF title ON bookstore_series',
+         _reindex_books('b.series_id = new.id')),
+        ('bookstore_publisher_book_fts_au', 'AFTER UPDATE OF name ON bookstore_publisher',
+         _reindex_books('b.publisher_id = new.id')),
+    ]
+    for table, columns in FTS_INDEXES[1:]:
+        name = '{}_fts'.format(table)
+        values = ', '.join('new.{}'.format(column) for column in columns)
+        insert = 'INSERT INTO {}(rowid, {}) VALUES (new.id, {});'.format(name, ', '.join(columns), values)
+        delete = 'DELETE FROM {} WHERE rowid = old.id;'.format(name)
+        triggers += [
+            ('{}_ai'.format(name), 'AFTER INSERT ON {}'.format(table), insert),
+            ('{}_au'.format(name), 'AFTER UPDATE OF {} ON {}'.format(', '.join(columns), table), delete + insert),
+            ('{}_ad'.format(name), 'AFTER DELETE ON {}'.format(table), delete),
+        ]
+    return triggers
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for table, columns in FTS_INDEXES:
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS {}_fts USING fts5({}, tokenize='{}')".format(
+                table, ', '.join(columns), TOKENIZER))
+        for name, event, body in _search_triggers():
+            cursor.execute('CREATE TRIGGER IF NOT EXISTS {} {} BEGIN {} END'.format(name, event, body))
+        cursor.execute('INSERT INTO bookstore_book_fts(rowid, {}) {}'.format(
+            ', '.join(FTS_INDEXES[0][1]), BOOK_DOCUMENT.format(condition='1')))
+        for table, columns in FTS_INDEXES[1:]:
+            cursor.execute('INSERT INTO {table}_fts(rowid, {columns}) SELECT id, {columns} FROM {table}'.format(
+                table=table, columns=', '.join(columns)))
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, event, body in _search_triggers():
+            cursor.execute('DROP TRIGGER IF EXISTS {}'.format(name))
+        for table, columns in FTS_INDEXES:
+            cursor.execute('DROP TABLE IF EXISTS {}_fts'.format(table))
+
+
+# SQLite alters a table by rebuilding it, which fails while the search
+# triggers of other tables refer to it. Operations altering the indexed tables
+# go between these two.
+def drop_search_triggers(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name GLOB '*_fts_a[iud]'")
+        triggers = cursor.fetchall()
+        for name, sql in triggers:
+            cursor.execute('DROP TRIGGER {}'.format(name))
+    _dropped_triggers.setdefault(connection.alias, []).extend(sql for name, sql in triggers)
+
+
+def create_search_triggers(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for sql in _dropped_triggers.pop(connection.alias, []):
+            cursor.execute(sql)
+
+
+def build_vocabulary(apps, schema_editor):
+    SearchTrigram = apps.get_model('bookstore', 'SearchTrigram')
+    db = schema_editor.connection.alias
+    SearchTrigram.objects.using(db).all().delete()
+    for model_name, field in NAME_FIELDS:
+        model = apps.get_model('bookstore', model_name)
+        terms = set()
+        for text in model.objects.using(db).values_list(field, flat=True).iterator():
+            terms.update(token for token in tokenize(text or '') if TERM_MIN_LENGTH <= len(token) <= TERM_MAX_LENGTH)
+        SearchTrigram.objects.using(db).bulk_create(
+            [SearchTrigram(gram=gram, term=term, length=len(term)) for term in terms for gram in trigrams(term)],
+            batch_size=BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+
+
+def build_autocomplete(apps, schema_editor):
+    AutocompleteEntry = apps.get_model('bookstore', 'AutocompleteEntry')
+    db = schema_editor.connection.alias
+    AutocompleteEntry.objects.using(db).all().delete()
+    for kind, field in NAME_FIELDS:
+        model = apps.get_model('bookstore', kind)
+        entries = []
+        for pk, label in model.objects.using(db).values_list('pk', field).iterator():
+            tokens = tokenize(label or '')
+            keys = []
+            for position in range(min(len(tokens), AUTOCOMPLETE_WORDS)):
+                key = ' '.join(tokens[position:])[:128]
+                if key not in keys:
+                    keys.append(key)
+            entries.extend(AutocompleteEntry(kind=kind, key=key, position=position, object_id=pk,
+                                             label=(label or '')[:128])
+                           for position, key in enumerate(keys))
+        AutocompleteEntry.objects.using(db).bulk_create(entries, batch_size=BATCH_SIZE)
@@ -1,15 +1,23 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, connection
 from django.db.models import Q
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils import timezone
+from bookstore import caching, search as search_index
+from bookstore.storage import blob_name
+from pathlib import Path
 import uuid
 
 
 class SearchMixin:
     search_field = None
 
-    def search(self, query=None):
+    def search(self, query=None, fuzzy=False):
         queryset = self.get_queryset()
-        if query:
+        if query and connection.vendor == 'sqlite':
+            queryset = search_index.match(queryset, query, fuzzy=fuzzy)
+        elif query:
             key = "{}__contains".format(self.search_field)
             or_lookup = (Q(**{key: query}))
             queryset = queryset.filter(or_lookup)
@@ -17,9 +25,40 @@ class SearchMixin:
         return queryset
 
 
-class BookManager(SearchMixin, models.Manager):
+class BookQuerySet(models.QuerySet):
+    # Columns read by ``_book_list.html`` (the link, the title, the cover URL and
+    # the cache key of the card) and the default sort key of the book list
+    card_fields = ['id', 'title', 'has_cover', 'uuid', 'last_modified', 'authors_modified', 'created_at']
+
+    def cards(self):
+        """
+        Books for the card grid: only the columns it shows. The authors are read
+        by ``{% book_cards %}`` for the cards missing from the cache.
+        """
+        return self.only(*self.card_fields)
+
+    def touch_authors(self):
+        """
+        Renews the cached cards and pages of the books after a change of their
+        authors. ``last_modified`` and with it the cover version stay.
+        """
+        pks = list(self.values_list('pk', flat=True))
+        self.update(authors_modified=timezone.now())
+        caching.invalidate(*[caching.model_tag(self.model, pk) for pk in pks])
+
+
+class BookManager(SearchMixin, models.Manager.from_queryset(BookQuerySet)):
     search_field = "title"
 
+    def bulk_create_with_pks(self, books, batch_size=None):
+        """``bulk_create()`` that also sets the ids on backends which do not return them."""
+        self.bulk_create(books, batch_size=batch_size)
+        if books and books[0].pk is None:
+            pks = dict(self.filter(uuid__in=[book.uuid for book in books]).values_list('uuid', 'pk'))
+            for book in books:
+                book.pk = pks[book.uuid]
+        return books
+
 
 class AuthorManager(SearchMixin, models.Manager):
     search_field = "name"
@@ -37,7 +76,36 @@ class PublisherManager(SearchMixin, models.Manager):
     search_field = "name"
 
 
-class Publisher(models.Model):
+class TaxonomyModel(models.Model):
+    """
+    Abstract base of authors, tags, series and publishers: the number of their
+    books (see ``bookstore.counters``) and the letter they are listed under.
+    """
+    name_field = 'name'
+
+    book_count = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+    letter = models.CharField(max_length=1, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def update_letter(self):
+        """Must be called before ``bulk_create()``, which skips ``save()``."""
+        self.letter = search_index.first_letter(getattr(self, self.name_field))
+
+    def save(self, *args, **kwargs):
+        self.update_letter()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and self.name_field in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['letter']
+        # The counter is kept in the database; a stale copy in memory must not overwrite it.
+        if not self._state.adding and update_fields is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name != 'book_count']
+        super().save(*args, **kwargs)
+
+
+class Publisher(TaxonomyModel):
     objects = PublisherManager()
 
     name = models.CharField(max_length=64)
@@ -48,17 +116,23 @@ class Publisher(models.Model):
 
     class Meta:
         ordering = ['name']
+        indexes = [models.Index(fields=['name']), models.Index(fields=['letter', 'name']),
+                   models.Index(fields=['letter', 'book_count'])]
 
 
-class Series(models.Model):
+class Series(TaxonomyModel):
     objects = SeriesManager()
 
+    name_field = 'title'
+
     title = models.CharField(max_length=64)
     description = models.TextField()
 
     class Meta:
         ordering = ['title']
         verbose_name_plural = 'Series'
+        indexes = [models.Index(fields=['title']), models.Index(fields=['letter', 'title']),
+                   models.Index(fields=['letter', 'book_count'])]
 
     def __str__(self):
         return self.title
@@ -73,7 +147,7 @@ class Shelf(models.Model):
         return self.name
 
 
-class Author(models.Model):
+class Author(TaxonomyModel):
     objects = AuthorManager()
 
     name = models.CharField(max_length=64)
@@ -85,9 +159,11 @@ class Author(models.Model):
 
     class Meta:
         ordering = ['name']
+        indexes = [models.Index(fields=['name']), models.Index(fields=['letter', 'name']),
+                   models.Index(fields=['letter', 'book_count'])]
 
 
-class Tag(models.Model):
+class Tag(TaxonomyModel):
     objects = TagManager()
 
     name = models.CharField(max_length=32)
@@ -97,6 +173,8 @@ class Tag(models.Model):
 
     class Meta:
         ordering = ['name']
+        indexes = [models.Index(fields=['name']), models.Index(fields=['letter', 'name']),
+                   models.Index(fields=['letter', 'book_count'])]
 
 
 class Book(models.Model):
@@ -106,6 +184,8 @@ class Book(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     published_at = models.DateField(null=True)
     last_modified = models.DateTimeField(auto_now=True)
+    # Changes of its authors, which the cover version leaves out
+    authors_modified = models.DateTimeField(null=True, editable=False)
     uuid = models.UUIDField(default=uuid.uuid4, editable=False)
     has_cover = models.BooleanField(default=False)
     description = models.TextField()
@@ -121,10 +201,25 @@ class Book(models.Model):
 
     class Meta:
         ordering = ['-pk']
+        indexes = [models.Index(fields=['uuid'])]
 
     def get_authors(self):
         return self.authors.all()
 
+    @property
+    def cover_version(self):
+        return '{}-{:x}'.format(self.uuid.hex, int(self.last_modified.timestamp() * 1000000))
+
+    def get_cover_url(self, size=None, image_format=None):
+        if not self.has_cover:
+            return static('img/default-cover.jpg')
+        url = '{}?v={}'.format(reverse('book-cover', kwargs={'pk': self.pk}), self.cover_version)
+        if size:
+            url += '&size={}'.format(size)
+        if image_format:
+            url += '&format={}'.format(image_format)
+        return url
+
     def __str__(self):
         return self.title
 
@@ -141,9 +236,107 @@ class File(models.Model):
     uuid = models.UUIDField(default=uuid.uuid4)
     extension = models.CharField(max_length=8)
     size = models.IntegerField()
+    checksum = models.CharField(max_length=64, blank=True, db_index=True)
 
     book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='files')
     uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='files')
 
+    @property
+    def storage_name(self):
+        if self.checksum:
+            return blob_name(self.checksum)
+        return 'books/' + self.uuid.hex
+
+    def __str__(self):
+        return self.uuid.hex
+
+
+class ExtractionJob(models.Model):
+    METADATA = 'metadata'
+    COVER = 'cover'
+    KIND_CHOICES = [
+        (METADATA, 'Metadata'),
+        (COVER, 'Cover'),
+    ]
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_modified = models.DateTimeField(auto_now=True)
+
+    file = models.ForeignKey(File, on_delete=models.CASCADE, related_name='jobs')
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'kind'])]
+
+    def __str__(self):
+        return '{} {}'.format(self.kind, self.file_id)
+
+
+class UploadSession(models.Model):
+    uuid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_modified = models.DateTimeField(auto_now=True)
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, null=True, blank=True, related_name='upload_sessions')
+    file = models.ForeignKey(File, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+
+    @property
+    def extension(self):
+        return Path(self.filename).suffix[1:].lower()
+
+    @property
+    def storage_name(self):
+        return 'uploads/' + self.uuid.hex
+
+    @property
+    def is_complete(self):
+        return self.offset == self.size
+
+    def __str__(self):
+        return self.filename
+
+
+class SearchTrigram(models.Model):
+    gram = models.CharField(max_length=3)
+    term = models.CharField(max_length=64)
+    length = models.PositiveSmallIntegerField()
+
+    class Meta:
+        unique_together = [['gram', 'term']]
+        indexes = [models.Index(fields=['gram', 'length', 'term'])]
+
+    def __str__(self):
+        return '{} ({})'.format(self.gram, self.term)
+
+
+class AutocompleteEntry(models.Model):
+    kind = models.CharField(max_length=16)
+    key = models.CharField(max_length=128)
+    position = models.PositiveSmallIntegerField()
+    object_id = models.IntegerField()
+    label = models.CharField(max_length=128)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'key']),
+            models.Index(fields=['kind', 'object_id']),
+        ]
+
     def __str__(self):
-        return self.uuid
+        return self.key
@@ -0,0 +1,234 @@
+"""
+Keyset pagination for the book lists.
+
+The first ``PAGINATION_PAGE_LINKS`` pages are numbered as usual. Further pages
+are reached through ``next``/``previous`` links carrying a cursor with the sort
+key of the last (first) book shown, so a deep page costs as much as the first.
+"""
+from collections.abc import Sequence
+import base64
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import Paginator
+from django.db.models import Q, Max
+from django.http import Http404
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination
+
+from bookstore import caching, search
+
+
+def invalidate_counts(*tables):
+    """
+    Forgets the cached counts of querysets reading ``tables``. Without
+    arguments (after bulk writes, which send no signals) it forgets every
+    cached count and page, see ``bookstore.caching``.
+    """
+    caching.invalidate(*['table:' + table for table in tables])
+
+
+def _count_key(queryset):
+    query = queryset.order_by().values_list('pk').query
+    sql, params = query.sql_with_params()
+    # Search querysets join their FTS table with extra(), and its documents follow other tables.
+    tables = search.index_tables([alias.table_name for alias in query.alias_map.values()] + list(query.extra_tables))
+    versions = caching.versions('table:' + table for table in tables)
+    signature = repr((sql, params, sorted(versions.items())))
+    return 'count:' + hashlib.md5(signature.encode()).hexdigest()
+
+
+def estimate_count(queryset):
+    """
+    Upper bound of the rows of an unfiltered queryset, read from the end of the
+    primary key index. None when the queryset is filtered.
+    """
+    query = queryset.query
+    if query.where or query.distinct or query.combinator:
+        return None
+    return queryset.model._base_manager.aggregate(last=Max('pk'))['last'] or 0
+
+
+def cached_count(queryset):
+    """
+    Returns ``(count, is_estimate)`` of ``queryset``. Counts are cached until
+    a table the queryset reads is written to; unfiltered querysets of more than
+    ``COUNT_ESTIMATE_THRESHOLD`` rows are estimated instead of counted.
+    """
+    try:
+        key = _count_key(queryset)
+    except EmptyResultSet:
+        return 0, False
+    result = cache.get(key)
+    if result is None:
+        estimate = estimate_count(queryset)
+        if estimate is not None and estimate > settings.COUNT_ESTIMATE_THRESHOLD:
+            result = estimate, True
+        else:
+            result = queryset.count(), False
+        cache.set(key, result, settings.COUNT_CACHE_TIMEOUT)
+    return result
+
+
+class CachedCountPaginator(Paginator):
+    """``Paginator`` whose count comes from ``cached_count()``."""
+    is_estimate = False
+
+    @cached_property
+    def count(self):
+        if isinstance(self.object_list, list):
+            return len(self.object_list)
+        count, self.is_estimate = cached_count(self.object_list)
+        return count
+
+
+def encode_cursor(values, reverse=False):
+    data = json.dumps({'v': values, 'r': reverse}, default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    """Returns ``(values, reverse)``; ``values`` is None for the end of the list."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        values, reverse = data['v'], bool(data['r'])
+    except (ValueError, KeyError, TypeError):
+        raise Http404('Invalid cursor')
+    if values is not None and (not isinstance(values, list) or len(values) != length):
+        raise Http404('Invalid cursor')
+    return values, reverse
+
+
+def reverse_ordering(ordering):
+    return [field[1:] if field.startswith('-') else '-' + field for field in ordering]
+
+
+def after(ordering, values):
+    """Condition selecting the rows that follow ``values`` in ``ordering``."""
+    condition = Q()
+    for number, field in enumerate(ordering):
+        equal = {name.lstrip('-'): value for name, value in zip(ordering[:number], values[:number])}
+        lookup = '{}__{}'.format(field.lstrip('-'), 'lt' if field.startswith('-') else 'gt')
+        condition |= Q(**equal, **{lookup: values[number]})
+    return condition
+
+
+def _url(request, **params):
+    query = request.GET.copy()
+    query.pop('page', None)
+    query.pop('cursor', None)
+    for key, value in params.items():
+        query[key] = value
+    return '?' + query.urlencode() if query else '?'
+
+
+def _key(ordering, obj):
+    return [getattr(obj, field.lstrip('-')) for field in ordering]
+
+
+class KeysetPage(Sequence):
+    """A page reached by cursor: it knows its neighbours but not its number."""
+    number = None
+
+    def __init__(self, object_list, has_previous, has_next):
+        self.object_list = object_list
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    def has_other_pages(self):
+        return self._has_previous or self._has_next
+
+
+class DeepPage(Exception):
+    """
+    Raised by ``paginate()`` for a ``?page=`` beyond the numbered pages, which
+    are only reached by cursor. ``url`` is the first page of the list.
+    """
+
+    def __init__(self, url):
+        super().__init__(url)
+        self.url = url
+
+
+def paginate(request, queryset, ordering, per_page=None):
+    """
+    Returns the page of ``queryset`` asked for by ``?page=`` or ``?cursor=``.
+    ``ordering`` must end with a unique field. Besides the usual ``Page``
+    interface the page has ``page_links`` (``(number, url)`` of the numbered
+    pages) and ``first_url``, ``previous_url``, ``next_url`` and ``last_url``.
+    Raises ``DeepPage`` for a page number past ``PAGINATION_PAGE_LINKS``.
+    """
+    per_page = per_page or settings.ITEMS_PER_PAGE
+    queryset = queryset.order_by(*ordering)
+    cursor = request.GET.get('cursor')
+
+    if cursor:
+        values, reverse = decode_cursor(cursor, len(ordering))
+        if reverse:
+            rows = queryset.order_by(*reverse_ordering(ordering))
+        else:
+            rows = queryset
+        if values is not None:
+            rows = rows.filter(after(reverse_ordering(ordering) if reverse else ordering, values))
+        object_list = list(rows[:per_page + 1])
+        has_more = len(object_list) > per_page
+        object_list = object_list[:per_page]
+        if reverse:
+            object_list.reverse()
+            page = KeysetPage(object_list, has_more, values is not None)
+        else:
+            page = KeysetPage(object_list, True, has_more)
+        page.page_links = [(number, _url(request, page=number))
+                           for number in range(1, settings.PAGINATION_PAGE_LINKS + 1)]
+        page.last_url = _url(request, cursor=encode_cursor(None, reverse=True))
+    else:
+        paginator = CachedCountPaginator(queryset, per_page)
+        try:
+            number = int(request.GET.get('page', 1))
+        except ValueError:
+            number = 1
+        if number > settings.PAGINATION_PAGE_LINKS:
+            raise DeepPage((request.path + _url(request)).rstrip('?'))
+        page = paginator.get_page(number)
+        page.page_links = [(number, _url(request, page=number))
+                           for number in range(1, min(paginator.num_pages, settings.PAGINATION_PAGE_LINKS) + 1)]
+        if paginator.num_pages > settings.PAGINATION_PAGE_LINKS:
+            page.last_url = _url(request, cursor=encode_cursor(None, reverse=True))
+        else:
+            page.last_url = _url(request, page=paginator.num_pages)
+
+    page.first_url = _url(request)
+    page.previous_url = page.next_url = None
+    if page.has_previous():
+        if page.number:
+            page.previous_url = _url(request, page=page.number - 1)
+        elif not page:
+            page.previous_url = page.first_url
+        else:
+            page.previous_url = _url(request, cursor=encode_cursor(_key(ordering, page[0]), reverse=True))
+    if page.has_next():
+        if page.number and page.number < settings.PAGINATION_PAGE_LINKS:
+            page.next_url = _url(request, page=page.number + 1)
+        else:
+            page.next_url = _url(request, cursor=encode_cursor(_key(ordering, page[-1])))
+    return page
+
+
+class BookCursorPagination(CursorPagination):
+    """``/api/books/`` pages by cursor, so every page costs the same."""
+    ordering = ['-created_at', '-pk']
@@ -0,0 +1,510 @@
+"""
+Full-text search over the catalog backed by SQLite FTS5.
+
+Every searchable model gets an external FTS5 table named ``<db_table>_fts`` whose
+rowid is the primary key of the indexed row. The tables are kept in sync by SQL
+triggers, so bulk inserts and raw updates are indexed the same way as ``save()``.
+
+Search-as-you-type is served from ``AutocompleteEntry``, a prefix index of
+normalized titles and names queried with index range scans.
+
+Typo tolerance is provided by a trigram index over the catalog vocabulary
+(``SearchTrigram``). Misspelled query tokens are matched against it to build
+"did you mean" suggestions and fuzzy FTS expressions.
+"""
+import collections
+import itertools
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db import connection
+
+TOKEN_RE = re.compile(r'\w+')
+
+TOKENIZER = 'unicode61 remove_diacritics 2'
+
+LATIN_END = '\u0250'
+
+BOOK_DOCUMENT = """
+    SELECT b.id, b.title, b.description,
+        (SELECT group_concat(a.name, ' ') FROM bookstore_author a
+            JOIN bookstore_book_authors ba ON ba.author_id = a.id WHERE ba.book_id = b.id),
+        (SELECT group_concat(t.name, ' ') FROM bookstore_tag t
+            JOIN bookstore_book_tags bt ON bt.tag_id = t.id WHERE bt.book_id = b.id),
+        (SELECT s.title FROM bookstore_series s WHERE s.id = b.series_id),
+        (SELECT p.name FROM bookstore_publisher p WHERE p.id = b.publisher_id)
+    FROM bookstore_book b WHERE {condition}
+"""
+
+
+def _reindex_books(condition):
+    return """
+        DELETE FROM bookstore_book_fts WHERE rowid IN (SELECT b.id FROM bookstore_book b WHERE {condition});
+        INSERT INTO bookstore_book_fts(rowid, title, description, authors, tags, series, publisher) {document};
+    """.format(condition=condition, document=BOOK_DOCUMENT.format(condition=condition))
+
+
+class SearchIndex:
+    def __init__(self, table, columns, weights, source=None, source_tables=()):
+        self.table = table
+        self.columns = columns
+        self.weights = weights
+        self.source = source
+        # Tables whose writes change the indexed documents
+        self.source_tables = [table, *source_tables]
+
+    @property
+    def name(self):
+        return '{}_fts'.format(self.table)
+
+    def create_sql(self):
+        return "CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING fts5({columns}, tokenize='{tokenizer}')".format(
+            name=self.name, columns=', '.join(self.columns), tokenizer=TOKENIZER)
+
+    def populate_sql(self):
+        if self.source:
+            return 'INSERT INTO {name}(rowid, {columns}) {source}'.format(
+                name=self.name, columns=', '.join(self.columns), source=self.source.format(condition='1'))
+        return 'INSERT INTO {name}(rowid, {columns}) SELECT id, {columns} FROM {table}'.format(
+            name=self.name, columns=', '.join(self.columns), table=self.table)
+
+    def triggers(self):
+        if self.source:
+            return []
+        columns = ', '.join(self.columns)
+        values = ', '.join('new.{}'.format(column) for column in self.columns)
+        insert = 'INSERT INTO {}(rowid, {}) VALUES (new.id, {});'.format(self.name, columns, values)
+        delete = 'DELETE FROM {} WHERE rowid = old.id;'.format(self.name)
+        return [
+            ('{}_ai'.format(self.name), 'AFTER INSERT ON {}'.format(self.table), insert),
+            ('{}_au'.format(self.name), 'AFTER UPDATE OF {} ON {}'.format(columns, self.table), delete + insert),
+            ('{}_ad'.format(self.name), 'AFTER DELETE ON {}'.format(self.table), delete),
+        ]
+
+    def rank_sql(self):
+        return 'bm25({}, {})'.format(self.name, ', '.join(str(w) for w in self.weights))
+
+
+INDEXES = {
+    'bookstore_book': SearchIndex('bookstore_book',
+                                  ['title', 'description', 'authors', 'tags', 'series', 'publisher'],
+                                  [10.0, 1.0, 5.0, 3.0, 3.0, 2.0],
+                                  source=BOOK_DOCUMENT,
+                                  source_tables=['bookstore_book_authors', 'bookstore_author', 'bookstore_book_tags',
+                                                 'bookstore_tag', 'bookstore_series', 'bookstore_publisher']),
+    'bookstore_author': SearchIndex('bookstore_author', ['name', 'description'], [10.0, 1.0]),
+    'bookstore_tag': SearchIndex('bookstore_tag', ['name'], [1.0]),
+    'bookstore_series': SearchIndex('bookstore_series', ['title', 'description'], [10.0, 1.0]),
+    'bookstore_publisher': SearchIndex('bookstore_publisher', ['name'], [1.0]),
+}
+
+# Book documents embed the names of related rows, so they are rebuilt whenever
+# the book, its M2M links or one of the related rows change.
+BOOK_TRIGGERS = [
+    ('bookstore_book_fts_ai', 'AFTER INSERT ON bookstore_book', _reindex_books('b.id = new.id')),
+    ('bookstore_book_fts_au', 'AFTER UPDATE OF title, description, series_id, publisher_id ON bookstore_book',
+     _reindex_books('b.id = new.id')),
+    ('bookstore_book_fts_ad', 'AFTER DELETE ON bookstore_book',
+     'DELETE FROM bookstore_book_fts WHERE rowid = old.id;'),
+    ('bookstore_book_authors_fts_ai', 'AFTER INSERT ON bookstore_book_authors', _reindex_books('b.id = new.book_id')),
+    ('bookstore_book_authors_fts_ad', 'AFTER DELETE ON bookstore_book_authors', _reindex_books('b.id = old.book_id')),
+    ('bookstore_book_tags_fts_ai', 'AFTER INSERT ON bookstore_book_tags', _reindex_books('b.id = new.book_id')),
+    ('bookstore_book_tags_fts_ad', 'AFTER DELETE ON bookstore_book_tags', _reindex_books('b.id = old.book_id')),
+    ('bookstore_author_book_fts_au', 'AFTER UPDATE OF name ON bookstore_author',
+     _reindex_books('b.id IN (SELECT book_id FROM bookstore_book_authors WHERE author_id = new.id)')),
+    ('bookstore_tag_book_fts_au', 'AFTER UPDATE OF name ON bookstore_tag',
+     _reindex_books('b.id IN (SELECT book_id FROM bookstore_book_tags WHERE tag_id = new.id)')),
+    ('bookstore_series_book_fts_au', 'AFTER UPDATE OF title ON bookstore_series',
+     _reindex_books('b.series_id = new.id')),
+    ('bookstore_publisher_book_fts_au', 'AFTER UPDATE OF name ON bookstore_publisher',
+     _reindex_books('b.publisher_id = new.id')),
+]
+
+
+def _triggers():
+    triggers = list(BOOK_TRIGGERS)
+    for index in INDEXES.values():
+        triggers.extend(index.triggers())
+    return triggers
+
+
+def index_tables(tables):
+    """``tables`` and, for the FTS tables among them, the tables their documents are built from."""
+    by_name = {index.name: index for index in INDEXES.values()}
+    return set(tables).union(*(by_name[table].source_tables for table in tables if table in by_name))
+
+
+def create_index(cursor):
+    for index in INDEXES.values():
+        cursor.execute(index.create_sql())
+    for name, event, body in _triggers():
+        cursor.execute('CREATE TRIGGER IF NOT EXISTS {} {} BEGIN {} END'.format(name, event, body))
+
+
+def drop_triggers(cursor):
+    for name, event, body in _triggers():
+        cursor.execute('DROP TRIGGER IF EXISTS {}'.format(name))
+
+
+def drop_index(cursor):
+    drop_triggers(cursor)
+    for index in INDEXES.values():
+        cursor.execute('DROP TABLE IF EXISTS {}'.format(index.name))
+
+
+def rebuild_index():
+    with connection.cursor() as cursor:
+        create_index(cursor)
+        for index in INDEXES.values():
+            cursor.execute('DELETE FROM {}'.format(index.name))
+            cursor.execute(index.populate_sql())
+            cursor.execute("INSERT INTO {name}({name}) VALUES ('optimize')".format(name=index.name))
+
+
+def normalize(text):
+    # Mirrors the unicode61 tokenizer: lower case, diacritics stripped from Latin letters only.
+    chars = []
+    for char in text.lower():
+        decomposed = unicodedata.normalize('NFD', char)
+        chars.append(decomposed[0] if decomposed[0] < LATIN_END else char)
+    return ''.join(chars)
+
+
+# Buckets of the letter index of the taxonomy lists
+DIGITS_LETTER = '#'
+OTHER_LETTER = '*'
+ALPHABET = [chr(code) for code in range(ord('А'), ord('Я') + 1)] + [chr(code) for code in range(ord('A'), ord('Z') + 1)]
+LETTERS = ALPHABET + [DIGITS_LETTER, OTHER_LETTER]
+
+
+def first_letter(text):
+    """Letter index bucket of a name: its first letter, ``#`` for a digit, ``*`` for anything else."""
+    for char in normalize(text):
+        if char.isdigit():
+            return DIGITS_LETTER
+        if char.isalpha():
+            char = char.upper().replace('Ё', 'Е')
+            return char if char in ALPHABET else OTHER_LETTER
+    return OTHER_LETTER
+
+
+def tokenize(query):
+    return TOKEN_RE.findall(normalize(query))
+
+
+def match_expression(query):
+    # Every token is matched as a prefix and all of them must be present.
+    return ' '.join('"{}"*'.format(token) for token in tokenize(query))
+
+
+def fuzzy_match_expression(query):
+    groups = []
+    for token in tokenize(query):
+        candidates = [token]
+        if len(token) >= TERM_MIN_LENGTH:
+            candidates += [term for term, similarity in similar_terms(token) if term != token]
+        groups.append('({})'.format(' OR '.join('"{}"'.format(term) for term in candidates)))
+    return ' AND '.join(groups)
+
+
+def match(queryset, query, fuzzy=False):
+    index = INDEXES[queryset.model._meta.db_table]
+    expression = fuzzy_match_expression(query) if fuzzy else match_expression(query)
+    if not expression:
+        return queryset.none()
+    return queryset.extra(
+        select={'search_rank': index.rank_sql()},
+        tables=[index.name],
+        where=['{} MATCH %s'.format(index.name), '{}.rowid = {}.id'.format(index.name, index.table)],
+        params=[expression],
+    ).order_by('search_rank', '-pk')
+
+
+VOCABULARY_FIELDS = [
+    ('bookstore_book', 'title'),
+    ('bookstore_author', 'name'),
+    ('bookstore_tag', 'name'),
+    ('bookstore_series', 'title'),
+    ('bookstore_publisher', 'name'),
+]
+
+TERM_MIN_LENGTH = 3
+TERM_MAX_LENGTH = 64
+
+
+def trigrams(term):
+    padded = '  {} '.format(term)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def vocabulary(text):
+    return {token for token in tokenize(text) if TERM_MIN_LENGTH <= len(token) <= TERM_MAX_LENGTH}
+
+
+def add_terms(terms):
+    from bookstore.models import SearchTrigram
+
+    SearchTrigram.objects.bulk_create(
+        [SearchTrigram(gram=gram, term=term, length=len(term)) for term in terms for gram in trigrams(term)],
+        batch_size=5000,
+        ignore_conflicts=True,
+    )
+
+
+def _catalog_terms(batch_size):
+    """Yields the terms of the catalog names, one set per batch of rows."""
+    with connection.cursor() as cursor:
+        for table, field in VOCABULARY_FIELDS:
+            cursor.execute('SELECT {} FROM {}'.format(field, table))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                terms = set()
+                for (text,) in rows:
+                    terms |= vocabulary(text or '')
+                yield terms
+
+
+def rebuild_vocabulary(batch_size=10000):
+    from bookstore.models import SearchTrigram
+
+    SearchTrigram.objects.all().delete()
+    for terms in _catalog_terms(batch_size):
+        add_terms(terms)
+
+
+def prune_vocabulary(batch_size=10000):
+    """
+    Deletes the terms no catalog name contains any more and returns their
+    number. Saves only add terms, so renamed and deleted names leave theirs.
+    """
+    from bookstore.models import SearchTrigram
+
+    current = set()
+    for terms in _catalog_terms(batch_size):
+        current |= terms
+    stale = sorted(set(SearchTrigram.objects.values_list('term', flat=True).distinct()) - current)
+    # Chunks stay below the SQLite limit of query parameters.
+    for start in range(0, len(stale), 500):
+        SearchTrigram.objects.filter(term__in=stale[start:start + 500]).delete()
+    return len(stale)
+
+
+def similar_terms(token, limit=None):
+    """Catalog terms sharing the most trigrams with ``token``, best first."""
+    limit = limit or settings.SEARCH_SUGGESTIONS
+    grams = trigrams(token)
+    delta = max(2, len(token) // 3)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT term, COUNT(*) AS shared FROM bookstore_searchtrigram '
+            'WHERE gram IN ({}) AND length BETWEEN %s AND %s '
+            'GROUP BY term ORDER BY shared DESC LIMIT %s'.format(', '.join(['%s'] * len(grams))),
+            [*grams, len(token) - delta, len(token) + delta, limit * 4],
+        )
+        rows = cursor.fetchall()
+    ranked = []
+    for term, shared in rows:
+        similarity = shared / (len(grams) + len(trigrams(term)) - shared)
+        if similarity >= settings.SEARCH_SIMILARITY_THRESHOLD:
+            ranked.append((term, similarity))
+    ranked.sort(key=lambda item: (-item[1], item[0]))
+    return ranked[:limit]
+
+
+def suggest(query, limit=None):
+    """Spelling suggestions for ``query`` built from the catalog vocabulary."""
+    limit = limit or settings.SEARCH_SUGGESTIONS
+    tokens = tokenize(query)
+    # Alternatives are only combined for short queries to keep the product small.
+    width = 3 if len(tokens) <= 4 else 1
+    choices = []
+    for token in tokens:
+        candidates = similar_terms(token) if len(token) >= TERM_MIN_LENGTH else []
+        if not candidates or any(term == token for term, similarity in candidates):
+            candidates = [(token, 1.0)]
+        choices.append(candidates[:width])
+    variants = sorted(itertools.product(*choices), key=lambda variant: -sum(sim for term, sim in variant))
+    suggestions = []
+    for variant in variants:
+        suggestion = ' '.join(term for term, similarity in variant)
+        if suggestion != ' '.join(tokens) and suggestion not in suggestions:
+            suggestions.append(suggestion)
+        if len(suggestions) == limit:
+            break
+    return suggestions
+
+
+SearchHit = collections.namedtuple('SearchHit', ['kind', 'object', 'rank'])
+
+SearchGroup = collections.namedtuple('SearchGroup', ['kind', 'hits', 'total'])
+
+# Entity type -> (model name, detail url name, per-type search url name)
+KINDS = collections.OrderedDict([
+    ('book', ('Book', 'book-detail', 'book-search')),
+    ('author', ('Author', 'author-detail', 'author-search')),
+    ('tag', ('Tag', 'tag-detail', 'tag-search')),
+    ('series', ('Series', 'series-detail', 'series-search')),
+    ('publisher', ('Publisher', 'publisher-detail', 'publishers-search')),
+])
+
+
+class CatalogSearch:
+    """Hits of one query over every entity type, ranked and grouped by type."""
+
+    def __init__(self, query, groups, suggestions=None, is_fuzzy=False):
+        self.query = query
+        self.groups = groups
+        self.suggestions = suggestions or []
+        self.is_fuzzy = is_fuzzy
+
+    @property
+    def counts(self):
+        return collections.OrderedDict((group.kind, group.total) for group in self.groups)
+
+    @property
+    def total(self):
+        return sum(group.total for group in self.groups)
+
+    @property
+    def hits(self):
+        hits = [hit for group in self.groups for hit in group.hits]
+        return sorted(hits, key=lambda hit: hit.rank)
+
+
+def _ranked_ids(kinds, expression, limit):
+    selects = []
+    params = []
+    for kind in kinds:
+        index = INDEXES['bookstore_{}'.format(kind)]
+        selects.append(
+            "SELECT * FROM (SELECT '{kind}', rowid, {rank} AS rank, "
+            "(SELECT COUNT(*) FROM {name} WHERE {name} MATCH %s) FROM {name} "
+            "WHERE {name} MATCH %s ORDER BY rank LIMIT %s)".format(kind=kind, rank=index.rank_sql(), name=index.name))
+        params += [expression, expression, limit]
+    with connection.cursor() as cursor:
+        cursor.execute(' UNION ALL '.join(selects), params)
+        return cursor.fetchall()
+
+
+def search_catalog(query, kinds=None, limit=None):
+    """
+    Searches every entity type with a single ranked UNION query and loads the
+    hits with one query per type, so the number of queries does not depend on
+    the number of results.
+    """
+    from django.apps import apps
+
+    kinds = [kind for kind in KINDS if not kinds or kind in kinds]
+    limit = limit or settings.SEARCH_RESULTS_PER_TYPE
+    is_fuzzy = False
+    suggestions = []
+    rows = _ranked_ids(kinds, match_expression(query), limit) if tokenize(query) else []
+    if len(rows) < settings.SEARCH_SUGGESTION_HITS:
+        suggestions = suggest(query)
+        if not rows and suggestions:
+            rows = _ranked_ids(kinds, fuzzy_match_expression(query), limit)
+            is_fuzzy = True
+
+    groups = []
+    for kind in kinds:
+        kind_rows = [row for row in rows if row[0] == kind]
+        if not kind_rows:
+            continue
+        model = apps.get_model('bookstore', KINDS[kind][0])
+        queryset = model.objects.all()
+        if kind == 'book':
+            queryset = queryset.cards()
+        objects = queryset.in_bulk([row[1] for row in kind_rows])
+        hits = [SearchHit(kind, objects[pk], rank) for _, pk, rank, total in kind_rows if pk in objects]
+        groups.append(SearchGroup(kind, hits, kind_rows[0][3]))
+    groups.sort(key=lambda group: group.hits[0].rank if group.hits else 0)
+    return CatalogSearch(query, groups, suggestions, is_fuzzy)
+
+
+AUTOCOMPLETE_FIELDS = collections.OrderedDict([
+    ('book', 'title'),
+    ('author', 'name'),
+    ('tag', 'name'),
+    ('series', 'title'),
+    ('publisher', 'name'),
+])
+
+# Every name is also reachable from its following words ("tolstoy" finds
+# "Leo Tolstoy"), up to this many words deep.
+AUTOCOMPLETE_WORDS = 4
+
+
+def autocomplete_entries(kind, pk, label):
+    from bookstore.models import AutocompleteEntry
+
+    tokens = tokenize(label)
+    keys = []
+    for position in range(min(len(tokens), AUTOCOMPLETE_WORDS)):
+        key = ' '.join(tokens[position:])[:128]
+        if key not in keys:
+            keys.append(key)
+    return [AutocompleteEntry(kind=kind, key=key, position=position, object_id=pk, label=label[:128])
+            for position, key in enumerate(keys)]
+
+
+def index_autocomplete(kind, instance):
+    from bookstore.models import AutocompleteEntry
+
+    AutocompleteEntry.objects.filter(kind=kind, object_id=instance.pk).delete()
+    AutocompleteEntry.objects.bulk_create(
+        autocomplete_entries(kind, instance.pk, getattr(instance, AUTOCOMPLETE_FIELDS[kind])))
+
+
+def unindex_autocomplete(kind, instance):
+    from bookstore.models import AutocompleteEntry
+
+    AutocompleteEntry.objects.filter(kind=kind, object_id=instance.pk).delete()
+
+
+def rebuild_autocomplete(batch_size=10000):
+    from bookstore.models import AutocompleteEntry
+
+    AutocompleteEntry.objects.all().delete()
+    with connection.cursor() as cursor:
+        for kind, field in AUTOCOMPLETE_FIELDS.items():
+            cursor.execute('SELECT id, {} FROM bookstore_{}'.format(field, kind))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                entries = []
+                for pk, label in rows:
+                    entries.extend(autocomplete_entries(kind, pk, label or ''))
+                AutocompleteEntry.objects.bulk_create(entries, batch_size=5000)
+
+
+def autocomplete(query, kinds=None, limit=None):
+    """Top names starting with ``query`` (or with one of its words) per entity type."""
+    limit = limit or settings.AUTOCOMPLETE_LIMIT
+    kinds = [kind for kind in AUTOCOMPLETE_FIELDS if not kinds or kind in kinds]
+    prefix = ' '.join(tokenize(query))
+    if not prefix:
+        return collections.OrderedDict()
+    if query[-1:].isspace():
+        prefix += ' '
+    selects = []
+    params = []
+    for kind in kinds:
+        selects.append('SELECT * FROM (SELECT kind, object_id, label, position FROM bookstore_autocompleteentry '
+                       'WHERE kind = %s AND key >= %s AND key < %s ORDER BY key LIMIT %s)')
+        params += [kind, prefix, prefix + '\uffff', limit * 3]
+    with connection.cursor() as cursor:
+        cursor.execute(' UNION ALL '.join(selects), params)
+        rows = cursor.fetchall()
+
+    suggestions = collections.OrderedDict((kind, []) for kind in kinds)
+    seen = set()
+    for kind, pk, label, position in sorted(rows, key=lambda row: (row[3], len(row[2]), row[2])):
+        if (kind, pk) in seen or len(suggestions[kind]) == limit:
+            continue
+        seen.add((kind, pk))
+        suggestions[kind].append({'id': pk, 'label': label})
+    return suggestions
@@ -1,7 +1,8 @@
 from rest_framework import serializers
-from bookstore.models import Book, Author, Publisher, Tag, Series, Shelf, Comments
+from bookstore.models import Book, Author, Publisher, Tag, Series, Shelf, Comments, UploadSession
 from django.shortcuts import redirect
 from django.urls import reverse
+from pathlib import Path
 
 
 class PublisherSerializer(serializers.ModelSerializer):
@@ -54,11 +55,52 @@ class BookSerializer(serializers.ModelSerializer):
     cover_url = serializers.SerializerMethodField()
 
     def get_cover_url(self, obj: Book):
-        if obj.has_cover:
-            return reverse('book-cover', args={'pk': obj.pk})
-        else:
-            return 'static/img/default-cover.jpg'
+        return obj.get_cover_url()
 
     class Meta:
         model = Book
         fields = ['id', 'title', 'created_at', 'description', 'authors', 'files', 'cover_url']
+
+
+class SearchHitSerializer(serializers.Serializer):
+    type = serializers.CharField(source='kind')
+    id = serializers.IntegerField(source='object.pk')
+    label = serializers.CharField(source='object')
+    url = serializers.SerializerMethodField()
+    rank = serializers.FloatField()
+
+    def get_url(self, hit):
+        from bookstore.search import KINDS
+        return reverse(KINDS[hit.kind][1], kwargs={'pk': hit.object.pk})
+
+
+class CatalogSearchSerializer(serializers.Serializer):
+    query = serializers.CharField()
+    total = serializers.IntegerField()
+    counts = serializers.DictField(child=serializers.IntegerField())
+    suggestions = serializers.ListField(child=serializers.CharField())
+    is_fuzzy = serializers.BooleanField()
+    results = SearchHitSerializer(source='hits', many=True)
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    file = serializers.HyperlinkedRelatedField(
+        read_only=True,
+        view_name='file-download',
+    )
+
+    def validate_filename(self, value):
+        extension = Path(value).suffix[1:]
+        if not extension or len(extension) > 8:
+            raise serializers.ValidationError('File name must have an extension!')
+        return value
+
+    def validate_size(self, value):
+        if value <= 0:
+            raise serializers.ValidationError('File must not be empty!')
+        return value
+
+    class Meta:
+        model = UploadSession
+        fields = ['uuid', 'filename', 'size', 'offset', 'book', 'file']
+        read_only_fields = ['uuid', 'offset', 'file']
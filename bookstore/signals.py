@@ -0,0 +1,189 @@
+from django.core.files.storage import default_storage
+from django.db.models.signals import post_init, pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from bookstore import caching, counters, search, storage, extraction, pagination
+from bookstore.models import Book, Author, Tag, Series, Publisher, File, UploadSession
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=Series)
+def index_title_terms(sender, instance, **kwargs):
+    search.add_terms(search.vocabulary(instance.title))
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Publisher)
+def index_name_terms(sender, instance, **kwargs):
+    search.add_terms(search.vocabulary(instance.name))
+
+
+AUTOCOMPLETE_KINDS = {
+    Book: 'book',
+    Author: 'author',
+    Tag: 'tag',
+    Series: 'series',
+    Publisher: 'publisher',
+}
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Series)
+@receiver(post_save, sender=Publisher)
+def index_autocomplete(sender, instance, **kwargs):
+    search.index_autocomplete(AUTOCOMPLETE_KINDS[sender], instance)
+
+
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Series)
+@receiver(post_delete, sender=Publisher)
+def unindex_autocomplete(sender, instance, **kwargs):
+    search.unindex_autocomplete(AUTOCOMPLETE_KINDS[sender], instance)
+
+
+@receiver(post_save, sender=File)
+def enqueue_extraction(sender, instance, created, **kwargs):
+    if created:
+        extraction.enqueue([instance])
+
+
+@receiver(post_delete, sender=File)
+def release_file_blob(sender, instance, **kwargs):
+    storage.release_blob(instance)
+
+
+@receiver(post_delete, sender=UploadSession)
+def delete_partial_upload(sender, instance, **kwargs):
+    if default_storage.exists(instance.storage_name):
+        default_storage.delete(instance.storage_name)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+@receiver(m2m_changed)
+def invalidate_counts(sender, **kwargs):
+    if sender._meta.app_label == 'bookstore':
+        pagination.invalidate_counts(sender._meta.db_table)
+
+
+@receiver(post_init)
+def collect_cache_tags(sender, instance, **kwargs):
+    if sender._meta.app_label == 'bookstore':
+        caching.record_instance(sender, instance)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_pages(sender, instance, **kwargs):
+    if sender._meta.app_label != 'bookstore':
+        return
+    tags = {caching.model_tag(sender), caching.model_tag(sender, instance.pk)}
+    # The rows it refers to, before and after a book moves to another series or publisher.
+    previous = getattr(instance, '_counted_keys', {})
+    for field in sender._meta.concrete_fields:
+        if field.many_to_one:
+            for pk in {getattr(instance, field.attname), previous.get(field.attname)} - {None}:
+                tags.add(caching.model_tag(field.related_model, pk))
+    caching.invalidate(*tags)
+
+
+@receiver(m2m_changed)
+def invalidate_linked_pages(sender, instance, action, model, pk_set, **kwargs):
+    if instance._meta.app_label != 'bookstore':
+        return
+    if action == 'pre_clear':
+        source, target = [next(field for field in sender._meta.fields if field.related_model is related)
+                          for related in (type(instance), model)]
+        instance._cleared_pks = set(sender.objects.filter(**{source.name: instance.pk})
+                                    .values_list(target.attname, flat=True))
+    elif action.startswith('post_'):
+        pks = pk_set if action != 'post_clear' else instance._cleared_pks
+        caching.invalidate(caching.model_tag(type(instance), instance.pk), caching.model_tag(type(instance)),
+                           caching.model_tag(model), *[caching.model_tag(model, pk) for pk in pks or ()])
+
+
+BOOK_FOREIGN_KEYS = [(Series, 'series_id'), (Publisher, 'publisher_id')]
+BOOK_M2M = {Book.authors.through: (Author, 'author_id'), Book.tags.through: (Tag, 'tag_id')}
+
+
+@receiver(pre_save, sender=Book)
+def remember_book_foreign_keys(sender, instance, **kwargs):
+    instance._counted_keys = {}
+    if not instance._state.adding:
+        instance._counted_keys = Book.objects.filter(pk=instance.pk).values('series_id', 'publisher_id').first() or {}
+
+
+@receiver(post_save, sender=Book)
+def count_book_foreign_keys(sender, instance, **kwargs):
+    for model, field in BOOK_FOREIGN_KEYS:
+        old, new = instance._counted_keys.get(field), getattr(instance, field)
+        if old != new:
+            counters.adjust(model, [old], -1)
+            counters.adjust(model, [new], 1)
+
+
+@receiver(pre_delete, sender=Book)
+def remember_book_links(sender, instance, **kwargs):
+    instance._counted_links = {model: list(sender.objects.filter(book_id=instance.pk).values_list(field, flat=True))
+                               for sender, (model, field) in BOOK_M2M.items()}
+    instance._counted_links.update({model: [getattr(instance, field)] for model, field in BOOK_FOREIGN_KEYS})
+
+
+@receiver(post_delete, sender=Book)
+def uncount_book_links(sender, instance, **kwargs):
+    for model, ids in instance._counted_links.items():
+        counters.adjust(model, ids, -1)
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+@receiver(m2m_changed, sender=Book.tags.through)
+def count_book_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    model, field = BOOK_M2M[sender]
+    if action in ('pre_remove', 'pre_clear'):
+        # The links that really exist are the ones to uncount.
+        links = sender.objects.filter(**{field if reverse else 'book_id': instance.pk})
+        if pk_set is not None:
+            links = links.filter(**{('book_id' if reverse else field) + '__in': pk_set})
+        instance._removed_links = list(links.values_list(field, flat=True))
+    elif action in ('post_remove', 'post_clear'):
+        counters.adjust(model, instance._removed_links, -1)
+    elif action == 'post_add' and pk_set:
+        if reverse:
+            counters.adjust(model, [instance.pk], len(pk_set))
+        else:
+            counters.adjust(model, pk_set, 1)
+
+
+# Book cards are cached by the book's authors_modified and show the names of its authors.
+@receiver(pre_save, sender=Author)
+def remember_author_name(sender, instance, **kwargs):
+    instance._previous_name = None
+    if not instance._state.adding:
+        instance._previous_name = Author.objects.filter(pk=instance.pk).values_list('name', flat=True).first()
+
+
+@receiver(post_save, sender=Author)
+def touch_renamed_author_books(sender, instance, created, **kwargs):
+    if not created and instance._previous_name != instance.name:
+        Book.objects.filter(authors=instance).touch_authors()
+
+
+@receiver(pre_delete, sender=Author)
+def touch_deleted_author_books(sender, instance, **kwargs):
+    Book.objects.filter(authors=instance).touch_authors()
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+def touch_books_of_changed_authors(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            Book.objects.filter(pk=instance.pk).touch_authors()
+    elif action == 'pre_clear':
+        Book.objects.filter(authors=instance).touch_authors()
+    elif action in ('post_add', 'post_remove') and pk_set:
+        Book.objects.filter(pk__in=pk_set).touch_authors()
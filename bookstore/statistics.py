@@ -0,0 +1,139 @@
+"""
+Catalog statistics for the statistics page.
+
+The analytics are computed with NumPy over whole columns read in one query
+per table, and kept in the cache as a snapshot. ``refresh_statistics`` (run it
+from cron) renews the snapshot. Page views never compute it: when it is missing
+or older than ``STATISTICS_MAX_AGE``, one of them starts a refresh in a
+background thread and all of them keep serving the old snapshot, or
+``PLACEHOLDER`` until there is one. The totals come from
+``pagination.cached_count()``, so they are current on every view.
+"""
+import datetime
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+
+from bookstore import pagination
+from bookstore.models import Book, Author, Tag, Series, Publisher, File
+
+SNAPSHOT_KEY = 'statistics:snapshot'
+LOCK_KEY = 'statistics:refreshing'
+# Seconds a refresh may take before another request starts one again
+LOCK_TIMEOUT = 5 * 60
+# Rows fetched per database round trip while reading a column
+CHUNK_SIZE = 10000
+# Rows of the top authors and tags
+TOP_SIZE = 10
+
+
+def _columns(queryset, *fields):
+    """The ``fields`` of ``queryset`` as one list per field, read in a single query."""
+    rows = queryset.order_by().values_list(*fields).iterator(chunk_size=CHUNK_SIZE)
+    return [list(column) for column in zip(*rows)] or [[] for field in fields]
+
+
+def _months(datetimes):
+    # NumPy has no time zones; the values are UTC.
+    return np.array([value.replace(tzinfo=None) for value in datetimes], dtype='datetime64[us]').astype('datetime64[M]')
+
+
+def books_per_year():
+    """``[(year, books)]`` of the books with a publication date."""
+    dates, = _columns(Book.objects.exclude(published_at=None), 'published_at')
+    years, counts = np.unique(np.array(dates, dtype='datetime64[D]').astype('datetime64[Y]'), return_counts=True)
+    return list(zip((years.astype(int) + 1970).tolist(), counts.tolist()))
+
+
+def storage_by_extension():
+    """``[(extension, files, bytes)]``, the largest first."""
+    extensions, sizes = _columns(File.objects.all(), 'extension', 'size')
+    names, inverse = np.unique(np.char.lower(np.array(extensions, dtype=str)), return_inverse=True)
+    files = np.bincount(inverse, minlength=len(names))
+    total = np.bincount(inverse, weights=np.array(sizes, dtype=np.int64), minlength=len(names)).astype(np.int64)
+    order = np.argsort(-total, kind='stable')
+    return list(zip(names[order].tolist(), files[order].tolist(), total[order].tolist()))
+
+
+def growth():
+    """
+    ``[(month, books added, bytes added, books in total, bytes in total)]``
+    by the ``created_at`` of the books.
+    """
+    created, = _columns(Book.objects.all(), 'created_at')
+    if not created:
+        return []
+    months = _months(created)
+    file_created, sizes = _columns(File.objects.all(), 'book__created_at', 'size')
+    first = months.min()
+    span = int((months.max() - first).astype(int)) + 1
+    books = np.bincount((months - first).astype(int), minlength=span)
+    size = np.bincount((_months(file_created) - first).astype(int), weights=np.array(sizes, dtype=np.int64),
+                       minlength=span).astype(np.int64)
+    labels = (first + np.arange(span)).astype('datetime64[D]').tolist()
+    return list(zip(labels, books.tolist(), size.tolist(), np.cumsum(books).tolist(), np.cumsum(size).tolist()))
+
+
+def top(model):
+    """``[(pk, name, books)]`` of the ``model`` rows with the most books."""
+    rows = model.objects.order_by('-book_count', 'pk')[:TOP_SIZE]
+    return [(row.pk, str(row), row.book_count) for row in rows]
+
+
+def compute():
+    return {
+        'generated_at': timezone.now(),
+        'books_per_year': books_per_year(),
+        'storage': storage_by_extension(),
+        'growth': growth(),
+        'top_authors': top(Author),
+        'top_tags': top(Tag),
+    }
+
+
+# Served until the first snapshot is computed
+PLACEHOLDER = {
+    'generated_at': None,
+    'books_per_year': [],
+    'storage': [],
+    'growth': [],
+    'top_authors': [],
+    'top_tags': [],
+}
+
+
+def refresh():
+    snapshot = compute()
+    cache.set(SNAPSHOT_KEY, snapshot, None)
+    return snapshot
+
+
+def totals():
+    """``{name: (count, is_estimate)}`` of the catalog tables."""
+    models = {'books': Book, 'authors': Author, 'tags': Tag, 'series': Series, 'publishers': Publisher}
+    return {name: pagination.cached_count(model.objects.all()) for name, model in models.items()}
+
+
+def _refresh_in_background():
+    try:
+        refresh()
+    finally:
+        cache.delete(LOCK_KEY)
+        connection.close()
+
+
+def snapshot():
+    """
+    The cached snapshot, or ``PLACEHOLDER`` while there is none. A missing or
+    stale one is refreshed in a background thread, by one request at a time.
+    """
+    current = cache.get(SNAPSHOT_KEY)
+    stale = current is None or (
+        timezone.now() - current['generated_at'] > datetime.timedelta(seconds=settings.STATISTICS_MAX_AGE))
+    if stale and cache.add(LOCK_KEY, True, LOCK_TIMEOUT):
+        threading.Thread(target=_refresh_in_background, daemon=True).start()
+    return current or PLACEHOLDER
@@ -0,0 +1,141 @@
+"""
+Content-addressed storage of book files.
+
+A blob lives at ``books/<sha256[:2]>/<sha256>`` and is shared by every ``File``
+with the same ``checksum``. The checksum is computed while the upload is written
+to a temporary name, so identical content is detected without reading it twice;
+a staged blob is either committed to its address or discarded.
+Files stored before checksums existed keep their ``books/<uuid>`` name.
+"""
+import hashlib
+import os
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files import File as DjangoFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+TEMP_DIR = 'books/tmp/'
+CHUNK_SIZE = 64 * 1024
+HEAD_SIZE = 1024
+
+Blob = namedtuple('Blob', ['name', 'checksum', 'size', 'head'])
+
+
+def blob_name(checksum):
+    return 'books/{}/{}'.format(checksum[:2], checksum)
+
+
+class HashingFile(DjangoFile):
+    """
+    File whose chunks are hashed and counted as the storage consumes them; the
+    first ``HEAD_SIZE`` bytes are kept for format sniffing.
+    """
+
+    def __init__(self, file, name=None):
+        super().__init__(file, name)
+        self.hash = hashlib.sha256()
+        self.bytes_read = 0
+        self.head = b''
+
+    def chunks(self, chunk_size=None):
+        for chunk in super().chunks(chunk_size):
+            self.hash.update(chunk)
+            self.bytes_read += len(chunk)
+            if len(self.head) < HEAD_SIZE:
+                self.head += chunk[:HEAD_SIZE - len(self.head)]
+            yield chunk
+
+    def blob(self, name):
+        return Blob(name, self.hash.hexdigest(), self.bytes_read, self.head)
+
+
+def _move(source, target):
+    if hasattr(default_storage, 'path'):
+        target_path = default_storage.path(target)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        os.replace(default_storage.path(source), target_path)
+    else:
+        with default_storage.open(source, 'rb') as content:
+            default_storage.save(target, content)
+        default_storage.delete(source)
+
+
+def stage_blob(content):
+    """Writes ``content`` to a temporary name in a single pass."""
+    hashing = HashingFile(content, getattr(content, 'name', None))
+    return hashing.blob(default_storage.save(TEMP_DIR + uuid.uuid4().hex, hashing))
+
+
+def stage_blobs(contents, workers=None):
+    """Stages several uploads concurrently on at most ``UPLOAD_WORKERS`` threads."""
+    with ThreadPoolExecutor(max_workers=workers or settings.UPLOAD_WORKERS) as executor:
+        return list(executor.map(stage_blob, contents))
+
+
+def hash_blob(name):
+    """Reads an already stored file as a staged blob."""
+    with default_storage.open(name, 'rb') as content:
+        hashing = HashingFile(content)
+        for _ in hashing.chunks():
+            pass
+    return hashing.blob(name)
+
+
+def commit_blob(blob):
+    """Moves a staged blob to its content address unless identical content is already there."""
+    if default_storage.exists(blob_name(blob.checksum)):
+        default_storage.delete(blob.name)
+    else:
+        _move(blob.name, blob_name(blob.checksum))
+
+
+def discard_blob(blob):
+    default_storage.delete(blob.name)
+
+
+def store_blob(content):
+    blob = stage_blob(content)
+    commit_blob(blob)
+    return blob
+
+
+def write_chunk(name, offset, stream, length, block_size=CHUNK_SIZE):
+    """
+    Copies up to ``length`` bytes of ``stream`` into the local file ``name`` at
+    ``offset``, ``block_size`` bytes at a time, and returns the number written.
+    Repeating a chunk overwrites the same bytes, so retries are harmless.
+    """
+    path = default_storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    written = 0
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as file:
+        file.seek(offset)
+        while written < length:
+            block = stream.read(min(block_size, length - written))
+            if not block:
+                break
+            file.write(block)
+            written += len(block)
+    return written
+
+
+def release_blob(file):
+    """
+    Deletes the blob of a deleted ``File`` once the deletion is committed, unless
+    another row refers to it by then. A rolled back deletion keeps the blob.
+    """
+    from bookstore.models import File
+
+    checksum, name = file.checksum, file.storage_name
+
+    def delete():
+        if checksum and File.objects.filter(checksum=checksum).exists():
+            return
+        if default_storage.exists(name):
+            default_storage.delete(name)
+
+    transaction.on_commit(delete)
@@ -1,6 +1,11 @@
 from django import template
+from django.core.cache import cache
+from django.db.models import Prefetch, prefetch_related_objects
 from django.template.defaultfilters import stringfilter
+from django.template.loader import get_template
 from django.utils.html import mark_safe
+from django.utils.translation import get_language
+from django.conf import settings
 import re
 
 register = template.Library()
@@ -12,3 +17,50 @@ def highlight_search(text, search):
     pattern = re.compile(re.escape(search), re.IGNORECASE)
     new_value = pattern.sub('<span class="highlight">\g<0></span>', text)
     return mark_safe(new_value)
+
+
+@register.simple_tag
+def cover_url(book, size=None, image_format=None):
+    return book.get_cover_url(size, image_format)
+
+
+@register.simple_tag
+def cover_srcset(book, image_format=None):
+    if not book.has_cover:
+        return ''
+    # Sizes are listed from smallest to largest, one per pixel density.
+    return ', '.join('{} {}x'.format(book.get_cover_url(size, image_format), density)
+                     for density, size in enumerate(settings.COVER_SIZES, start=1))
+
+
+def _card_key(book):
+    authors_modified = book.authors_modified.timestamp() if book.authors_modified else 0
+    return 'card:{}:{}:{}:{}'.format(book.pk, book.last_modified.timestamp(), authors_modified, get_language())
+
+
+def _render_cards(books, query_string=None):
+    from bookstore.models import Author
+    prefetch_related_objects(books, Prefetch('authors', queryset=Author.objects.only('id', 'name')))
+    card = get_template('_book_card.html')
+    return [card.render({'book': book, 'query_string': query_string}) for book in books]
+
+
+@register.simple_tag(takes_context=True)
+def book_cards(context, books):
+    """
+    The cards of ``books``, read from the cache with one request. A card is
+    cached until its book's ``last_modified`` or ``authors_modified`` changes,
+    the latter on every change of its authors. Search results highlight the
+    query and are not cached.
+    """
+    books = list(books)
+    if context.get('query_string'):
+        return mark_safe(''.join(_render_cards(books, context['query_string'])))
+    keys = [_card_key(book) for book in books]
+    cards = cache.get_many(keys)
+    missing = [(key, book) for key, book in zip(keys, books) if key not in cards]
+    if missing:
+        rendered = dict(zip([key for key, book in missing], _render_cards([book for key, book in missing])))
+        cache.set_many(rendered, settings.BOOK_CARD_TIMEOUT)
+        cards.update(rendered)
+    return mark_safe(''.join(cards[key] for key in keys))
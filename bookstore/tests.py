@@ -1,8 +1,31 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.template import Context, Template
+from django.conf import settings
 from django.shortcuts import reverse
 from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
 from .models import *
+from .views import BookListView
+from . import search, covers, storage, extraction, benchmark, instrumentation, pagination, counters, statistics
 from mixer.backend.django import Mixer
+from PIL import Image
+import base64
+import datetime
+import hashlib
+import io
+import os
+import sqlite3
+import tempfile
+import zipfile
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
 
 class ListViewTestMixin:
@@ -18,6 +41,11 @@ class ListViewTestMixin:
         mixer = Mixer(commit=False)
         objects = mixer.cycle(30).blend(cls.model)
         cls.model.objects.bulk_create(objects)
+        pagination.invalidate_counts()
+
+    def setUp(self):
+        # The tests look into the context, which a cached page does not have.
+        cache.clear()
 
     def test_parameters(self):
         self.assertTrue(self.model)
@@ -130,6 +158,9 @@ class DetailViewTestMixin:
         mixer = Mixer()
         mixer.blend(cls.model)
 
+    def setUp(self):
+        cache.clear()
+
     def test_view_url_exists_at_desired_location(self):
         resp = self.client.get(self.path_url)
         self.assertEqual(resp.status_code, 200)
@@ -199,18 +230,18 @@ class SearchViewTest(TestCase):
         (':books', 'Wrong search operator!'),
     ]
     valid_queries = [
-        ('query', reverse('book-search') + "?query=query"),
-        ('  query', reverse('book-search') + "?query=query"),
-        ('book:query', reverse('book-search') + "?query=query"),
-        ('book:   query', reverse('book-search') + "?query=query"),
-        ('author:query', reverse('author-search') + "?query=query"),
-        ('author:   query', reverse('author-search') + "?query=query"),
-        ('tag:query', reverse('tag-search') + "?query=query"),
-        ('tag:   query', reverse('tag-search') + "?query=query"),
-        ('series:query', reverse('series-search') + "?query=query"),
-        ('series:   query', reverse('series-search') + "?query=query"),
-        ('publisher:query', reverse('publishers-search') + "?query=query"),
-        ('publisher:   query', reverse('publishers-search') + "?query=query"),
+        ('query', None),
+        ('  query', None),
+        ('book:query', ['book']),
+        ('book:   query', ['book']),
+        ('author:query', ['author']),
+        ('author:   query', ['author']),
+        ('tag:query', ['tag']),
+        ('tag:   query', ['tag']),
+        ('series:query', ['series']),
+        ('series:   query', ['series']),
+        ('publisher:query', ['publisher']),
+        ('publisher:   query', ['publisher']),
     ]
     default_status = 302
     path_url = '/search'
@@ -235,15 +266,48 @@ class SearchViewTest(TestCase):
             self.assertWarnsMessage(resp, query[1])
             self.assertRedirects(resp, reverse('index'))
 
-    def test_valid_query(self):
-        import urllib.parse as urlparse
+    @classmethod
+    def setUpTestData(cls):
+        book = Book.objects.create(title='query book', description='')
+        book.authors.add(Author.objects.create(name='query author', link='', description=''))
+        book.tags.add(Tag.objects.create(name='query tag'))
+        book.series = Series.objects.create(title='query series', description='')
+        book.publisher = Publisher.objects.create(name='query publisher', link='')
+        book.save()
 
-        for query in self.valid_queries:
-            resp = self.client.get(self.path_url + '?query={}'.format(query[0]))
-            self.assertEqual(resp.status_code, self.default_status)
-            self.assertRedirects(resp, query[1])
-            search_arg = (urlparse.parse_qs(urlparse.urlparse(resp.url).query)['query'])[0]
-            self.assertEqual(search_arg, 'query')
+    def test_valid_query(self):
+        for query, kinds in self.valid_queries:
+            resp = self.client.get(self.path_url + '?query={}'.format(query))
+            self.assertEqual(resp.status_code, 200)
+            self.assertTemplateUsed(resp, 'search_results.html')
+            self.assertEqual(resp.context['query_string'], 'query')
+            expected = kinds or ['book', 'author', 'tag', 'series', 'publisher']
+            self.assertEqual(sorted(group['kind'] for group in resp.context['groups']), sorted(expected))
+
+    def test_grouped_counts(self):
+        resp = self.client.get(self.path_url + '?query=query')
+        self.assertEqual(resp.context['result'].total, 5)
+        self.assertEqual(resp.context['result'].counts['book'], 1)
+
+    def test_search_url_quotes_query(self):
+        query = 'query &#book+'
+        resp = self.client.get(self.path_url, {'query': query})
+        self.assertTrue(resp.context['groups'])
+        for group in resp.context['groups']:
+            search_url = urlparse(group['search_url'])
+            self.assertEqual(parse_qs(search_url.query), {'query': [query]})
+
+    def test_bounded_queries(self):
+        with self.assertNumQueries(7):
+            self.client.get(self.path_url + '?query=query')
+
+    def test_api(self):
+        resp = self.client.get(reverse('api:search-list') + '?query=query&type=author&type=tag')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['counts'], {'author': 1, 'tag': 1})
+        self.assertEqual(resp.json()['results'][0]['url'].split('/')[1] in ('author', 'tag'), True)
+        resp = self.client.get(reverse('api:search-list') + '?query=q')
+        self.assertEqual(resp.status_code, 400)
 
 
 class SubjectSearchViewTestMixin:
@@ -617,3 +681,1164 @@ class PublisherEditViewTest(SubjectEditViewTestMixin, TestCase):
         {'name': 'Test Publisher'}
     ]
     invalid_data = {}
+
+
+class SearchIndexTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(name='Лев Толстой', link='', description='')
+        cls.tag = Tag.objects.create(name='classic')
+        cls.book = Book.objects.create(title='Война и мир', description='')
+        cls.book.authors.add(cls.author)
+        cls.book.tags.add(cls.tag)
+        Book.objects.create(title='Anna', description='Not a war and peace novel by classic authors')
+
+    def test_search_by_title(self):
+        self.assertEqual(list(Book.objects.search('войн')), [self.book])
+
+    def test_search_by_related_names(self):
+        self.assertEqual(list(Book.objects.search('толстой')), [self.book])
+        self.assertEqual(list(Author.objects.search('лев')), [self.author])
+
+    def test_index_follows_changes(self):
+        self.author.name = 'Leo Tolstoy'
+        self.author.save()
+        self.assertEqual(list(Book.objects.search('tolstoy')), [self.book])
+        self.assertFalse(Book.objects.search('толстой').exists())
+        self.book.authors.remove(self.author)
+        self.assertFalse(Book.objects.search('tolstoy').exists())
+        Book.objects.filter(pk=self.book.pk).delete()
+        self.assertFalse(Book.objects.search('войн').exists())
+
+    def test_title_hits_rank_first(self):
+        Book.objects.create(title='Classic', description='')
+        books = list(Book.objects.search('classic'))
+        self.assertEqual(books[0].title, 'Classic')
+        self.assertEqual(len(books), 3)
+
+
+class SearchSuggestionTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(name='Достоевский', link='', description='')
+        cls.book = Book.objects.create(title='Crime and Punishment', description='')
+        cls.book.authors.add(cls.author)
+
+    def test_similar_terms(self):
+        self.assertEqual(search.similar_terms('достаевский')[0][0], 'достоевский')
+        self.assertEqual(search.similar_terms('punishmnet')[0][0], 'punishment')
+
+    def test_suggest(self):
+        self.assertIn('crime and punishment', search.suggest('crme and punishment'))
+        self.assertEqual(search.suggest('crime'), [])
+
+    def test_prune_vocabulary(self):
+        self.author.name = 'Толстой'
+        self.author.save()
+        self.assertEqual(search.similar_terms('достаевский')[0][0], 'достоевский')
+        call_command('prune_search_vocabulary', stdout=io.StringIO())
+        self.assertEqual(search.similar_terms('достаевский'), [])
+        self.assertEqual(search.similar_terms('толстоу')[0][0], 'толстой')
+        self.assertEqual(search.prune_vocabulary(), 0)
+
+    def test_fuzzy_search_view(self):
+        resp = self.client.get(reverse('book-search') + '?query=Достаевский')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.context['is_fuzzy'])
+        self.assertEqual(list(resp.context['books']), [self.book])
+        self.assertIn('достоевский', resp.context['suggestions'])
+
+
+class AutocompleteTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(name='Leo Tolstoy', link='', description='')
+        Author.objects.create(name='Leonid Andreyev', link='', description='')
+        cls.book = Book.objects.create(title='Война и мир', description='')
+
+    def test_prefix(self):
+        results = search.autocomplete('leo')
+        self.assertEqual([item['label'] for item in results['author']], ['Leo Tolstoy', 'Leonid Andreyev'])
+        self.assertEqual(search.autocomplete('leo ')['author'], [{'id': self.author.pk, 'label': 'Leo Tolstoy'}])
+
+    def test_word_prefix(self):
+        self.assertEqual(search.autocomplete('мир')['book'], [{'id': self.book.pk, 'label': 'Война и мир'}])
+
+    def test_incremental_update(self):
+        self.author.name = 'Lev Tolstoy'
+        self.author.save()
+        self.assertEqual([item['label'] for item in search.autocomplete('le')['author']],
+                         ['Lev Tolstoy', 'Leonid Andreyev'])
+        Author.objects.get(pk=self.author.pk).delete()
+        self.assertEqual(len(search.autocomplete('tol')['author']), 0)
+
+    def test_api(self):
+        resp = self.client.get(reverse('autocomplete') + '?q=Tol&type=author')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['results'], {'author': [{'id': self.author.pk, 'label': 'Leo Tolstoy'}]})
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class FileDownloadViewTest(TestCase):
+    content = b'0123456789' * 100
+
+    @classmethod
+    def setUpTestData(cls):
+        user = get_user_model().objects.create_user('temporary', 'temporary@temp.com', 'temporary')
+        book = Book.objects.create(title='Война и мир', description='')
+        cls.file = File.objects.create(book=book, extension='pdf', size=len(cls.content), uploader=user)
+
+    def setUp(self):
+        default_storage.save('books/' + self.file.uuid.hex, ContentFile(self.content))
+
+    def tearDown(self):
+        default_storage.delete('books/' + self.file.uuid.hex)
+
+    def test_streaming_download(self):
+        resp = self.client.get(reverse('file-download', kwargs={'pk': self.file.pk}))
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.streaming)
+        self.assertEqual(resp['Content-Length'], str(len(self.content)))
+        self.assertEqual(resp['Content-Type'], 'application/pdf')
+        self.assertEqual(resp['Accept-Ranges'], 'bytes')
+        self.assertIn('attachment', resp['Content-Disposition'])
+        self.assertEqual(b''.join(resp.streaming_content), self.content)
+
+    def test_range(self):
+        url = reverse('file-download', kwargs={'pk': self.file.pk})
+        resp = self.client.get(url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp['Content-Range'], 'bytes 10-19/1000')
+        self.assertEqual(resp['Content-Length'], '10')
+        self.assertEqual(b''.join(resp.streaming_content), self.content[10:20])
+
+        resp = self.client.get(url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(resp.streaming_content), self.content[-5:])
+
+        resp = self.client.get(url, HTTP_RANGE='bytes=990-')
+        self.assertEqual(resp['Content-Range'], 'bytes 990-999/1000')
+
+    def test_range_not_satisfiable(self):
+        resp = self.client.get(reverse('file-download', kwargs={'pk': self.file.pk}), HTTP_RANGE='bytes=1000-')
+        self.assertEqual(resp.status_code, 416)
+        self.assertEqual(resp['Content-Range'], 'bytes */1000')
+
+    def test_if_range_mismatch_sends_whole_file(self):
+        resp = self.client.get(reverse('file-download', kwargs={'pk': self.file.pk}),
+                               HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b''.join(resp.streaming_content), self.content)
+
+
+def run_on_commit():
+    """Runs the on_commit callbacks of the transaction wrapping a TestCase, as a real commit would."""
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for savepoints, callback in callbacks:
+        callback()
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class FileStorageTest(TestCase):
+    content = b'%PDF-1.4' + b'\x00' * 100
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('temporary', 'temporary@temp.com', 'temporary')
+        self.client.login(username='temporary', password='temporary')
+
+    def upload(self):
+        self.client.post(reverse('file-upload'), {'files': SimpleUploadedFile('book.pdf', self.content)})
+        return File.objects.latest('pk')
+
+    def test_identical_uploads_share_blob(self):
+        first, second = self.upload(), self.upload()
+        self.assertEqual(first.checksum, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(first.size, len(self.content))
+        self.assertNotEqual(first.pk, second.pk)
+        self.assertEqual(first.storage_name, second.storage_name)
+        self.assertEqual(default_storage.open(first.storage_name).read(), self.content)
+        self.assertEqual(default_storage.listdir(storage.TEMP_DIR)[1], [])
+
+        self.client.get(reverse('file-delete', kwargs={'pk': first.pk}))
+        run_on_commit()
+        self.assertTrue(default_storage.exists(second.storage_name))
+        second.book.delete()
+        self.assertTrue(default_storage.exists(second.storage_name))
+        run_on_commit()
+        self.assertFalse(default_storage.exists(second.storage_name))
+
+    def test_rolled_back_delete_keeps_blob(self):
+        file = self.upload()
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            File.objects.filter(pk=file.pk).delete()
+            raise RuntimeError
+        run_on_commit()
+        self.assertTrue(File.objects.filter(pk=file.pk).exists())
+        self.assertTrue(default_storage.exists(file.storage_name))
+
+    def test_format_is_sniffed(self):
+        epub = b'PK\x03\x04' + b'\x00' * 26 + b'mimetypeapplication/epub+zip' + b'\x00' * 100
+        self.client.post(reverse('file-upload'), {'files': [
+            SimpleUploadedFile('book.pdf', self.content),
+            SimpleUploadedFile('book.txt', epub),
+            SimpleUploadedFile('fake.djvu', b'not a djvu'),
+        ]})
+        self.assertEqual(sorted(File.objects.values_list('extension', flat=True)), ['epub', 'pdf'])
+        self.assertEqual(Book.objects.count(), 1)
+        self.assertEqual(len(default_storage.listdir(storage.TEMP_DIR)[1]), 0)
+
+    def test_rejected_upload(self):
+        resp = self.client.post(reverse('file-upload'), {'files': SimpleUploadedFile('fake.pdf', b'\x00' * 10)})
+        self.assertEqual(resp.status_code, 302)
+        self.assertFalse(Book.objects.exists())
+
+    def test_deduplicate_legacy_files(self):
+        book = Book.objects.create(title='Война и мир', description='')
+        legacy = File.objects.create(book=book, extension='pdf', size=len(self.content), uploader=self.user)
+        default_storage.save(legacy.storage_name, ContentFile(self.content))
+        uploaded = self.upload()
+
+        call_command('deduplicate_files', stdout=io.StringIO())
+        legacy.refresh_from_db()
+        self.assertEqual(legacy.storage_name, uploaded.storage_name)
+        self.assertFalse(default_storage.exists('books/' + legacy.uuid.hex))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class UploadSessionTest(TestCase):
+    content = b'AT&TFORM\x00\x00\x0f\xa0DJVU' + bytes(range(256)) * 40
+
+    def setUp(self):
+        get_user_model().objects.create_user('temporary', 'temporary@temp.com', 'temporary')
+        self.client.login(username='temporary', password='temporary')
+        resp = self.client.post(reverse('api:uploads-list'), {'filename': 'Book.DJVU', 'size': len(self.content)})
+        self.assertEqual(resp.status_code, 201)
+        self.session = resp.json()
+        self.chunk_url = reverse('api:uploads-chunk', kwargs={'uuid': self.session['uuid']})
+
+    def put_chunk(self, offset, data):
+        return self.client.put(self.chunk_url, data, content_type='application/octet-stream',
+                               HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_resumed_upload(self):
+        resp = self.put_chunk(0, self.content[:4000])
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['offset'], 4000)
+
+        resp = self.put_chunk(0, self.content[:4000])
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(resp.json()['offset'], 4000)
+
+        resp = self.client.get(reverse('api:uploads-detail', kwargs={'uuid': self.session['uuid']}))
+        self.assertEqual(resp.json()['offset'], 4000)
+        self.assertIsNone(resp.json()['file'])
+
+        resp = self.put_chunk(4000, self.content[4000:])
+        self.assertEqual(resp.status_code, 201)
+        file = File.objects.get()
+        self.assertEqual(file.extension, 'djvu')
+        self.assertEqual(file.size, len(self.content))
+        self.assertEqual(file.checksum, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(default_storage.open(file.storage_name).read(), self.content)
+        self.assertFalse(default_storage.exists('uploads/' + self.session['uuid'].replace('-', '')))
+
+    def test_identical_reupload(self):
+        self.assertEqual(self.put_chunk(0, self.content).status_code, 201)
+        book = File.objects.get().book
+        resp = self.client.post(reverse('api:uploads-list'),
+                                {'filename': 'Book.djvu', 'size': len(self.content), 'book': book.pk})
+        resp = self.client.put(reverse('api:uploads-chunk', kwargs={'uuid': resp.json()['uuid']}), self.content,
+                               content_type='application/octet-stream', HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(resp.status_code, 201)
+        file = File.objects.get()
+        self.assertEqual(file.book, book)
+        self.assertEqual(default_storage.open(file.storage_name).read(), self.content)
+
+    def test_invalid_chunks(self):
+        self.assertEqual(self.client.put(self.chunk_url, b'data', content_type='application/octet-stream').status_code,
+                         400)
+        self.assertEqual(self.put_chunk(0, self.content + b'tail').status_code, 400)
+        with self.settings(UPLOAD_CHUNK_MAX_SIZE=1024):
+            self.assertEqual(self.put_chunk(0, self.content[:2048]).status_code, 413)
+        self.assertEqual(UploadSession.objects.get().offset, 0)
+
+    def test_mislabelled_file(self):
+        resp = self.client.post(reverse('api:uploads-list'), {'filename': 'book.pdf', 'size': 4})
+        resp = self.client.put(reverse('api:uploads-chunk', kwargs={'uuid': resp.json()['uuid']}), b'\x00' * 4,
+                               content_type='application/octet-stream', HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(resp.status_code, 415)
+        self.assertFalse(File.objects.exists())
+
+    def test_foreign_session(self):
+        self.client.logout()
+        get_user_model().objects.create_user('other', 'other@temp.com', 'other')
+        self.client.login(username='other', password='other')
+        self.assertEqual(self.put_chunk(0, self.content).status_code, 404)
+
+
+def make_epub(opf_metadata, files=None):
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w') as archive:
+        archive.writestr('mimetype', 'application/epub+zip')
+        archive.writestr('META-INF/container.xml', (
+            '<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0"><rootfiles>'
+            '<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+            '</rootfiles></container>'))
+        archive.writestr('OEBPS/content.opf', (
+            '<package xmlns="http://www.idpf.org/2007/opf" version="2.0">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">{}</metadata></package>').format(opf_metadata))
+        for name, data in (files or {}).items():
+            archive.writestr(name, data)
+    return content.getvalue()
+
+
+FB2_BOOK = """<?xml version="1.0" encoding="utf-8"?>
+<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0"><description><title-info>
+<genre>prose_classic</genre><author><first-name>Лев</first-name><last-name>Толстой</last-name></author>
+<book-title>Анна Каренина</book-title><annotation><p>Роман</p></annotation>
+<sequence name="Романы" number="2"/></title-info>
+<publish-info><publisher>Эксмо</publisher><year>2010</year><isbn>978-5-699-12014-7</isbn></publish-info>
+</description><body/></FictionBook>""".encode()
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class MetadataExtractionTest(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_user('temporary', 'temporary@temp.com', 'temporary')
+        self.client.login(username='temporary', password='temporary')
+        Author.objects.create(name='Лев Толстой')
+
+    def run_worker(self):
+        call_command('run_extraction_worker', '--once', '--workers=1', stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_uploads_are_queued(self):
+        epub = make_epub('<dc:title>Война и мир</dc:title><dc:creator>Лев Толстой</dc:creator>'
+                         '<dc:creator>Редактор</dc:creator><dc:subject>Классика</dc:subject>'
+                         '<dc:identifier>urn:isbn:978-5-17-090099-7</dc:identifier><dc:date>1869</dc:date>'
+                         '<dc:description>&lt;p&gt;Роман-эпопея&lt;/p&gt;</dc:description>'
+                         '<meta name="calibre:series" content="Романы"/>')
+        resp = self.client.post(reverse('file-upload'), {'files': SimpleUploadedFile('war.epub', epub)})
+        self.assertEqual(resp.status_code, 302)
+        self.client.post(reverse('file-upload'), {'files': SimpleUploadedFile('anna.fb2', FB2_BOOK)})
+        jobs = ExtractionJob.objects.filter(kind=ExtractionJob.METADATA)
+        self.assertEqual(jobs.filter(status=ExtractionJob.PENDING).count(), 2)
+        self.assertEqual(Book.objects.filter(title='Untitled book').count(), 2)
+
+        self.run_worker()
+        self.assertEqual(jobs.filter(status=ExtractionJob.DONE).count(), 2)
+        war = Book.objects.get(title='Война и мир')
+        self.assertEqual(war.description, 'Роман-эпопея')
+        self.assertEqual(war.isbn, '9785170900997')
+        self.assertEqual(war.published_at.year, 1869)
+        self.assertEqual([a.name for a in war.authors.order_by('pk')], ['Лев Толстой', 'Редактор'])
+        self.assertEqual(list(war.tags.values_list('name', flat=True)), ['Классика'])
+        anna = Book.objects.get(title='Анна Каренина')
+        self.assertEqual(anna.publisher.name, 'Эксмо')
+        self.assertEqual(anna.series, war.series)
+        self.assertEqual(Author.objects.filter(name='Лев Толстой').count(), 1)
+        self.assertEqual(Series.objects.count(), 1)
+        self.assertIn(anna, Book.objects.search('каренина'))
+
+    def test_existing_values_are_kept(self):
+        book = Book.objects.create(title='Своё название', description='Своё описание')
+        File.objects.create(book=book, extension='fb2', size=len(FB2_BOOK), uploader=get_user_model().objects.get(),
+                            checksum=storage.store_blob(ContentFile(FB2_BOOK)).checksum)
+        self.run_worker()
+        book.refresh_from_db()
+        self.assertEqual((book.title, book.description, book.isbn), ('Своё название', 'Своё описание', '9785699120147'))
+
+    def test_cached_pages_show_new_links(self):
+        self.client.logout()
+        cache.clear()
+        book = Book.objects.create(title='Своё название', description='Своё описание')
+        author = Author.objects.get()
+        author_url = reverse('author-detail', kwargs={'pk': author.pk})
+        self.assertNotContains(self.client.get(reverse('index')), 'Лев Толстой')
+        self.assertNotContains(self.client.get(author_url), 'Своё название')
+        extraction.apply_metadata([(book.pk, {'authors': ['Лев Толстой'], 'tags': ['Классика']})])
+        self.assertContains(self.client.get(reverse('index')), 'Лев Толстой')
+        self.assertContains(self.client.get(author_url), 'Своё название')
+        self.assertContains(self.client.get(reverse('tag-list')), 'Классика')
+        self.assertEqual(Book.objects.get().cover_version, book.cover_version)
+
+    def test_broken_file(self):
+        self.client.post(reverse('file-upload'), {'files': SimpleUploadedFile('war.epub', make_epub('')[:60])})
+        self.run_worker()
+        job = ExtractionJob.objects.get(kind=ExtractionJob.METADATA)
+        self.assertEqual(job.status, ExtractionJob.FAILED)
+        self.assertTrue(job.error)
+
+    def test_pdf_info(self):
+        pdf = b'%PDF-1.4\n1 0 obj\n<< /Title (War \\(and\\) Peace) /Author <FEFF0422043E043B04410442043E0439> >>'
+        metadata = extraction.read_pdf(io.BytesIO(pdf))
+        self.assertEqual(metadata['title'], 'War (and) Peace')
+        self.assertEqual(metadata['authors'], ['Толстой'])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class CoverExtractionTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('temporary', 'temporary@temp.com', 'temporary')
+        buffer = io.BytesIO()
+        Image.new('RGB', (60, 90), 'red').save(buffer, 'PNG')
+        self.image = buffer.getvalue()
+
+    def add_file(self, extension, content, book=None):
+        book = book or Book.objects.create(title='Война и мир', description='')
+        return File.objects.create(book=book, extension=extension, size=len(content), uploader=self.user,
+                                   checksum=storage.store_blob(ContentFile(content)).checksum)
+
+    def test_epub_cover(self):
+        epub = make_epub('<meta name="cover" content="img"/></metadata><manifest>'
+                         '<item id="img" href="images/front.png" media-type="image/png"/></manifest><metadata>',
+                         {'OEBPS/images/front.png': self.image})
+        book = self.add_file('epub', epub).book
+        call_command('run_extraction_worker', '--once', '--workers=1', '--kind=cover', stdout=io.StringIO())
+        book.refresh_from_db()
+        self.assertTrue(book.has_cover)
+        self.assertEqual(default_storage.open(covers.cover_name(book.uuid.hex)).read(), self.image)
+        self.assertTrue(default_storage.exists(covers.cover_name(book.uuid.hex, 'list', 'jpeg')))
+
+    def test_cached_pages_show_cover(self):
+        epub = make_epub('<meta name="cover" content="img"/></metadata><manifest>'
+                         '<item id="img" href="images/front.png" media-type="image/png"/></manifest><metadata>',
+                         {'OEBPS/images/front.png': self.image})
+        book = self.add_file('epub', epub).book
+        cache.clear()
+        self.assertContains(self.client.get(reverse('index')), 'default-cover')
+        call_command('run_extraction_worker', '--once', '--workers=1', '--kind=cover', stdout=io.StringIO())
+        resp = self.client.get(reverse('index'))
+        self.assertNotContains(resp, 'default-cover')
+        self.assertContains(resp, reverse('book-cover', kwargs={'pk': book.pk}) + '?v=')
+
+    def test_backfill_resumes(self):
+        fb2 = FB2_BOOK.replace(b'<book-title>', b'<coverpage><image l:href="#cover.png"/></coverpage><book-title>')
+        fb2 = fb2.replace(b'<FictionBook ', b'<FictionBook xmlns:l="http://www.w3.org/1999/xlink" ')
+        fb2 = fb2.replace(b'<body/>', b'<body/><binary id="cover.png" content-type="image/png">'
+                          + base64.b64encode(self.image) + b'</binary>')
+        book = self.add_file('fb2', fb2).book
+        self.add_file('pdf', b'%PDF-1.4', book)
+        no_cover = self.add_file('epub', make_epub('')).book
+        ExtractionJob.objects.all().delete()
+
+        call_command('backfill_covers', '--workers=1', stdout=io.StringIO())
+        book.refresh_from_db()
+        self.assertTrue(book.has_cover)
+        self.assertEqual(ExtractionJob.objects.get(file__book=book).file.extension, 'fb2')
+        self.assertFalse(Book.objects.get(pk=no_cover.pk).has_cover)
+
+        self.assertEqual(extraction.enqueue_covers(), 0)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class IngestCommandTest(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_superuser('admin', 'admin@temp.com', 'admin')
+        self.root = tempfile.mkdtemp()
+        epub = make_epub('<dc:title>Война и мир</dc:title><dc:creator>Лев Толстой</dc:creator>')
+        for path, content in [('classic/war.epub', epub), ('classic/copy/war.epub', epub),
+                              ('classic/anna.fb2', FB2_BOOK), ('broken.pdf', b'nothing'),
+                              ('Some_Notes.txt', b'plain text'), ('cover.jpg', b'skipped')]:
+            os.makedirs(os.path.dirname(os.path.join(self.root, path)), exist_ok=True)
+            with open(os.path.join(self.root, path), 'wb') as file:
+                file.write(content)
+
+    def ingest(self, *args):
+        out = io.StringIO()
+        call_command('ingest', self.root, '--workers=1', '--batch-size=2', *args, stdout=out, stderr=io.StringIO())
+        return out.getvalue()
+
+    def test_ingest(self):
+        out = self.ingest('--defer-index')
+        self.assertIn('Successfully ingested 3 books (1 duplicates skipped, 1 failed', out)
+        self.assertEqual(sorted(Book.objects.values_list('title', flat=True)),
+                         ['Some Notes', 'Анна Каренина', 'Война и мир'])
+        war = Book.objects.get(title='Война и мир')
+        self.assertEqual(list(war.authors.values_list('name', flat=True)), ['Лев Толстой'])
+        self.assertEqual(war.files.get().extension, 'epub')
+        self.assertEqual(Author.objects.get(name='Лев Толстой').books.count(), 2)
+        self.assertEqual(Author.objects.get(name='Лев Толстой').book_count, 2)
+        self.assertIn(war, Book.objects.search('война'))
+        self.assertEqual(search.autocomplete('войн', ['book'])['book'][0]['id'], war.pk)
+
+        out = self.ingest()
+        self.assertIn('1 files to ingest (4 already done)', out)
+        self.assertIn('Successfully ingested 0 books (0 duplicates skipped, 1 failed', out)
+        self.assertEqual(Book.objects.count(), 3)
+
+
+CALIBRE_SCHEMA = """
+CREATE TABLE books (id INTEGER PRIMARY KEY, title TEXT, pubdate TIMESTAMP, isbn TEXT, path TEXT, uuid TEXT);
+CREATE TABLE authors (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE books_authors_link (id INTEGER PRIMARY KEY, book INTEGER, author INTEGER);
+CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE books_tags_link (id INTEGER PRIMARY KEY, book INTEGER, tag INTEGER);
+CREATE TABLE series (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE books_series_link (id INTEGER PRIMARY KEY, book INTEGER, series INTEGER);
+CREATE TABLE publishers (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE books_publishers_link (id INTEGER PRIMARY KEY, book INTEGER, publisher INTEGER);
+CREATE TABLE comments (id INTEGER PRIMARY KEY, book INTEGER, text TEXT);
+CREATE TABLE identifiers (id INTEGER PRIMARY KEY, book INTEGER, type TEXT, val TEXT);
+CREATE TABLE data (id INTEGER PRIMARY KEY, book INTEGER, format TEXT, name TEXT);
+INSERT INTO books VALUES (1, 'Война и мир', '1869-01-01 00:00:00+00:00', '', 'Tolstoy/War (1)',
+                          '1c9a3b4e-6a43-4a59-9a3e-4d1d2a7f0e01');
+INSERT INTO books VALUES (2, 'Анна Каренина', '0101-01-01 00:00:00+00:00', '', 'Tolstoy/Anna (2)',
+                          '1c9a3b4e-6a43-4a59-9a3e-4d1d2a7f0e02');
+INSERT INTO authors VALUES (1, 'Лев Толстой');
+INSERT INTO books_authors_link VALUES (1, 1, 1), (2, 2, 1);
+INSERT INTO tags VALUES (1, 'Классика'), (2, 'Роман');
+INSERT INTO books_tags_link VALUES (1, 1, 1), (2, 1, 2), (3, 2, 2);
+INSERT INTO series VALUES (1, 'Романы');
+INSERT INTO books_series_link VALUES (1, 1, 1);
+INSERT INTO publishers VALUES (1, 'Эксмо');
+INSERT INTO books_publishers_link VALUES (1, 2, 1);
+INSERT INTO comments VALUES (1, 1, '<p>Роман-эпопея &amp; история</p>');
+INSERT INTO identifiers VALUES (1, 1, 'isbn', '9785170900997');
+INSERT INTO data VALUES (1, 1, 'EPUB', 'War'), (2, 1, 'AZW3', 'War'), (3, 2, 'FB2', 'Anna');
+"""
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class CalibreImportTest(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_superuser('admin', 'admin@temp.com', 'admin')
+        self.library = tempfile.mkdtemp()
+        database = sqlite3.connect(os.path.join(self.library, 'metadata.db'))
+        database.executescript(CALIBRE_SCHEMA)
+        database.close()
+        buffer = io.BytesIO()
+        Image.new('RGB', (60, 90), 'red').save(buffer, 'JPEG')
+        for path, content in [('Tolstoy/War (1)/War.epub', make_epub('')), ('Tolstoy/War (1)/War.azw3', b'azw'),
+                              ('Tolstoy/War (1)/cover.jpg', buffer.getvalue()), ('Tolstoy/Anna (2)/Anna.fb2', FB2_BOOK)]:
+            os.makedirs(os.path.dirname(os.path.join(self.library, path)), exist_ok=True)
+            with open(os.path.join(self.library, path), 'wb') as file:
+                file.write(content)
+
+    def test_import(self):
+        call_command('import_calibre', self.library, '--batch-size=1', stdout=io.StringIO())
+        war = Book.objects.get(uuid='1c9a3b4e-6a43-4a59-9a3e-4d1d2a7f0e01')
+        self.assertEqual(war.title, 'Война и мир')
+        self.assertEqual(war.description, 'Роман-эпопея & история')
+        self.assertEqual(war.isbn, '9785170900997')
+        self.assertEqual(war.published_at.year, 1869)
+        self.assertEqual(war.series.title, 'Романы')
+        self.assertTrue(war.has_cover)
+        self.assertEqual(list(war.files.values_list('extension', flat=True)), ['epub'])
+        self.assertEqual(sorted(war.tags.values_list('name', flat=True)), ['Классика', 'Роман'])
+        anna = Book.objects.get(title='Анна Каренина')
+        self.assertIsNone(anna.published_at)
+        self.assertEqual(anna.publisher.name, 'Эксмо')
+        self.assertEqual(list(anna.authors.all()), list(war.authors.all()))
+        self.assertIn(anna, Book.objects.search('каренина'))
+
+    def test_reimport_is_idempotent(self):
+        call_command('import_calibre', self.library, stdout=io.StringIO())
+        database = sqlite3.connect(os.path.join(self.library, 'metadata.db'))
+        database.execute("UPDATE books SET title = 'Война и мир. Том 1' WHERE id = 1")
+        database.execute('DELETE FROM books_tags_link WHERE id = 2')
+        database.commit()
+        database.close()
+        out = io.StringIO()
+        call_command('import_calibre', self.library, stdout=out)
+        self.assertIn('0 new and 2 updated books (0 files, 0 covers)', out.getvalue())
+        self.assertEqual((Book.objects.count(), File.objects.count(), Tag.objects.count()), (2, 2, 2))
+        war = Book.objects.get(title='Война и мир. Том 1')
+        self.assertEqual(list(war.tags.values_list('name', flat=True)), ['Классика'])
+        self.assertEqual(Tag.objects.get(name='Роман').book_count, 1)
+
+    def test_broken_cover(self):
+        with open(os.path.join(self.library, 'Tolstoy/Anna (2)/cover.jpg'), 'wb') as file:
+            file.write(b'not an image')
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_calibre', self.library, '--batch-size=1', stdout=out, stderr=err)
+        self.assertIn('2 new and 0 updated books (2 files, 1 covers)', out.getvalue())
+        self.assertIn('Broken cover', err.getvalue())
+        anna = Book.objects.get(title='Анна Каренина')
+        self.assertFalse(anna.has_cover)
+        self.assertEqual(anna.files.count(), 1)
+        self.assertFalse(default_storage.exists(covers.cover_name(anna.uuid.hex)))
+
+
+class GenerateCommandTest(TestCase):
+    def generate(self, *args):
+        call_command('generate', '2', '--batch-size=25', *args, stdout=io.StringIO())
+        return list(Book.objects.order_by('pk').values_list('pk', 'title', 'published_at', 'series_id',
+                                                            'publisher_id')), \
+            list(Book.authors.through.objects.order_by('book_id', 'author_id').values_list('book_id', 'author_id'))
+
+    def test_generate(self):
+        books, authors = self.generate('--seed=7')
+        self.assertEqual(len(books), 60)
+        self.assertEqual(Author.objects.count(), 10)
+        self.assertTrue(File.objects.exists())
+        self.assertEqual(Book.objects.annotate(n=Count('authors')).filter(n=0).count(), 0)
+        self.assertEqual([counters.recount(model.objects.all()) for model in counters.taxonomy()], [0, 0, 0, 0])
+        title = books[0][1]
+        self.assertIn(Book.objects.get(pk=books[0][0]), Book.objects.search(title))
+
+        for model in (Book, Author, Tag, Series, Publisher, Shelf):
+            model.objects.all().delete()
+        get_user_model().objects.all().delete()
+        self.assertEqual(self.generate('--seed=7', '--workers=2'), (books, authors))
+
+    def test_reproducible_on_existing_rows(self):
+        books, authors = self.generate('--seed=7')
+        for model in (Book, Author, Tag, Series, Publisher, Shelf):
+            model.objects.all().delete()
+        get_user_model().objects.all().delete()
+        Book.objects.create(title='Existing', description='')
+        generated = self.generate('--seed=7')[0][1:]
+        self.assertEqual([row[1:3] for row in generated], [row[1:3] for row in books])
+        self.assertTrue(all(datetime.date(1925, 1, 1) <= row[2] <= datetime.date(2024, 12, 31) for row in generated))
+
+
+class BookCardQueriesTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(name='Лев Толстой')
+        cls.tag = Tag.objects.create(name='роман')
+
+    def add_books(self, count):
+        for number in range(count):
+            book = Book.objects.create(title='Книга {}'.format(number), description='')
+            book.authors.add(self.author, Author.objects.create(name='Автор {}'.format(number)))
+            book.tags.add(self.tag)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        return len(queries)
+
+    def test_constant_queries(self):
+        urls = [reverse('index'), reverse('author-detail', kwargs={'pk': self.author.pk}),
+                reverse('tag-detail', kwargs={'pk': self.tag.pk}), reverse('book-search') + '?query=книга']
+        self.add_books(3)
+        few = [self.count_queries(url) for url in urls]
+        self.add_books(17)
+        self.assertEqual([self.count_queries(url) for url in urls], few)
+
+    def render_cards(self):
+        books = list(Book.objects.cards())
+        with CaptureQueriesContext(connection) as queries:
+            html = Template('{% load filters %}{% book_cards books %}').render(Context({'books': books}))
+        return html, len(queries)
+
+    def test_cards(self):
+        self.add_books(2)
+        cache.clear()
+        self.assertIn('description', Book.objects.cards().first().get_deferred_fields())
+        html, queries = self.render_cards()
+        self.assertEqual(queries, 1)
+        self.assertEqual(html.count('Лев Толстой'), 2)
+        self.assertEqual(self.render_cards(), (html, 0))
+
+    def test_card_invalidation(self):
+        self.add_books(2)
+        self.author.name = 'Л. Н. Толстой'
+        self.author.save()
+        html, queries = self.render_cards()
+        self.assertEqual(html.count('Л. Н. Толстой'), 2)
+        book = Book.objects.get(title='Книга 0')
+        book.authors.remove(self.author)
+        html, queries = self.render_cards()
+        self.assertEqual(html.count('Л. Н. Толстой'), 1)
+        self.author.books.clear()
+        self.assertNotIn('Толстой', self.render_cards()[0])
+
+    def test_author_rename(self):
+        self.add_books(1)
+        cache.clear()
+        book = Book.objects.get()
+        # A page built from cached cards reads no authors.
+        self.render_cards()
+        self.assertContains(self.client.get(reverse('index')), 'Лев Толстой')
+        self.author.description = 'Писатель'
+        self.author.save()
+        self.assertEqual(Book.objects.get().authors_modified, book.authors_modified)
+        self.author.name = 'Л. Н. Толстой'
+        self.author.save()
+        # The cached index page and card show the new name, the cover URLs stay.
+        self.assertContains(self.client.get(reverse('index')), 'Л. Н. Толстой')
+        self.assertNotEqual(Book.objects.get().authors_modified, book.authors_modified)
+        self.assertEqual(Book.objects.get().cover_version, book.cover_version)
+
+
+@override_settings(PAGINATION_PAGE_LINKS=2, PAGE_CACHE_TIMEOUT=0)
+class KeysetPaginationTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Book.objects.bulk_create([Book(title='Книга {:02}'.format(number % 30), description='') for number in range(90)])
+        pagination.invalidate_counts()
+
+    def walk(self, url, link):
+        titles = []
+        while url:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            titles.extend(book.pk for book in resp.context['books'])
+            url = getattr(resp.context['page_obj'], link)
+            if url:
+                url = reverse('index') + url
+        return titles
+
+    def test_walk(self):
+        for ordering in ('-created_at', 'title', '-title'):
+            expected = list(Book.objects.order_by(*BookListView.orderings[ordering]).values_list('pk', flat=True))
+            url = reverse('index') + '?ordering=' + ordering
+            self.assertEqual(self.walk(url, 'next_url'), expected)
+            last = reverse('index') + self.client.get(url).context['page_obj'].last_url
+            self.assertEqual(sorted(self.walk(last, 'previous_url')), sorted(expected))
+
+    def test_cursor_links(self):
+        page = self.client.get(reverse('index') + '?page=2&ordering=title').context['page_obj']
+        self.assertIn('cursor=', page.next_url)
+        self.assertIn('ordering=title', page.next_url)
+        page = self.client.get(reverse('index') + page.next_url).context['page_obj']
+        self.assertIsNone(page.number)
+        self.assertEqual(page.previous_url.count('cursor='), 1)
+
+    def test_deep_page(self):
+        self.assertRedirects(self.client.get(reverse('index') + '?page=3&ordering=title'),
+                             reverse('index') + '?ordering=title')
+        author = Author.objects.create(name='Пушкин')
+        url = reverse('author-detail', args=[author.pk])
+        self.assertRedirects(self.client.get(url + '?page=3'), url)
+        self.assertEqual(self.client.get(reverse('index') + '?cursor=garbage').status_code, 404)
+
+    def test_api(self):
+        resp = self.client.get(reverse('api:books-list'))
+        self.assertEqual(len(resp.data['results']), 30)
+        self.assertIn('cursor=', resp.data['next'])
+        resp = self.client.get(resp.data['next'])
+        self.assertEqual(len(resp.data['results']), 30)
+
+
+class CachedCountTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.tag = Tag.objects.create(name='роман')
+        for number in range(3):
+            Book.objects.create(title='Книга {}'.format(number), description='').tags.add(cls.tag)
+
+    def test_cached(self):
+        self.assertEqual(pagination.cached_count(self.tag.books.all()), (3, False))
+        with self.assertNumQueries(0):
+            self.assertEqual(pagination.cached_count(self.tag.books.all()), (3, False))
+        Book.objects.create(title='Книга', description='').tags.add(self.tag)
+        self.assertEqual(pagination.cached_count(self.tag.books.all()), (4, False))
+        Book.objects.filter(title='Книга').delete()
+        self.assertEqual(pagination.cached_count(self.tag.books.all()), (3, False))
+
+    @override_settings(COUNT_ESTIMATE_THRESHOLD=2)
+    def test_estimate(self):
+        last = Book.objects.order_by('pk').last().pk
+        self.assertEqual(pagination.cached_count(Book.objects.all()), (last, True))
+        self.assertEqual(pagination.cached_count(self.tag.books.all()), (3, False))
+        resp = self.client.get(reverse('index'))
+        self.assertTrue(resp.context['paginator'].is_estimate)
+        self.assertContains(resp, 'примерно')
+
+    def test_single_count_per_request(self):
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(reverse('book-search') + '?query=книга')
+        self.assertEqual(resp.context['objects_count'], 3)
+        self.assertEqual(len([query for query in queries if 'COUNT(' in query['sql']]), 1)
+
+    def test_search_follows_linked_rows(self):
+        url = reverse('book-search') + '?query=tolstoy'
+        self.assertEqual(self.client.get(url).context['objects_count'], 0)
+        author = Author.objects.create(name='Leo Tolstoy')
+        Book.objects.first().authors.add(author)
+        resp = self.client.get(url)
+        self.assertEqual(resp.context['objects_count'], 1)
+        self.assertFalse(resp.context['is_fuzzy'])
+        author.name = 'Lev Nikolayevich'
+        author.save()
+        self.assertEqual(self.client.get(url).context['objects_count'], 0)
+
+
+class BookCountTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.authors = [Author.objects.create(name='Автор {}'.format(number)) for number in range(3)]
+        cls.tag = Tag.objects.create(name='роман')
+        cls.series = Series.objects.create(title='Серия', description='')
+        cls.publisher = Publisher.objects.create(name='Издатель')
+
+    def counts(self):
+        return [author.book_count for author in Author.objects.order_by('pk')] + \
+            [model.objects.get().book_count for model in (Tag, Series, Publisher)]
+
+    def test_signals(self):
+        book = Book.objects.create(title='Книга', description='', series=self.series)
+        book.authors.add(*self.authors[:2])
+        book.authors.add(self.authors[0])
+        self.tag.books.add(book, Book.objects.create(title='Другая', description=''))
+        self.assertEqual(self.counts(), [1, 1, 0, 2, 1, 0])
+
+        book.authors.remove(self.authors[0], self.authors[2])
+        book.series, book.publisher = None, self.publisher
+        book.save()
+        self.assertEqual(self.counts(), [0, 1, 0, 2, 0, 1])
+
+        book.authors.set(self.authors[1:])
+        self.tag.books.clear()
+        self.assertEqual(self.counts(), [0, 1, 1, 0, 0, 1])
+
+        Book.objects.filter(pk=book.pk).delete()
+        self.assertEqual(self.counts(), [0, 0, 0, 0, 0, 0])
+
+    def test_stale_instance(self):
+        self.tag.books.add(Book.objects.create(title='Книга', description=''))
+        self.tag.name = 'классика'
+        self.tag.save()
+        self.assertEqual(Tag.objects.get().book_count, 1)
+
+    def test_list_without_aggregation(self):
+        self.authors[1].books.add(Book.objects.create(title='Книга', description=''))
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(reverse('author-list') + '?ordering=-book_count')
+        self.assertEqual(resp.context['authors'][0], self.authors[1])
+        self.assertFalse([query for query in queries if 'GROUP BY' in query['sql']])
+
+    def test_reconcile(self):
+        self.authors[0].books.add(Book.objects.create(title='Книга', description='', publisher=self.publisher))
+        Author.objects.update(book_count=5)
+        Publisher.objects.update(book_count=0)
+        out = io.StringIO()
+        call_command('reconcile_book_counts', '--batch-size=2', stdout=out)
+        self.assertEqual(self.counts(), [1, 0, 0, 0, 0, 1])
+        self.assertIn('authors: 3 fixed', out.getvalue())
+
+
+class TaxonomyListTest(TestCase):
+    def test_first_letter(self):
+        self.assertEqual([search.first_letter(name) for name in ['ёжик', 'Émile', ' 1984', '«Война»', '漢字', '']],
+                         ['Е', 'E', '#', 'В', '*', '*'])
+
+    def test_letter_follows_name(self):
+        series = Series.objects.create(title='Хроники', description='')
+        self.assertEqual(series.letter, 'Х')
+        series.title = 'Anthology'
+        series.save(update_fields=['title'])
+        self.assertEqual(Series.objects.get().letter, 'A')
+        pks = extraction.get_or_create_names(Tag, 'name', ['1812', 'поэзия'])
+        self.assertEqual(Tag.objects.get(pk=pks['поэзия']).letter, 'П')
+        self.assertEqual(Tag.objects.get(pk=pks['1812']).letter, '#')
+
+    def test_letter_filter(self):
+        for name in ['Азимов', 'Акунин', 'Булгаков', 'Asimov']:
+            Author.objects.create(name=name)
+        resp = self.client.get(reverse('author-list'), {'letter': 'А', 'ordering': '-name'})
+        self.assertEqual([author.name for author in resp.context['authors']], ['Акунин', 'Азимов'])
+        self.assertEqual(resp.context['letter'], 'А')
+        self.assertContains(resp, 'href="?ordering=name&amp;letter=%D0%90"')
+        resp = self.client.get(reverse('author-list'), {'letter': 'АБ', 'ordering': 'description'})
+        self.assertEqual(len(resp.context['authors']), 4)
+        self.assertEqual(resp.context['authors'][0].name, 'Asimov')
+
+    def test_pages(self):
+        per_page = settings.TAXONOMY_ITEMS_PER_PAGE
+        tags = [Tag(name='тег {:04}'.format(number)) for number in range(per_page + 5)]
+        for tag in tags:
+            tag.update_letter()
+        Tag.objects.bulk_create(tags)
+        resp = self.client.get(reverse('tag-list'), {'letter': 'Т'})
+        self.assertTrue(resp.context['is_paginated'])
+        self.assertEqual(len(resp.context['tags']), per_page)
+        resp = self.client.get(reverse('tag-list') + resp.context['page_obj'].next_url)
+        self.assertEqual([tag.name for tag in resp.context['tags']],
+                         ['тег {:04}'.format(number) for number in range(per_page, per_page + 5)])
+
+
+class StatisticsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = get_user_model().objects.create(username='stats')
+        author = Author.objects.create(name='Пушкин')
+        for number, (published_at, extension, size) in enumerate(
+                [('1833-01-01', 'epub', 100), ('1833-06-01', 'PDF', 300), ('1999-01-01', 'epub', 50), (None, 'fb2', 7)]):
+            book = Book.objects.create(title='Книга {}'.format(number), description='', published_at=published_at)
+            book.authors.add(author)
+            File.objects.create(book=book, extension=extension, size=size, uploader=user)
+        Book.objects.update(created_at=datetime.datetime(2020, 3, 10, tzinfo=datetime.timezone.utc))
+        Book.objects.filter(title='Книга 0').update(created_at=datetime.datetime(2020, 1, 15, tzinfo=datetime.timezone.utc))
+
+    def setUp(self):
+        cache.clear()
+
+    def test_snapshot(self):
+        snapshot = statistics.refresh()
+        self.assertEqual(snapshot['books_per_year'], [(1833, 2), (1999, 1)])
+        self.assertEqual(snapshot['storage'], [('pdf', 1, 300), ('epub', 2, 150), ('fb2', 1, 7)])
+        self.assertEqual(snapshot['top_authors'], [(Author.objects.get().pk, 'Пушкин', 4)])
+        growth = snapshot['growth']
+        self.assertEqual(len(growth), 3)
+        self.assertEqual([row[1] for row in growth], [1, 0, 3])
+        self.assertEqual(growth[-1][3:], (4, 457))
+
+    def test_view_reads_snapshot(self):
+        statistics.refresh()
+        self.client.get(reverse('statistic'))
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(reverse('statistic'))
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(resp.context['totals']['books'], (4, False))
+        self.assertContains(resp, 'Пушкин')
+
+    @mock.patch('bookstore.statistics._refresh_in_background')
+    def test_missing_snapshot(self, refresh):
+        resp = self.client.get(reverse('statistic'))
+        self.assertIs(resp.context['snapshot'], statistics.PLACEHOLDER)
+        self.assertContains(resp, 'being computed')
+        self.assertEqual(resp.context['totals']['books'], (4, False))
+        self.client.get(reverse('statistic'))
+        self.assertEqual(refresh.call_count, 1)
+
+    @mock.patch('bookstore.statistics._refresh_in_background')
+    def test_stale_snapshot(self, refresh):
+        stale = statistics.refresh()
+        stale['generated_at'] -= datetime.timedelta(seconds=settings.STATISTICS_MAX_AGE + 1)
+        cache.set(statistics.SNAPSHOT_KEY, stale, None)
+        self.assertEqual(statistics.snapshot(), stale)
+        self.assertEqual(statistics.snapshot(), stale)
+        self.assertEqual(refresh.call_count, 1)
+        cache.delete(statistics.LOCK_KEY)
+        statistics.refresh()
+        statistics.snapshot()
+        self.assertEqual(refresh.call_count, 1)
+
+
+class PageCacheTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(name='Пушкин')
+        cls.other = Author.objects.create(name='Гоголь')
+        cls.tag = Tag.objects.create(name='поэзия')
+        cls.series = [Series.objects.create(title=title, description='') for title in ['Первая', 'Вторая']]
+        cls.book = Book.objects.create(title='Онегин', description='', series=cls.series[0])
+        cls.book.authors.add(cls.author)
+
+    def setUp(self):
+        cache.clear()
+
+    def assertCached(self, url, cached=True):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertEqual(len(queries) == 0, cached, url)
+
+    def test_hit(self):
+        resp = self.client.get(reverse('index'))
+        with self.assertNumQueries(0):
+            cached = self.client.get(reverse('index'))
+        self.assertEqual(cached.content, resp.content)
+        self.assertEqual(cached['Content-Type'], resp['Content-Type'])
+        self.assertCached(reverse('index') + '?ordering=title', cached=False)
+
+    def test_invalidation(self):
+        urls = [reverse('index'), reverse('author-detail', args=[self.author.pk]),
+                reverse('author-detail', args=[self.other.pk]), reverse('tag-detail', args=[self.tag.pk]),
+                reverse('series-detail', args=[self.series[0].pk]), reverse('series-detail', args=[self.series[1].pk])]
+        for url in urls:
+            self.client.get(url)
+        self.book.title = 'Евгений Онегин'
+        self.book.save()
+        for url, cached in zip(urls, [False, False, True, True, False, True]):
+            self.assertCached(url, cached)
+        self.book.tags.add(self.tag)
+        self.assertCached(urls[3], cached=False)
+        self.book.series = self.series[1]
+        self.book.save()
+        self.assertCached(urls[4], cached=False)
+        self.assertCached(urls[5], cached=False)
+        self.author.books.clear()
+        self.assertCached(urls[1], cached=False)
+        self.assertCached(urls[2], cached=True)
+        pagination.invalidate_counts()
+        self.assertCached(urls[2], cached=False)
+
+    def test_logged_in(self):
+        self.client.force_login(get_user_model().objects.create(username='reader'))
+        self.client.get(reverse('index'))
+        self.assertCached(reverse('index'), cached=False)
+
+
+class BenchmarkTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.book = Book.objects.create(title='Война и мир', description='')
+        cls.author = Author.objects.create(name='Лев Толстой')
+
+    def test_endpoints(self):
+        urls = dict(benchmark.endpoints('война'))
+        self.assertEqual(urls['book-detail'], reverse('book-detail', kwargs={'pk': self.book.pk}))
+        self.assertEqual(urls['search'], reverse('search') + '?query=война')
+        self.assertIn('api:books-detail', urls)
+        self.assertNotIn('tag-detail', urls)
+        self.assertFalse([name for name in urls if 'delete' in name])
+
+    def test_measure(self):
+        self.client.force_login(self.user)
+        result = benchmark.measure(self.client, reverse('book-detail', kwargs={'pk': self.book.pk}), repeat=3)
+        self.assertEqual(result['status'], 200)
+        self.assertGreater(result['queries'], 0)
+        self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+    def test_compare(self):
+        baseline = {'endpoints': {'index': {'p95_ms': 10.0, 'queries': 5}, 'search': {'p95_ms': 10.0, 'queries': 5}}}
+        current = {'endpoints': {'index': {'p95_ms': 11.0, 'queries': 5}, 'search': {'p95_ms': 20.0, 'queries': 6}}}
+        self.assertEqual(benchmark.compare(baseline, current, 0.2),
+                         ['search: p95 10.0 ms -> 20.0 ms', 'search: 5 queries -> 6'])
+
+
+@override_settings(QUERY_INSTRUMENTATION=True, QUERY_REPEAT_THRESHOLD=2, QUERY_EXPLAIN_THRESHOLD=10 ** 6,
+                   TEMPLATES=[dict(settings.TEMPLATES[0], NAME='django',
+                                   BACKEND='bookstore.instrumentation.InstrumentedDjangoTemplates')],
+                   DEFAULT_FILE_STORAGE='bookstore.instrumentation.InstrumentedFileSystemStorage')
+class QueryInstrumentationTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = Author.objects.create(name='Лев Толстой')
+        for number in range(5):
+            Book.objects.create(title='Книга {}'.format(number), description='').authors.add(author)
+
+    def test_normalize_sql(self):
+        self.assertEqual(instrumentation.normalize_sql('SELECT * FROM t WHERE id IN (%s, %s)  AND x = 5'),
+                         instrumentation.normalize_sql("SELECT * FROM t WHERE id IN (%s, %s, %s) AND x = 'a'"))
+
+    def test_server_timing(self):
+        resp = self.client.get(reverse('index'))
+        metrics = [metric.split(';')[0] for metric in resp['Server-Timing'].split(', ')]
+        self.assertEqual(metrics, ['db', 'template', 'storage', 'total'])
+
+    def test_template_timing(self):
+        cache.clear()
+        # render() views and the page cached views render outside of a TemplateResponse
+        for url in (reverse('statistic'), reverse('search') + '?query=Книга', reverse('author-list'), reverse('index')):
+            timings = dict(metric.split(';')[:2] for metric in self.client.get(url)['Server-Timing'].split(', '))
+            self.assertGreater(float(timings['template'][4:]), 0, url)
+            self.assertLessEqual(float(timings['template'][4:]), float(timings['total'][4:]), url)
+
+    def test_repeated_queries(self):
+        with self.assertLogs('bookstore.instrumentation', 'WARNING') as logs:
+            with connection.execute_wrapper(instrumentation.RequestProfile()):
+                for book in Book.objects.all():
+                    list(book.authors.all())
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Query repeated more than 2 times', logs.output[0])
+        self.assertIn('tests.py', logs.output[0])
+
+    @override_settings(QUERY_EXPLAIN_THRESHOLD=0)
+    def test_explain(self):
+        with self.assertLogs('bookstore.instrumentation', 'WARNING') as logs:
+            self.client.get(reverse('book-detail', kwargs={'pk': Book.objects.first().pk}))
+        self.assertTrue([line for line in logs.output if 'Slow query' in line and 'bookstore_book' in line])
+
+    @override_settings(QUERY_INSTRUMENTATION=False)
+    def test_disabled(self):
+        self.assertNotIn('Server-Timing', self.client.get(reverse('index')))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class BookCoverViewTest(TestCase):
+    content = b'\x89PNG\r\n\x1a\n' + b'\x00' * 100
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title='Война и мир', description='', has_cover=True)
+
+    def setUp(self):
+        default_storage.save('covers/' + self.book.uuid.hex, ContentFile(self.content))
+
+    def tearDown(self):
+        default_storage.delete('covers/' + self.book.uuid.hex)
+
+    def test_cover(self):
+        resp = self.client.get(reverse('book-cover', kwargs={'pk': self.book.pk}))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'image/png')
+        self.assertEqual(resp['ETag'], '"{}"'.format(self.book.cover_version))
+        self.assertEqual(resp['Cache-Control'], 'public, no-cache')
+        self.assertEqual(b''.join(resp.streaming_content), self.content)
+
+    def test_versioned_cover_is_immutable(self):
+        resp = self.client.get(self.book.get_cover_url())
+        self.assertEqual(resp['Cache-Control'], 'public, max-age=31536000, immutable')
+
+    def test_not_modified(self):
+        url = reverse('book-cover', kwargs={'pk': self.book.pk})
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH='"{}"'.format(self.book.cover_version))
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get(url, HTTP_IF_MODIFIED_SINCE=resp['Last-Modified'])
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_missing_cover(self):
+        book = Book.objects.create(title='No cover', description='')
+        resp = self.client.get(reverse('book-cover', kwargs={'pk': book.pk}))
+        self.assertEqual(resp.status_code, 404)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class CoverVariantsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title='Война и мир', description='', has_cover=True)
+
+    def setUp(self):
+        from PIL import Image
+
+        buffer = io.BytesIO()
+        Image.new('RGB', (800, 1200), 'red').save(buffer, format='PNG')
+        covers.save_cover(self.book, ContentFile(buffer.getvalue()))
+
+    def tearDown(self):
+        covers.delete_cover(self.book.uuid.hex)
+
+    def test_variants(self):
+        from PIL import Image
+
+        for name in covers.variant_names(self.book.uuid.hex):
+            self.assertTrue(default_storage.exists(name), name)
+        with default_storage.open(covers.cover_name(self.book.uuid.hex, 'list')) as f:
+            self.assertEqual(Image.open(f).size, (200, 300))
+
+    def test_variant_view(self):
+        resp = self.client.get(self.book.get_cover_url('list', 'webp'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'image/webp')
+        self.assertEqual(resp['Cache-Control'], 'public, max-age=31536000, immutable')
+        original = self.client.get(self.book.get_cover_url())
+        self.assertNotEqual(resp['ETag'], original['ETag'])
+
+    def test_backfill(self):
+        for name in covers.variant_names(self.book.uuid.hex):
+            default_storage.delete(name)
+        call_command('render_cover_variants', workers=1, stdout=io.StringIO())
+        self.assertTrue(default_storage.exists(covers.cover_name(self.book.uuid.hex, 'detail', 'webp')))
+
+    def test_broken_image_keeps_cover(self):
+        with self.assertRaises(OSError):
+            covers.save_cover(self.book, ContentFile(b'not an image'))
+        self.assertTrue(default_storage.exists(covers.cover_name(self.book.uuid.hex, 'list')))
+
+    def test_edit_view(self):
+        get_user_model().objects.create_user('temporary', 'temporary@temp.com', 'temporary')
+        self.client.login(username='temporary', password='temporary')
+        book = Book.objects.create(title='Анна Каренина', description='')
+        url = reverse('book-edit', kwargs={'pk': book.pk})
+        data = {'title': book.title, 'description': ''}
+        resp = self.client.post(url, dict(data, cover=SimpleUploadedFile('cover.jpg', b'not an image')))
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.context['form'].errors['cover'])
+        self.assertFalse(Book.objects.get(pk=book.pk).has_cover)
+        self.assertFalse(default_storage.exists(covers.cover_name(book.uuid.hex)))
+
+        buffer = io.BytesIO()
+        Image.new('RGB', (60, 90), 'red').save(buffer, format='JPEG')
+        resp = self.client.post(url, dict(data, cover=SimpleUploadedFile('cover.jpg', buffer.getvalue())))
+        self.assertRedirects(resp, reverse('book-detail', kwargs={'pk': book.pk}))
+        self.assertTrue(Book.objects.get(pk=book.pk).has_cover)
+        self.assertTrue(default_storage.exists(covers.cover_name(book.uuid.hex, 'list')))
@@ -1,8 +1,9 @@
 from django.urls import path, include
 from .views import *
-from .api_views import router
+from .api_views import router, AutocompleteView
 
 urlpatterns = [
+    path('api/autocomplete', AutocompleteView.as_view(), name='autocomplete'),
     path('api/', include((router.urls, 'candle'), namespace='api')),
 
     path('', BookListView.as_view(), name='index'),
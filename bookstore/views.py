@@ -2,6 +2,8 @@ from django.shortcuts import render, redirect, reverse
 from django.http import Http404, HttpResponse
 from django.core.files.storage import default_storage
 from django.utils.text import get_valid_filename
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, urlencode
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.generic.base import View
@@ -10,40 +12,116 @@ from django.views.generic.edit import CreateView, UpdateView, DeleteView, FormVi
 from django.views.generic.detail import DetailView
 from django.conf import settings
 from django.urls import reverse_lazy
-from django.core.paginator import Paginator
-from django.db.models import Count
-from django.utils.translation import ugettext as _
+from django.utils.translation import ugettext as _, ugettext_lazy
 from bookstore.models import *
 from bookstore.forms import BookForm, FileUploadForm
-import mimetypes
+from bookstore import search, covers, storage, formats, pagination, statistics, caching
+from bookstore.responses import serve_file, guess_content_type
+from pathlib import Path
+
+
+class PageCacheMixin:
+    """
+    Serves anonymous visitors from the page cache (``bookstore.caching``). A
+    page is dropped when a row it showed changes, or any row of
+    ``cache_models``, the models it lists.
+    """
+    cache_models = []
+
+    def dispatch(self, request, *args, **kwargs):
+        if not caching.is_cacheable(request):
+            return super().dispatch(request, *args, **kwargs)
+        key = caching.page_key(request, type(self).__name__)
+        response = caching.get_page(key)
+        if response is not None:
+            return response
+        tag_versions = caching.versions(caching.model_tag(model) for model in self.cache_models)
+        with caching.collect_tags() as tags:
+            response = super().dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+        tag_versions.update(caching.versions(tags - tag_versions.keys()))
+        caching.set_page(key, response, tag_versions)
+        return response
+
+
+class DeepPageMixin:
+    """Redirects the numbered pages past the page links to the first page, see ``pagination.DeepPage``."""
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except pagination.DeepPage as e:
+            return redirect(e.url)
 
 
 class OrderingMixin:
-    queryset = None
+    """
+    Taxonomy lists: sorted by name or number of books (both indexed, also
+    within a letter), filtered by the ``?letter=`` of the letter index and
+    paged like the book lists.
+    """
     order_by_default = 'name'
-
-    def get_queryset(self):
-        self.queryset = self.model.objects.annotate(book_nums=Count('books'))
-        return super().get_queryset()
+    paginate_by = settings.TAXONOMY_ITEMS_PER_PAGE
 
     def get_ordering(self):
+        orderings = {
+            self.order_by_default: [self.order_by_default, 'pk'],
+            '-' + self.order_by_default: ['-' + self.order_by_default, '-pk'],
+            'book_count': ['book_count', 'pk'],
+            '-book_count': ['-book_count', '-pk'],
+        }
         ordering = self.request.GET.get('ordering', self.order_by_default)
-        return ordering
+        return orderings.get(ordering, orderings[self.order_by_default])
+
+    def get_letter(self):
+        letter = self.request.GET.get('letter', '')
+        return letter if letter in search.LETTERS else None
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        letter = self.get_letter()
+        if letter:
+            queryset = queryset.filter(letter=letter)
+        return queryset
+
+    def paginate_queryset(self, queryset, page_size):
+        page = pagination.paginate(self.request, queryset, self.get_ordering(), page_size)
+        return getattr(page, 'paginator', None), page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['letters'] = search.LETTERS
+        context['letter'] = self.get_letter()
+        return context
 
 
-class BookListView(ListView):
+class BookListView(DeepPageMixin, PageCacheMixin, ListView):
     model = Book
+    cache_models = [Book]
     template_name = 'book_list.html'
     paginate_by = settings.ITEMS_PER_PAGE
     extra_context = {'title': 'Список книг'}
     context_object_name = 'books'
+    queryset = Book.objects.cards()
+    # Sort keys offered by the list; the primary key makes each of them unique for the cursors.
+    orderings = {
+        '-created_at': ['-created_at', '-pk'],
+        'created_at': ['created_at', 'pk'],
+        'title': ['title', 'pk'],
+        '-title': ['-title', '-pk'],
+    }
 
     def get_ordering(self):
         ordering = self.request.GET.get('ordering', '-created_at')
-        return ordering
+        return self.orderings.get(ordering, self.orderings['-created_at'])
 
+    def paginate_queryset(self, queryset, page_size):
+        page = pagination.paginate(self.request, queryset, self.get_ordering(), page_size)
+        return getattr(page, 'paginator', None), page, page.object_list, page.has_other_pages()
 
-class BookDetailView(DetailView):
+
+class BookDetailView(PageCacheMixin, DetailView):
     model = Book
     template_name = 'book_detail.html'
     context_object_name = 'book'
@@ -54,7 +132,35 @@ class BookDetailView(DetailView):
         return context
 
 
-class BookEditView(LoginRequiredMixin, UpdateView):
+class FileSaveMixin:
+    """Stores uploaded book files, checking each file's real format on the way."""
+
+    def stage_files(self, files):
+        """
+        Writes ``files`` concurrently and returns ``(extension, blob)`` for those
+        whose content matches a supported format.
+        """
+        staged = []
+        for file, blob in zip(files, storage.stage_blobs(files)):
+            ext = formats.detect_book_format(blob.head, Path(file.name).suffix[1:].lower())
+            if ext is None:
+                storage.discard_blob(blob)
+                messages.warning(self.request, _('File "%(name)s" is damaged or has a wrong extension!')
+                                 % {'name': file.name})
+                continue
+            staged.append((ext, blob))
+        return staged
+
+    def save_file(self, book, ext, blob):
+        storage.commit_blob(blob)
+        return File.objects.create(book=book,
+                                   extension=ext,
+                                   size=blob.size,
+                                   checksum=blob.checksum,
+                                   uploader=self.request.user)
+
+
+class BookEditView(LoginRequiredMixin, FileSaveMixin, UpdateView):
     template_name = 'book_editor.html'
     model = Book
     form_class = BookForm
@@ -68,32 +174,18 @@ class BookEditView(LoginRequiredMixin, UpdateView):
         return context
 
     def form_valid(self, form):
-        from pathlib import Path
-
-        response = super().form_valid(form)
-        files = self.request.FILES.getlist('files')
-        cover = self.request.FILES.get('cover', None)
+        cover = form.cleaned_data.get('cover')
         if cover:
-            self.object.has_cover = True
-            self.object.save()
-            if default_storage.exists("covers/" + self.object.uuid.hex):
-                default_storage.delete("covers/" + self.object.uuid.hex)
-            default_storage.save("covers/" + self.object.uuid.hex, cover)
-        for f in files:
-            ext = Path(f.name).suffix[1:].lower()
-            size = f.size
-
-            old_file = File.objects.filter(book=self.object, extension=ext).first()
-            if old_file:
-                default_storage.delete('books/' + old_file.uuid.hex)
-                old_file.delete()
-
-            new_file = File(book=self.object,
-                            extension=ext,
-                            size=size,
-                            uploader=self.request.user)
-            new_file.save()
-            default_storage.save('books/' + new_file.uuid.hex, f)
+            try:
+                covers.save_cover(self.object, cover)
+            except OSError:
+                form.add_error('cover', form.fields['cover'].error_messages['invalid_image'])
+                return self.form_invalid(form)
+            form.instance.has_cover = True
+        response = super().form_valid(form)
+        for ext, blob in self.stage_files(self.request.FILES.getlist('files')):
+            File.objects.filter(book=self.object, extension=ext).delete()
+            self.save_file(self.object, ext, blob)
 
         return response
 
@@ -106,14 +198,15 @@ class BookDeleteView(LoginRequiredMixin, DeleteView):
         return self.post(*args, **kwargs)
 
 
-class AuthorListView(OrderingMixin, ListView):
+class AuthorListView(DeepPageMixin, PageCacheMixin, OrderingMixin, ListView):
     model = Author
+    cache_models = [Author]
     template_name = 'author_list.html'
     context_object_name = 'authors'
     extra_context = {'title': 'Список авторов'}
 
 
-class AuthorDetailView(DetailView):
+class AuthorDetailView(DeepPageMixin, PageCacheMixin, DetailView):
     model = Author
     template_name = 'author_detail.html'
     context_object_name = 'author'
@@ -121,11 +214,9 @@ class AuthorDetailView(DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['title'] = 'Author {} - detail'.format(self.object.name)
-        books = self.object.books.all()
-        paginator = Paginator(books, settings.ITEMS_PER_PAGE)
-        page_number = self.request.GET.get('page')
+        books = self.object.books.cards()
         context['books'] = books
-        context['page_obj'] = paginator.get_page(page_number)
+        context['page_obj'] = pagination.paginate(self.request, books, ['-pk'])
         return context
 
 
@@ -178,14 +269,15 @@ class AuthorDeleteView(LoginRequiredMixin, DeleteView):
         return self.post(*args, **kwargs)
 
 
-class TagListView(OrderingMixin, ListView):
+class TagListView(DeepPageMixin, PageCacheMixin, OrderingMixin, ListView):
     model = Tag
+    cache_models = [Tag]
     template_name = 'tag_list.html'
     context_object_name = 'tags'
     extra_context = {'title': 'Список тегов'}
 
 
-class TagDetailView(DetailView):
+class TagDetailView(DeepPageMixin, PageCacheMixin, DetailView):
     model = Tag
     template_name = 'tag_detail.html'
     context_object_name = 'tag'
@@ -194,10 +286,8 @@ class TagDetailView(DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['title'] = 'Тег "{}"'.format(self.object.name)
-        books = self.object.books.all()
-        paginator = Paginator(books, settings.ITEMS_PER_PAGE)
-        page_number = self.request.GET.get('page')
-        context['page_obj'] = paginator.get_page(page_number)
+        books = self.object.books.cards()
+        context['page_obj'] = pagination.paginate(self.request, books, ['-pk'])
         return context
 
 
@@ -238,15 +328,16 @@ class TagDeleteView(LoginRequiredMixin, DeleteView):
         return self.post(*args, **kwargs)
 
 
-class SeriesListView(OrderingMixin, ListView):
+class SeriesListView(DeepPageMixin, PageCacheMixin, OrderingMixin, ListView):
     model = Series
+    cache_models = [Series]
     template_name = 'series_list.html'
     context_object_name = 'series'
     extra_context = {'title': 'Список серий'}
     order_by_default = 'title'
 
 
-class SeriesDetailView(DetailView):
+class SeriesDetailView(DeepPageMixin, PageCacheMixin, DetailView):
     model = Series
     template_name = 'series_detail.html'
     context_object_name = 'series'
@@ -254,10 +345,8 @@ class SeriesDetailView(DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['title'] = 'Book series "{}" - detail'.format(self.object.title)
-        books = self.object.books.all()
-        paginator = Paginator(books, settings.ITEMS_PER_PAGE)
-        page_number = self.request.GET.get('page')
-        context['page_obj'] = paginator.get_page(page_number)
+        books = self.object.books.cards()
+        context['page_obj'] = pagination.paginate(self.request, books, ['-pk'])
         return context
 
 
@@ -303,14 +392,15 @@ class SeriesDeleteView(LoginRequiredMixin, DeleteView):
         return self.post(*args, **kwargs)
 
 
-class PublisherListView(OrderingMixin, ListView):
+class PublisherListView(DeepPageMixin, PageCacheMixin, OrderingMixin, ListView):
     model = Publisher
+    cache_models = [Publisher]
     template_name = 'publisher_list.html'
     context_object_name = 'publishers'
     extra_context = {'title': 'Список издателей'}
 
 
-class PublisherDetailView(DetailView):
+class PublisherDetailView(DeepPageMixin, PageCacheMixin, DetailView):
     model = Publisher
     template_name = 'publisher_detail.html'
     context_object_name = 'publisher'
@@ -319,10 +409,8 @@ class PublisherDetailView(DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['title'] = 'Publisher "{}" - detail'.format(self.object.name)
-        books = self.object.books.all()
-        paginator = Paginator(books, settings.ITEMS_PER_PAGE)
-        page_number = self.request.GET.get('page')
-        context['page_obj'] = paginator.get_page(page_number)
+        books = self.object.books.cards()
+        context['page_obj'] = pagination.paginate(self.request, books, ['-pk'])
         return context
 
 
@@ -373,25 +461,18 @@ class PublisherDeleteView(LoginRequiredMixin, DeleteView):
         return self.post(*args, **kwargs)
 
 
-class FileUploadView(LoginRequiredMixin, FormView):
+class FileUploadView(LoginRequiredMixin, FileSaveMixin, FormView):
     form_class = FileUploadForm
 
     def form_valid(self, form):
-        from pathlib import Path
+        staged = self.stage_files(self.request.FILES.getlist('files'))
+        if not staged:
+            return self.form_invalid(form)
 
-        files = self.request.FILES.getlist('files')
         book = Book()
         book.save()
-
-        for file in files:
-            ext = Path(file.name).suffix[1:].lower()
-            size = file.size
-            f = File(book=book,
-                     extension=ext,
-                     size=size,
-                     uploader=self.request.user)
-            f.save()
-            default_storage.save("books/" + f.uuid.hex, file)
+        for ext, blob in staged:
+            self.save_file(book, ext, blob)
         return redirect(reverse('book-edit', kwargs={'pk': book.pk}))
 
     def form_invalid(self, form):
@@ -409,11 +490,12 @@ class FileDownloadView(DetailView):
 
     def get(self, request, *args, **kwargs):
         file = self.get_object()
-        response = HttpResponse(default_storage.open("books/" + file.uuid.hex).read(),
-                                content_type=mimetypes.guess_type(file.extension))
         filename = get_valid_filename(file.book.title + '.' + file.extension)
-        response['Content-Disposition'] = 'attachment; filename=' + filename
-        return response
+        return serve_file(request, file.storage_name,
+                          content_type=guess_content_type(file.extension),
+                          filename=filename,
+                          as_attachment=True,
+                          etag='"{}"'.format(file.checksum or file.uuid.hex))
 
 
 class FileDeleteView(LoginRequiredMixin, DetailView):
@@ -421,8 +503,7 @@ class FileDeleteView(LoginRequiredMixin, DetailView):
 
     def get(self, request, *args, **kwargs):
         file = self.get_object()
-        book_id = file.book.id
-        default_storage.delete(file.uuid.hex)
+        book_id = file.book_id
         file.delete()
         redirect_uri = self.request.META.get('HTTP_REFERER', None) or reverse('book-edit', kwargs={'pk': book_id})
         return redirect(redirect_uri)
@@ -433,26 +514,55 @@ class BookCoverView(DetailView):
 
     def get(self, request, *args, **kwargs):
         book = self.get_object()
-        response = HttpResponse(default_storage.open('covers/' + book.uuid.hex).read(),
-                                content_type='image/jpeg')
-        response['Content-Disposition'] = 'attachment'
+        if not book.has_cover:
+            raise Http404
+        name = covers.cover_name(book.uuid.hex)
+        version = book.cover_version
+        size = request.GET.get('size')
+        image_format = request.GET.get('format', 'jpeg')
+        if size in settings.COVER_SIZES and image_format in covers.FORMATS:
+            variant = covers.cover_name(book.uuid.hex, size, image_format)
+            # Covers that were not backfilled yet fall back to the original.
+            if default_storage.exists(variant):
+                name = variant
+                version = '{}-{}-{}'.format(version, size, image_format)
+        etag = '"{}"'.format(version)
+        response = get_conditional_response(request, etag=etag,
+                                            last_modified=int(book.last_modified.timestamp()))
+        if response is None:
+            response = serve_file(request, name, etag=etag)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(book.last_modified.timestamp())
+        if request.GET.get('v') == book.cover_version and (name != covers.cover_name(book.uuid.hex) or not size):
+            response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response['Cache-Control'] = 'public, no-cache'
         return response
 
 
 class StatisticView(View):
     def get(self, request, *args, **kwargs):
+        snapshot = statistics.snapshot()
+        years = snapshot['books_per_year']
         context = {
-            'book_count': Book.objects.count(),
-            'author_count': Author.objects.count(),
-            'tag_count': Tag.objects.count(),
-            'series_count': Series.objects.count(),
-            'publisher_count': Publisher.objects.count(),
+            'totals': statistics.totals(),
+            'snapshot': snapshot,
+            'most_books_per_year': max([count for year, count in years], default=0),
             'title': 'Статистика'
         }
         return render(request=request, template_name='statistic.html', context=context)
 
 
 class SearchView(View):
+    template_name = 'search_results.html'
+    kind_labels = {
+        'book': ugettext_lazy('Books'),
+        'author': ugettext_lazy('Authors'),
+        'tag': ugettext_lazy('Tags'),
+        'series': ugettext_lazy('Series'),
+        'publisher': ugettext_lazy('Publishers'),
+    }
+
     def get(self, request, *args, **kwargs):
         import re
         query_string = self.request.GET.get('query', '')
@@ -470,28 +580,38 @@ class SearchView(View):
             redirect_uri = self.request.META.get('HTTP_REFERER', reverse('index'))
             return redirect(redirect_uri)
 
+        kinds = None
         if query_subject:
-            if query_subject == 'book:':
-                return redirect(reverse('book-search') + "?query=" + query_string)
-            elif query_subject == 'author:':
-                return redirect(reverse('author-search') + "?query=" + query_string)
-            elif query_subject == 'tag:':
-                return redirect(reverse('tag-search') + "?query=" + query_string)
-            elif query_subject == 'series:':
-                return redirect(reverse('series-search') + "?query=" + query_string)
-            elif query_subject == 'publisher:':
-                return redirect(reverse('publishers-search') + "?query=" + query_string)
-            else:
+            kind = query_subject[:-1]
+            if kind not in search.KINDS:
                 messages.warning(self.request, _('Wrong search operator!'))
                 redirect_uri = self.request.META.get('HTTP_REFERER', reverse('index'))
                 return redirect(redirect_uri)
+            kinds = [kind]
 
-        return redirect(reverse('book-search') + "?query=" + query_string)
+        result = search.search_catalog(query_string, kinds)
+        context = {
+            'title': 'Search by "{}"'.format(query_string),
+            'query_string': query_string,
+            'result': result,
+            'groups': [
+                {
+                    'kind': group.kind,
+                    'label': self.kind_labels[group.kind],
+                    'objects': [hit.object for hit in group.hits],
+                    'total': group.total,
+                    'search_url': reverse(search.KINDS[group.kind][2]) + '?' + urlencode({'query': query_string}),
+                }
+                for group in result.groups
+            ],
+        }
+        return render(request=request, template_name=self.template_name, context=context)
 
 
 class SubjectSearchView(ListView):
     template_name = 'search_page.html'
     paginate_by = 20
+    paginator_class = pagination.CachedCountPaginator
 
     def get_query_string(self):
         query_string = self.request.GET.get('query', '')
@@ -501,8 +621,10 @@ class SubjectSearchView(ListView):
         context = super().get_context_data(**kwargs)
         context['title'] = 'Search by "{}"'.format(self.get_query_string())
         context['query_string'] = self.get_query_string()
-        context['objects_count'] = self.get_queryset().count()
+        context['objects_count'] = context['paginator'].count
         context['search_object'] = self.context_object_name
+        context['suggestions'] = self.suggestions
+        context['is_fuzzy'] = self.is_fuzzy
         return context
 
     def get(self, request, *args, **kwargs):
@@ -511,14 +633,28 @@ class SubjectSearchView(ListView):
             messages.warning(self.request, _('Query must have min 3 character!'))
             redirect_uri = self.request.META.get('HTTP_REFERER', reverse('index'))
             return redirect(redirect_uri)
-        self.queryset = self.model.objects.search(query_string)
+        self.queryset = self.search(query_string)
+        self.suggestions = []
+        self.is_fuzzy = False
+        hits, is_estimate = pagination.cached_count(self.queryset)
+        if hits < settings.SEARCH_SUGGESTION_HITS:
+            self.suggestions = search.suggest(query_string)
+            if not hits and self.suggestions:
+                self.queryset = self.search(query_string, fuzzy=True)
+                self.is_fuzzy = True
         return super().get(self.request, args, kwargs)
 
+    def search(self, query_string, fuzzy=False):
+        return self.model.objects.search(query_string, fuzzy=fuzzy)
+
 
 class BookSearchView(SubjectSearchView):
     model = Book
     context_object_name = 'books'
 
+    def search(self, query_string, fuzzy=False):
+        return super().search(query_string, fuzzy).cards()
+
 
 class AuthorSearchView(SubjectSearchView):
     model = Author
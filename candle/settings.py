@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -47,6 +48,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'bookstore.instrumentation.QueryInstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -94,6 +96,31 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# CACHE_BACKEND: file (the processes of one host, the default), redis (a local
+# Redis or a server speaking its protocol) or locmem. A locmem cache lives in one
+# process: the invalidations and statistics of the workers and management
+# commands would never reach the web server, so it is only the default of tests.
+
+CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'candle'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', str(BASE_DIR / 'storage/cache')),
+    'redis': ('django_redis.cache.RedisCache', 'redis://127.0.0.1:6379/1'),
+}
+CACHE_BACKEND, CACHE_LOCATION = CACHE_BACKENDS[
+    os.environ.get('CACHE_BACKEND', default='locmem' if sys.argv[1:2] == ['test'] else 'file')]
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': os.environ.get('CACHE_LOCATION', default=CACHE_LOCATION),
+    }
+}
+if CACHE_BACKEND != CACHE_BACKENDS['redis'][0]:
+    # Versions of the cache tags are entries too; the default of 300 would evict them early.
+    CACHES['default']['OPTIONS'] = {'MAX_ENTRIES': 20000}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -148,6 +175,57 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 MEDIA_ROOT = 'storage/'
 
 ITEMS_PER_PAGE = 20
+# Numbered pages of the book lists; further pages are reached by cursor (bookstore.pagination)
+PAGINATION_PAGE_LINKS = 5
+# Authors, tags, series and publishers per page of their lists
+TAXONOMY_ITEMS_PER_PAGE = 100
+# Paginator counts: seconds a count stays cached (writes invalidate it earlier),
+# and the table size above which unfiltered lists show an estimate instead
+COUNT_CACHE_TIMEOUT = 60 * 60
+COUNT_ESTIMATE_THRESHOLD = 100000
+# Seconds a page stays in the cache for anonymous visitors (writes drop it earlier); 0 disables the page cache
+PAGE_CACHE_TIMEOUT = 10 * 60
+# Seconds a rendered book card stays cached; a change of the book replaces it earlier
+BOOK_CARD_TIMEOUT = 24 * 60 * 60
+# Seconds after which a page view renews the statistics snapshot (refresh_statistics renews it from cron)
+STATISTICS_MAX_AGE = 24 * 60 * 60
+
+# Pre-rendered cover variants: name -> bounding box in pixels
+COVER_SIZES = {
+    'list': (200, 300),
+    'detail': (400, 600),
+}
+COVER_WEBP = True
+
+# Typo-tolerant search: suggestions are offered when a query has fewer hits
+SEARCH_SUGGESTION_HITS = 3
+SEARCH_SUGGESTIONS = 5
+SEARCH_SIMILARITY_THRESHOLD = 0.3
+SEARCH_RESULTS_PER_TYPE = 10
+AUTOCOMPLETE_LIMIT = 5
+
+# Resumable uploads (/api/uploads/): largest accepted chunk, session lifetime in seconds
+UPLOAD_CHUNK_MAX_SIZE = 16 * 1024 * 1024
+UPLOAD_SESSION_EXPIRY = 24 * 60 * 60
+# Threads writing the files of one upload request concurrently
+UPLOAD_WORKERS = 4
+
+# Metadata extraction worker (run_extraction_worker): jobs per batch, seconds
+# between polls of an empty queue, seconds before a running job is retried
+EXTRACTION_BATCH_SIZE = 50
+EXTRACTION_POLL_INTERVAL = 5
+EXTRACTION_JOB_TIMEOUT = 10 * 60
+
+# Per-request profiling (bookstore.instrumentation): Server-Timing header, a warning
+# when one query shape runs more than QUERY_REPEAT_THRESHOLD times in a request and
+# the plans of queries slower than QUERY_EXPLAIN_THRESHOLD milliseconds
+QUERY_INSTRUMENTATION = os.environ.get('QUERY_INSTRUMENTATION', default='').lower() in ('1', 'true', 'yes')
+QUERY_REPEAT_THRESHOLD = 5
+QUERY_EXPLAIN_THRESHOLD = 50
+if QUERY_INSTRUMENTATION:
+    # Template and storage subclasses timing the profiled requests
+    TEMPLATES[0].update(BACKEND='bookstore.instrumentation.InstrumentedDjangoTemplates', NAME='django')
+    DEFAULT_FILE_STORAGE = 'bookstore.instrumentation.InstrumentedFileSystemStorage'
 
 LOGIN_URL = '/auth/login/'
 LOGIN_REDIRECT_URL = '/'